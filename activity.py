@@ -0,0 +1,180 @@
+import os
+import socket
+import logging
+import threading
+from datetime import datetime, timedelta, timezone
+from config import get_env
+from metrics import metrics
+from concurrency import submit
+
+logger = logging.getLogger(__name__)
+
+
+class ActivityTracker:
+    """تتبع المستخدمين النشطين في عُقد يومية activity/<YYYY-MM-DD>/<user_id>"""
+
+    def __init__(self, firebase, cache=None):
+        self.firebase = firebase
+        self.cache = cache
+        self.RETENTION_DAYS = get_env('ACTIVITY_RETENTION_DAYS', 90, int)
+        self._lock = threading.Lock()
+        self._day = None
+        self._seen = set()
+        logger.info(f"✅ تم تهيئة تتبع النشاط | مدة الاحتفاظ: {self.RETENTION_DAYS} يوم")
+
+    @staticmethod
+    def day_key(day=None):
+        day = day or datetime.now(timezone.utc).date()
+        return day.strftime('%Y-%m-%d')
+
+    def _first_today(self, user_id, day):
+        """هل هذا أول نشاط للمستخدم اليوم؟ (محلياً ثم عبر العمليات)"""
+        with self._lock:
+            if self._day != day:
+                self._day = day
+                self._seen = set()
+                rolled_over = True
+            else:
+                rolled_over = False
+            if user_id in self._seen:
+                return False, rolled_over
+            self._seen.add(user_id)
+
+        if self.cache:
+            try:
+                return self.cache.compare_and_set(f'activity:{day}:{user_id}', None, 1, 2 * 86400), rolled_over
+            except Exception as e:
+                # تكرار كتابة النشاط لا يضر، وإسقاطها يُخرج المستخدم من إحصائية اليوم
+                logger.warning(f"⚠️ تعذر التحقق من نشاط المستخدم {user_id}: {str(e)}")
+        return True, rolled_over
+
+    def _release(self, user_id, day):
+        """إلغاء حجز اليوم بعد فشل الكتابة ليُعاد تسجيل النشاط مع التحديث التالي"""
+        with self._lock:
+            if self._day == day:
+                self._seen.discard(user_id)
+        if self.cache:
+            try:
+                self.cache.delete(f'activity:{day}:{user_id}')
+            except Exception as e:
+                logger.warning(f"⚠️ تعذر إلغاء حجز نشاط المستخدم {user_id}: {str(e)}")
+
+    def _claim_prune(self, day):
+        """التنظيف مرة واحدة يومياً لكل العمليات والعقد
+
+        الذاكرة المشتركة تصفي عمليات الجهاز الواحد، ومعاملة RTDB تختار مالكاً واحداً
+        (تكفي وحدها إذا لم تكن هناك ذاكرة مشتركة).
+        """
+        if self.cache:
+            try:
+                if not self.cache.compare_and_set(f'activity_prune:{day}', None, 1, 86400):
+                    return False
+            except Exception as e:
+                logger.warning(f"⚠️ تعذر حجز تنظيف النشاط محلياً: {str(e)}")
+
+        token = f'{socket.gethostname()}:{os.getpid()}'
+        try:
+            owner = self.firebase.ref.child('activity_prune').child(day).transaction(
+                lambda current: current or token
+            )
+        except Exception as e:
+            logger.warning(f"⚠️ تعذر حجز تنظيف النشاط: {str(e)}")
+            return False
+        return owner == token
+
+    def _prune_once(self, day):
+        if self._claim_prune(day):
+            self.prune()
+
+    def record(self, user_id):
+        """تسجيل نشاط المستخدم مرة واحدة يومياً"""
+        if not user_id:
+            return
+
+        day = self.day_key()
+        first, rolled_over = self._first_today(user_id, day)
+        if rolled_over:
+            # الحجز والتنظيف في الخلفية: لا يتحملهما التحديث الذي عبر منتصف الليل
+            submit(self._prune_once, day)
+        if not first:
+            return
+
+        try:
+            # ضمن كتابة التحديث الواحدة، لكنها لا تُلغى بخطأ معالج لاحق (حجز اليوم باقٍ)؛
+            # وإذا لم تُنفذ الوحدة يُلغى الحجز ليُسجل النشاط مع التحديث التالي
+            self.firebase.write(
+                {f'activity/{day}/{user_id}': True},
+                durable=True,
+                on_failure=lambda: self._release(user_id, day)
+            )
+            metrics.incr('activity.recorded')
+        except Exception as e:
+            logger.error(f"❌ فشل تسجيل نشاط المستخدم {user_id}: {str(e)}")
+            self._release(user_id, day)
+
+    def record_signup(self, user_id):
+        """تسجيل المستخدم الجديد في مجموعة يوم انضمامه"""
+        try:
+            self.firebase.write({f'signups/{self.day_key()}/{user_id}': True})
+        except Exception as e:
+            logger.error(f"❌ فشل تسجيل انضمام المستخدم {user_id}: {str(e)}")
+
+    def _users_on(self, node, day):
+        """قراءة سطحية لمعرفات مستخدمي يوم واحد"""
+        try:
+            users = self.firebase.ref.child(node).child(self.day_key(day)).get(shallow=True) or {}
+            return set(users.keys())
+        except Exception as e:
+            logger.error(f"❌ فشل قراءة {node} ليوم {self.day_key(day)}: {str(e)}")
+            return set()
+
+    def active_users(self, days=1, end=None):
+        """المستخدمون النشطون خلال آخر N يوم (حتى end)"""
+        end = end or datetime.now(timezone.utc).date()
+        active = set()
+        for offset in range(days):
+            active |= self._users_on('activity', end - timedelta(days=offset))
+        return active
+
+    def daily_active(self):
+        return len(self.active_users(1))
+
+    def weekly_active(self):
+        return len(self.active_users(7))
+
+    def monthly_active(self):
+        return len(self.active_users(30))
+
+    def retention(self, cohort_day, days=7):
+        """نسبة من انضموا في cohort_day وعادوا في كل يوم من الأيام التالية"""
+        cohort = self._users_on('signups', cohort_day)
+        if not cohort:
+            return []
+
+        today = datetime.now(timezone.utc).date()
+        curve = []
+        for offset in range(1, days + 1):
+            day = cohort_day + timedelta(days=offset)
+            if day > today:
+                break
+            returned = cohort & self._users_on('activity', day)
+            curve.append(len(returned) / len(cohort))
+        return curve
+
+    def prune(self, retention_days=None):
+        """حذف عُقد الأيام الأقدم من مدة الاحتفاظ"""
+        retention_days = retention_days or self.RETENTION_DAYS
+        cutoff = self.day_key(datetime.now(timezone.utc).date() - timedelta(days=retention_days))
+
+        try:
+            updates = {}
+            for node in ('activity', 'signups', 'activity_prune'):
+                days = self.firebase.ref.child(node).get(shallow=True) or {}
+                updates.update({f'{node}/{day}': None for day in days if day < cutoff})
+            if updates:
+                self.firebase.ref.update(updates)
+                logger.info(f"🧹 تم حذف {len(updates)} عقدة نشاط قديمة (قبل {cutoff})")
+            return len(updates)
+        except Exception as e:
+            logger.error(f"❌ فشل حذف عُقد النشاط القديمة: {str(e)}", exc_info=True)
+            return 0
@@ -1,16 +1,28 @@
 import os
+import re
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
 from firebase_admin import db
 from datetime import datetime
+from config import get_env
+import deadline
 
 logger = logging.getLogger(__name__)
 
 class AdminPanel:
-    def __init__(self, firebase, premium_manager):
+    def __init__(self, firebase, premium_manager, sender, activity=None):
         self.firebase = firebase
         self.premium = premium_manager
+        self.sender = sender
+        self.activity = activity
         self.ADMIN_IDS = self._load_admin_ids()
+        self.BULK_MAX_IDS = get_env('BULK_PREMIUM_MAX_IDS', 5000, int)
+        self.BULK_MAX_FILE_SIZE = get_env('BULK_PREMIUM_MAX_FILE_SIZE', 1024 * 1024, int)
+        # العملية الجماعية تتجاوز ميزانية التحديث العادية
+        self.BULK_BUDGET = get_env('BULK_PREMIUM_BUDGET_SECONDS', 120.0, float)
+        # خيط واحد: العمليات الجماعية تُنفذ بالتتابع خارج خيط التحديث
+        self._bulk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='bulk')
         self._validate_admins()
         logger.info(f"✅ تم تهيئة لوحة المشرفين | عدد المشرفين: {len(self.ADMIN_IDS)}")
 
@@ -39,6 +51,10 @@ class AdminPanel:
         buttons = [
             [InlineKeyboardButton("📊 الإحصائيات", callback_data="admin_stats")],
             [InlineKeyboardButton("👑 تفعيل اشتراك", callback_data="admin_activate")],
+            [
+                InlineKeyboardButton("👥 تفعيل جماعي", callback_data="admin_bulk_activate"),
+                InlineKeyboardButton("🚫 إلغاء جماعي", callback_data="admin_bulk_deactivate")
+            ],
             [InlineKeyboardButton("📢 إشعار عام", callback_data="admin_broadcast")],
             [InlineKeyboardButton("🔍 تفاصيل مستخدم", callback_data="admin_user_info")],
             [InlineKeyboardButton("🚪 إغلاق اللوحة", callback_data="admin_close")]
@@ -48,23 +64,46 @@ class AdminPanel:
     def get_stats(self):
         """جلب إحصائيات البوت"""
         try:
-            users = self.firebase.ref.child('users').get() or {}
-            stats = {
-                'total_users': len(users),
-                'premium_users': sum(1 for u in users.values() if isinstance(u, dict) and u.get('premium', {}).get('is_premium')),
-                'active_today': sum(1 for u in users.values() if self._is_active_today(u)),
-                'total_requests': sum(u.get('usage', {}).get('total_chars', 0) for u in users.values() if isinstance(u, dict))
-            }
+            counters = self.firebase.ref.child('stats').get() or {}
+            users = None
+            if all(counters.get(name) is not None for name in self.firebase.STATS_FIELDS):
+                stats = {
+                    'total_users': counters['users'],
+                    'premium_users': counters['premium_users'],
+                    'total_requests': counters['total_chars']
+                }
+            else:
+                # العدادات لم تُهيأ بعد (manage.py recount-premium): قراءة كل المستخدمين
+                logger.warning("⚠️ عدادات stats/ غير مكتملة، جاري قراءة كل المستخدمين")
+                users = self.firebase.ref.child('users').get() or {}
+                stats = {
+                    'total_users': len(users),
+                    'premium_users': sum(1 for u in users.values() if isinstance(u, dict) and u.get('premium', {}).get('is_premium')),
+                    'total_requests': sum(u.get('usage', {}).get('total_chars', 0) for u in users.values() if isinstance(u, dict))
+                }
+
+            # النشاط من عُقد الأيام بدلاً من فحص last_used لكل مستخدم
+            if self.activity:
+                stats['active_today'] = self.activity.daily_active()
+                stats['active_week'] = self.activity.weekly_active()
+                stats['active_month'] = self.activity.monthly_active()
+            else:
+                if users is None:
+                    users = self.firebase.ref.child('users').get() or {}
+                stats['active_today'] = sum(1 for u in users.values() if isinstance(u, dict) and self._is_active_today(u))
+                stats['active_week'] = stats['active_month'] = 0
             return stats
         except Exception as e:
             logger.error(f"❌ فشل جلب الإحصائيات: {str(e)}", exc_info=True)
-            return {'total_users': 0, 'premium_users': 0, 'active_today': 0, 'total_requests': 0}
+            return {'total_users': 0, 'premium_users': 0, 'active_today': 0, 'active_week': 0,
+                    'active_month': 0, 'total_requests': 0}
 
     def _is_active_today(self, user_data):
         """التحقق من النشاط اليومي"""
         last_used = user_data.get('last_used')
         if isinstance(last_used, dict):
-            return True
+            # قيمة {'.sv': 'timestamp'} لم تُحل بعد ولا تدل على نشاط
+            return False
         try:
             return (datetime.now() - datetime.fromtimestamp(last_used)).total_seconds() < 86400
         except:
@@ -73,18 +112,20 @@ class AdminPanel:
     def handle_admin_actions(self, update, context):
         """معالجة إجراءات المشرف"""
         query = update.callback_query
-        query.answer()
+        # الإجابة على الزر تتم في handle_callback_query
         
         if not self.is_admin(query.from_user.id):
-            query.edit_message_text("⛔ ليس لديك صلاحية الوصول إلى هذه اللوحة", parse_mode=ParseMode.HTML)
+            self.sender.edit_message_text(query, "⛔ ليس لديك صلاحية الوصول إلى هذه اللوحة", parse_mode=ParseMode.HTML)
             return
             
-        action = query.data.split('_')[1]
+        action = query.data.split('_', 1)[1]
         try:
             if action == "stats":
                 self._show_stats(query, context)
             elif action == "activate":
                 self._start_activation(query, context)
+            elif action in ("bulk_activate", "bulk_deactivate"):
+                self._start_bulk(query, context, action)
             elif action == "broadcast":
                 self._start_broadcast(query, context)
             elif action == "user_info":
@@ -95,7 +136,7 @@ class AdminPanel:
                 self._cancel_action(query, context)
         except Exception as e:
             logger.error(f"فشل معالجة إجراء المشرف: {str(e)}", exc_info=True)
-            query.edit_message_text("❌ حدث خطأ أثناء معالجة طلبك", parse_mode=ParseMode.HTML)
+            self.sender.edit_message_text(query, "❌ حدث خطأ أثناء معالجة طلبك", parse_mode=ParseMode.HTML)
 
     def _show_stats(self, query, context):
         """عرض الإحصائيات"""
@@ -105,10 +146,13 @@ class AdminPanel:
             f"• 👥 <code>المستخدمون: {stats['total_users']}</code>\n"
             f"• 💎 <code>المميزون: {stats['premium_users']}</code>\n"
             f"• 🔄 <code>النشطون اليوم: {stats['active_today']}</code>\n"
+            f"• 📅 <code>النشطون أسبوعياً: {stats['active_week']}</code>\n"
+            f"• 🗓 <code>النشطون شهرياً: {stats['active_month']}</code>\n"
             f"• 📨 <code>إجمالي الأحرف: {stats['total_requests']:,}</code>"
         )
-        query.edit_message_text(
-            text=message,
+        self.sender.edit_message_text(
+            query,
+            message,
             parse_mode=ParseMode.HTML,
             reply_markup=self.get_admin_dashboard()
         )
@@ -116,8 +160,22 @@ class AdminPanel:
     def _start_activation(self, query, context):
         """بدء تفعيل اشتراك"""
         context.user_data['admin_action'] = 'activate'
-        query.edit_message_text(
-            "✍️ أرسل <b>معرف المستخدم</b> لتفعيل الاشتراك:",
+        self.sender.edit_message_text(
+            query,
+            "✍️ أرسل <b>معرف المستخدم</b> أو <b>@اسم_المستخدم</b> لتفعيل الاشتراك:",
+            parse_mode=ParseMode.HTML,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« إلغاء", callback_data="admin_cancel")]])
+        )
+
+    def _start_bulk(self, query, context, action):
+        """بدء تفعيل أو إلغاء جماعي"""
+        context.user_data['admin_action'] = action
+        verb = "تفعيل" if action == 'bulk_activate' else "إلغاء"
+        self.sender.edit_message_text(
+            query,
+            f"📋 أرسل <b>معرفات المستخدمين</b> لـ{verb} الاشتراك:\n\n"
+            "• مفصولة بمسافات أو فواصل أو أسطر\n"
+            f"• أو ملف نصي/CSV (حتى {self.BULK_MAX_IDS:,} معرف)",
             parse_mode=ParseMode.HTML,
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« إلغاء", callback_data="admin_cancel")]])
         )
@@ -125,7 +183,8 @@ class AdminPanel:
     def _start_broadcast(self, query, context):
         """بدء بث إشعار"""
         context.user_data['admin_action'] = 'broadcast'
-        query.edit_message_text(
+        self.sender.edit_message_text(
+            query,
             "📩 أرسل الرسالة التي تريد بثها <b>لجميع المستخدمين</b>:\n\n"
             "⚠️ يمكنك استخدام تنسيق HTML:\n"
             "<code>&lt;b&gt;عريض&lt;/b&gt; &lt;i&gt;مائل&lt;/i&gt; &lt;a href='example.com'&gt;رابط&lt;/a&gt;</code>",
@@ -133,16 +192,166 @@ class AdminPanel:
             reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« إلغاء", callback_data="admin_cancel")]])
         )
 
+    def _start_user_info(self, query, context):
+        """بدء عرض معلومات مستخدم"""
+        context.user_data['admin_action'] = 'user_info'
+        self.sender.edit_message_text(
+            query,
+            "🔍 أرسل <b>معرف المستخدم</b> أو <b>@اسم_المستخدم</b>:",
+            parse_mode=ParseMode.HTML,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("« إلغاء", callback_data="admin_cancel")]])
+        )
+
+    def _cancel_action(self, query, context):
+        """إلغاء الإجراء الحالي والعودة للوحة"""
+        context.user_data.pop('admin_action', None)
+        self.sender.edit_message_text(
+            query,
+            "👨‍💻 لوحة تحكم المشرفين",
+            parse_mode=ParseMode.HTML,
+            reply_markup=self.get_admin_dashboard()
+        )
+
+    def handle_admin_message(self, update, context):
+        """معالجة رد المشرف على الإجراء المنتظر"""
+        action = context.user_data.pop('admin_action', None)
+        text = (update.message.text or '').strip()
+
+        if action == 'broadcast':
+            self._process_broadcast(update, text)
+        elif action == 'user_info':
+            self._process_user_info(update, text)
+        elif action == 'activate':
+            self._process_activation(update, text)
+        elif action in ('bulk_activate', 'bulk_deactivate'):
+            self._process_bulk(update, text, activate=action == 'bulk_activate')
+
+    def handle_admin_document(self, update, context):
+        """ملف معرفات مرفوع لعملية جماعية منتظرة"""
+        action = context.user_data.get('admin_action')
+        if action not in ('bulk_activate', 'bulk_deactivate'):
+            return
+        document = update.message.document
+        if document.file_size and document.file_size > self.BULK_MAX_FILE_SIZE:
+            self.sender.reply_text(update.message, "⚠️ الملف أكبر من الحد المسموح", parse_mode=ParseMode.HTML)
+            return
+
+        context.user_data.pop('admin_action', None)
+        try:
+            tg_file = context.bot.get_file(document.file_id, timeout=deadline.timeout(None, 'telegram'))
+            text = bytes(tg_file.download_as_bytearray()).decode('utf-8-sig', errors='replace')
+        except Exception as e:
+            logger.error(f"فشل تنزيل ملف المعرفات: {str(e)}", exc_info=True)
+            self.sender.reply_text(update.message, "❌ تعذر قراءة الملف", parse_mode=ParseMode.HTML)
+            return
+        self._process_bulk(update, text, activate=action == 'bulk_activate')
+
+    @staticmethod
+    def _parse_user_ids(text):
+        """استخراج معرفات فريدة بترتيبها مع الرموز غير الصالحة"""
+        user_ids = []
+        invalid = []
+        seen = set()
+        for token in re.split(r'[\s,;]+', text):
+            token = token.strip().strip('"\'')
+            if not token:
+                continue
+            if not token.isdigit():
+                invalid.append(token)
+                continue
+            user_id = int(token)
+            if user_id not in seen:
+                seen.add(user_id)
+                user_ids.append(user_id)
+        return user_ids, invalid
+
+    def _process_bulk(self, update, text, activate):
+        """بدء العملية الجماعية في الخلفية؛ رسالة التقدم تُعدل بالتقرير عند انتهائها"""
+        user_ids, invalid = self._parse_user_ids(text)
+        if not user_ids:
+            self.sender.reply_text(update.message, "⚠️ لم يتم العثور على أي معرف صالح", parse_mode=ParseMode.HTML)
+            return
+        if len(user_ids) > self.BULK_MAX_IDS:
+            self.sender.reply_text(
+                update.message,
+                f"⚠️ عدد المعرفات ({len(user_ids):,}) يتجاوز الحد ({self.BULK_MAX_IDS:,})",
+                parse_mode=ParseMode.HTML
+            )
+            return
+
+        verb = "تفعيل" if activate else "إلغاء"
+        progress_msg = self.sender.reply_text(
+            update.message,
+            f"⏳ جاري {verb} الاشتراك لـ {len(user_ids):,} مستخدم...",
+            parse_mode=ParseMode.HTML
+        )
+        # لا تحجز خيط التحديث (ولا ميزانيته) طوال العملية
+        self._bulk_executor.submit(
+            self._run_bulk, progress_msg, user_ids, invalid, activate, update.effective_user.id
+        )
+
+    def _run_bulk(self, progress_msg, user_ids, invalid, activate, admin_id):
+        """تنفيذ العملية الجماعية بميزانيتها الخاصة وتعديل رسالة التقدم بالتقرير"""
+        verb = "تفعيل" if activate else "إلغاء"
+        try:
+            with deadline.budget(self.BULK_BUDGET):
+                report = self.premium.bulk_set_premium(user_ids, activate, admin_id=admin_id)
+        except Exception as e:
+            logger.error(f"فشل العملية الجماعية: {str(e)}", exc_info=True)
+            self.sender.edit_text(progress_msg, "❌ حدث خطأ أثناء العملية الجماعية", parse_mode=ParseMode.HTML)
+            return
+
+        lines = [
+            f"<b>📊 نتيجة {verb} الاشتراك الجماعي</b>\n",
+            f"• 📨 المعرفات: <code>{len(user_ids):,}</code>",
+            f"• ✅ تغيرت حالتهم: <code>{len(report['changed']):,}</code>"
+        ]
+        if activate:
+            lines.append(f"• 🔄 مميزون تم تجديدهم: <code>{len(report['renewed']):,}</code>")
+        else:
+            lines.append(f"• ⏭ ليسوا مميزين: <code>{len(report['skipped']):,}</code>")
+        lines.append(f"• ❓ غير موجودين: <code>{len(report['missing']):,}</code>")
+        if report['failed']:
+            lines.append(f"• ❌ فشلت كتابتهم: <code>{len(report['failed']):,}</code>")
+        if invalid:
+            lines.append(f"• ⚠️ قيم غير صالحة: <code>{len(invalid):,}</code>")
+        for title, values in (("غير موجودين", report['missing']), ("فشلت كتابتهم", report['failed']), ("قيم غير صالحة", invalid)):
+            if values:
+                sample = ', '.join(str(value) for value in values[:10])
+                more = f" (+{len(values) - 10})" if len(values) > 10 else ""
+                lines.append(f"\n<b>{title}:</b> <code>{sample}</code>{more}")
+        self.sender.edit_text(progress_msg, '\n'.join(lines), parse_mode=ParseMode.HTML)
+
+    def _resolve_user_id(self, user_ref):
+        """تحويل معرف رقمي أو @username إلى معرف مستخدم"""
+        user_ref = user_ref.strip()
+        if user_ref.isdigit():
+            return int(user_ref)
+        return self.firebase.get_user_id_by_username(user_ref)
+
+    def _process_activation(self, update, user_ref):
+        """تفعيل الاشتراك لمستخدم محدد"""
+        user_id = self._resolve_user_id(user_ref)
+        if not user_id:
+            self.sender.reply_text(update.message, "⚠️ لم يتم العثور على المستخدم", parse_mode=ParseMode.HTML)
+            return
+
+        if self.premium.activate_premium(user_id, admin_id=update.effective_user.id):
+            self.sender.reply_text(update.message, f"✅ تم تفعيل الاشتراك للمستخدم <code>{user_id}</code>", parse_mode=ParseMode.HTML)
+        else:
+            self.sender.reply_text(update.message, "❌ فشل في تفعيل الاشتراك", parse_mode=ParseMode.HTML)
+
     def _process_broadcast(self, update, message):
         """معالجة البث العام"""
         try:
             users = self.firebase.ref.child('users').get() or {}
             if not users:
-                update.message.reply_text("⚠️ لا يوجد مستخدمون لإرسال الإشعار", parse_mode=ParseMode.HTML)
+                self.sender.reply_text(update.message, "⚠️ لا يوجد مستخدمون لإرسال الإشعار", parse_mode=ParseMode.HTML)
                 return
 
             total = len(users)
-            progress_msg = update.message.reply_text(
+            progress_msg = self.sender.reply_text(
+                update.message,
                 f"جاري إرسال الإشعار لـ {total} مستخدم...\n\n"
                 f"✅ تم إرسالها لـ 0 مستخدم\n"
                 f"❌ فشل إرسالها لـ 0 مستخدم",
@@ -157,9 +366,10 @@ class AdminPanel:
                         failed_users.append(str(uid))
                         continue
                         
-                    update.message.bot.send_message(
-                        chat_id=uid,
-                        text=message,
+                    self.sender.send_message(
+                        update.message.bot,
+                        uid,
+                        message,
                         parse_mode=ParseMode.HTML,
                         disable_web_page_preview=True
                     )
@@ -169,7 +379,8 @@ class AdminPanel:
                     logger.warning(f"فشل إرسال الإشعار لـ {uid}: {str(e)}")
 
                 if i % 10 == 0 or i == total:
-                    progress_msg.edit_text(
+                    self.sender.edit_text(
+                        progress_msg,
                         f"جاري إرسال الإشعار لـ {total} مستخدم...\n\n"
                         f"✅ تم إرسالها لـ {success} مستخدم\n"
                         f"❌ فشل إرسالها لـ {len(failed_users)} مستخدم\n"
@@ -183,16 +394,22 @@ class AdminPanel:
                 f"• ❌ فشل الإرسال: <code>{len(failed_users)}</code>\n"
                 f"• 📨 إجمالي المستهدفين: <code>{total}</code>"
             )
-            update.message.reply_text(result_msg, parse_mode=ParseMode.HTML)
+            self.sender.reply_text(update.message, result_msg, parse_mode=ParseMode.HTML)
             
         except Exception as e:
             logger.error(f"فشل كامل في عملية البث: {str(e)}", exc_info=True)
-            update.message.reply_text("❌ حدث خطأ جسيم أثناء عملية البث", parse_mode=ParseMode.HTML)
+            self.sender.reply_text(update.message, "❌ حدث خطأ جسيم أثناء عملية البث", parse_mode=ParseMode.HTML)
 
-    def _process_user_info(self, update, user_id_str):
-        """عرض معلومات المستخدم"""
+    def _process_user_info(self, update, user_ref):
+        """عرض معلومات المستخدم (بالمعرف أو @username)"""
         try:
-            user_id = int(user_id_str)
+            if not re.fullmatch(r'@?\w{3,32}', user_ref.strip()):
+                raise ValueError(user_ref)
+
+            user_id = self._resolve_user_id(user_ref)
+            if not user_id:
+                self.sender.reply_text(update.message, f"⚠️ لا يوجد مستخدم بالاسم <code>{user_ref}</code>", parse_mode=ParseMode.HTML)
+                return
             user_data = self.firebase.get_user_data(user_id) or {}
             
             msg = (
@@ -206,10 +423,10 @@ class AdminPanel:
                 f"• 🕒 آخر نشاط: <code>{self._format_last_active(user_data)}</code>\n"
                 f"• 📅 تاريخ التسجيل: <code>{self._format_join_date(user_data)}</code>"
             )
-            update.message.reply_text(msg, parse_mode=ParseMode.HTML)
+            self.sender.reply_text(update.message, msg, parse_mode=ParseMode.HTML)
             
         except ValueError:
-            update.message.reply_text("⚠️ يجب إدخال <b>معرف مستخدم</b> صحيح (أرقام فقط)", parse_mode=ParseMode.HTML)
+            self.sender.reply_text(update.message, "⚠️ يجب إدخال <b>معرف مستخدم</b> صحيح (أرقام) أو <b>@اسم_المستخدم</b>", parse_mode=ParseMode.HTML)
 
     def _format_last_active(self, user_data):
         """تنسيق تاريخ آخر نشاط"""
@@ -0,0 +1,51 @@
+import logging
+from config import get_env
+
+logger = logging.getLogger(__name__)
+
+# الصيغ التي يرسلها Speechify ويقبلها send_voice في تيليجرام.
+# concatenable: يمكن دمج مقاطع الجمل في ملف واحد، فتعمل ذاكرة المقاطع لكل جملة.
+# OGG/Opus (الافتراضية) لا تُدمج، فتُخزن النصوص كاملة وتفيد فقط عند تكرار النص نفسه؛
+# لتفعيل التخزين لكل جملة اختر mp3 في TTS_FORMAT_FREE / TTS_FORMAT_PREMIUM.
+OUTPUT_FORMATS = {
+    'ogg': {
+        'accept': 'audio/ogg',
+        'suffix': '.ogg',
+        'concatenable': False
+    },
+    'mp3': {
+        'accept': 'audio/mpeg',
+        'suffix': '.mp3',
+        'concatenable': True
+    }
+}
+
+
+class OutputFormatPolicy:
+    """اختيار صيغة الصوت الناتج حسب خطة المستخدم"""
+
+    def __init__(self):
+        self.FREE_FORMAT = self._load_format('TTS_FORMAT_FREE', 'ogg')
+        self.PREMIUM_FORMAT = self._load_format('TTS_FORMAT_PREMIUM', 'ogg')
+        logger.info(f"🎧 صيغة الصوت | مجاني: {self.FREE_FORMAT} | مميز: {self.PREMIUM_FORMAT}")
+        whole_text = [name for name in {self.FREE_FORMAT, self.PREMIUM_FORMAT}
+                      if not OUTPUT_FORMATS[name]['concatenable']]
+        if whole_text:
+            logger.info(
+                f"ℹ️ ذاكرة مقاطع الصوت تعمل بالنص الكامل (لا لكل جملة) للصيغ: {', '.join(sorted(whole_text))}"
+            )
+
+    def _load_format(self, var_name, default):
+        value = get_env(var_name, default).lower()
+        if value not in OUTPUT_FORMATS:
+            logger.warning(f"⚠️ صيغة غير مدعومة لـ {var_name}: {value}, استخدام {default}")
+            return default
+        return value
+
+    def format_for(self, is_premium):
+        """اسم الصيغة المناسبة للخطة"""
+        return self.PREMIUM_FORMAT if is_premium else self.FREE_FORMAT
+
+    @staticmethod
+    def spec(audio_format):
+        return OUTPUT_FORMATS[audio_format]
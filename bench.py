@@ -0,0 +1,453 @@
+"""قياسات أداء محلية
+
+الاستخدام:
+    python bench.py cache [--ops N] [--workers N] [--keys N]
+    python bench.py tts-formats --voice-id ID [--text ...] [--runs N] [--chat-id ID]
+    python bench.py logging [--updates N] [--error-every N]
+    python bench.py replay TRACE [TRACE ...] [--speed N|max] [--concurrency N] [--stub-latency-ms N]
+    python bench.py fastpath [--traces TRACE ...] [--updates N]
+"""
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+
+
+def _report(title, rows):
+    print(f"\n== {title} ==")
+    width = max(len(name) for name, _ in rows)
+    for name, value in rows:
+        print(f"  {name.ljust(width)}  {value}")
+
+
+# --- الذاكرة المشتركة ---
+def _cache_worker(args):
+    kind, path, lookups, keys, seed = args
+    rng = random.Random(seed)
+    if kind == 'shared':
+        from shared_cache import SharedCache
+        cache = SharedCache(path=path, max_entries=keys * 2, default_ttl=300)
+        get, put = cache.get, cache.set
+    else:
+        local = {}
+        get, put = local.get, local.__setitem__
+
+    hits = 0
+    for _ in range(lookups):
+        key = f'user:{rng.randrange(keys)}'
+        if get(key) is not None:
+            hits += 1
+        else:
+            put(key, {'usage': {'total_chars': 0}})
+    return hits
+
+
+def bench_cache(args):
+    """مقارنة SharedCache مع قاموس داخل كل عملية"""
+    from shared_cache import SharedCache
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench_cache.sqlite3')
+    cache = SharedCache(path=path, max_entries=args.keys * 2, default_ttl=300)
+    local = {}
+    value = {'usage': {'total_chars': 120, 'voice_cloned': True}, 'premium': {'is_premium': False}}
+
+    rows = []
+    for name, put, get in (
+        ('dict', local.__setitem__, local.get),
+        ('shared', cache.set, cache.get),
+    ):
+        start = time.perf_counter()
+        for i in range(args.ops):
+            put(f'user:{i % args.keys}', value)
+        write = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for i in range(args.ops):
+            get(f'user:{i % args.keys}')
+        read = time.perf_counter() - start
+        rows.append((f'{name} set', f'{args.ops / write:,.0f} ops/s ({write / args.ops * 1e6:.1f} µs/op)'))
+        rows.append((f'{name} get', f'{args.ops / read:,.0f} ops/s ({read / args.ops * 1e6:.1f} µs/op)'))
+    _report('زمن العمليات (عملية واحدة)', rows)
+
+    cache.clear()
+    lookups = args.ops // args.workers
+    rows = []
+    with multiprocessing.Pool(args.workers) as pool:
+        for kind in ('dict', 'shared'):
+            jobs = [(kind, path, lookups, args.keys, seed) for seed in range(args.workers)]
+            hits = sum(pool.map(_cache_worker, jobs))
+            rows.append((kind, f'{hits / (lookups * args.workers):.1%} hit ratio'))
+    _report(f'نسبة الإصابة عبر {args.workers} عمليات', rows)
+
+
+# --- صيغ الصوت ---
+def _upload_voice(token, chat_id, data, suffix):
+    """رفع الصوت إلى تيليجرام وإرجاع مدة الرفع"""
+    import requests
+    start = time.perf_counter()
+    response = requests.post(
+        f'https://api.telegram.org/bot{token}/sendVoice',
+        data={'chat_id': chat_id},
+        files={'voice': (f'bench{suffix}', data)},
+        timeout=60
+    )
+    response.raise_for_status()
+    return time.perf_counter() - start
+
+
+def bench_tts_formats(args):
+    """مقارنة الحجم وزمن أول بايت والزمن الكلي لكل صيغة صوت"""
+    import requests
+    from audio_formats import OUTPUT_FORMATS
+
+    api_key = os.getenv('SPEECHIFY_API_KEY')
+    if not api_key:
+        sys.exit('SPEECHIFY_API_KEY مطلوب')
+    token = os.getenv('TELEGRAM_BOT_TOKEN') if args.chat_id else None
+
+    session = requests.Session()
+    rows = []
+    for name, spec in OUTPUT_FORMATS.items():
+        sizes, first_bytes, totals, uploads = [], [], [], []
+        for _ in range(args.runs):
+            start = time.perf_counter()
+            response = session.post(
+                'https://api.sws.speechify.com/v1/audio/stream',
+                headers={
+                    'Authorization': f'Bearer {api_key}',
+                    'Content-Type': 'application/json',
+                    'Accept': spec['accept']
+                },
+                json={'input': args.text, 'voice_id': args.voice_id,
+                      'output_format': name, 'model': 'simba-multilingual'},
+                stream=True,
+                timeout=60
+            )
+            response.raise_for_status()
+            data = bytearray()
+            for chunk in response.iter_content(chunk_size=4096):
+                if chunk and not data:
+                    first_bytes.append(time.perf_counter() - start)
+                data.extend(chunk)
+            totals.append(time.perf_counter() - start)
+            sizes.append(len(data))
+            if token:
+                uploads.append(_upload_voice(token, args.chat_id, bytes(data), spec['suffix']))
+
+        row = (f'{sum(sizes) / len(sizes) / 1024:,.1f} KiB | '
+               f'أول بايت {sum(first_bytes) / len(first_bytes) * 1000:,.0f} ms | '
+               f'كامل {sum(totals) / len(totals) * 1000:,.0f} ms')
+        if uploads:
+            row += (f' | رفع {sum(uploads) / len(uploads) * 1000:,.0f} ms'
+                    f' | من الطرف للطرف {(sum(totals) + sum(uploads)) / len(totals) * 1000:,.0f} ms')
+        rows.append((name, row))
+    _report(f'صيغ الصوت ({len(args.text)} حرف، {args.runs} تكرار)', rows)
+
+
+# --- التسجيل ---
+def _simulate_updates(updates, error_every):
+    """نمط السجلات لتحديث نصي: حفظ واستخدام وصوت في firebase وسطر في main"""
+    import logging
+    firebase_log = logging.getLogger('firebase')
+    sampled_log = logging.getLogger('firebase.sampled')
+    main_log = logging.getLogger('main')
+    start = time.perf_counter()
+    for i in range(updates):
+        user_id = 100000 + i % 500
+        sampled_log.info(f"✅ تم حفظ بيانات المستخدم {user_id} بنجاح", extra={'user_id': user_id})
+        sampled_log.info(f"✅ تم تحديث استخدام الأحرف للمستخدم {user_id}: +42",
+                         extra={'user_id': user_id, 'chars': 42})
+        main_log.info(f"🎙️ تحويل نص للمستخدم {user_id}")
+        if error_every and i % error_every == 0:
+            try:
+                raise ConnectionError('upstream unavailable')
+            except ConnectionError as e:
+                firebase_log.error(f"❌ فشل جلب بيانات المستخدم {user_id}: {str(e)}", exc_info=True)
+    return time.perf_counter() - start
+
+
+def bench_logging(args):
+    """كلفة التسجيل على خيط الطلب: معالج متزامن مقابل الطابور مع العينات"""
+    import logging
+    import log_setup
+
+    path = os.path.join(tempfile.mkdtemp(), 'bench.log')
+    root = logging.getLogger()
+    rows = []
+
+    handler = logging.FileHandler(path)
+    handler.setFormatter(logging.Formatter(log_setup.DEFAULT_FORMAT))
+    root.handlers[:] = [handler]
+    root.setLevel(logging.INFO)
+    elapsed = _simulate_updates(args.updates, args.error_every)
+    handler.close()
+    rows.append(('sync', f'{elapsed / args.updates * 1e6:,.1f} µs/تحديث'))
+
+    from metrics import metrics
+    log_setup.setup_logging(logging.INFO, handler=logging.FileHandler(path))
+    elapsed = _simulate_updates(args.updates, args.error_every)
+    start = time.perf_counter()
+    log_setup.shutdown_logging()
+    drain = time.perf_counter() - start
+    rows.append(('queue', f'{elapsed / args.updates * 1e6:,.1f} µs/تحديث (تفريغ الطابور {drain * 1000:,.0f} ms)'))
+    rows.append(('  مستبعدة بالعينات', f"{metrics.counter('logging.sampled_out'):,}"))
+    rows.append(('  أخطاء مكتومة', f"{metrics.counter('logging.errors_suppressed'):,}"))
+    rows.append(('  مفقودة (طابور ممتلئ)', f"{metrics.counter('logging.dropped'):,}"))
+    root.handlers[:] = []
+
+    _report(f'كلفة التسجيل ({args.updates} تحديث، خطأ كل {args.error_every})', rows)
+
+
+# --- إعادة تشغيل حركة مسجلة ---
+def _replay_one(client, path, update):
+    start = time.perf_counter()
+    response = client.post(path, json=update)
+    return time.perf_counter() - start, response.status_code
+
+
+def bench_replay(args):
+    """إعادة تشغيل تسجيل TRACE_RECORD_PATH على create_app() مع خوادم بديلة"""
+    from concurrent.futures import ThreadPoolExecutor
+    from upstream_stub import start_stub_server
+    from traffic_trace import read_traces, update_kind
+
+    if not os.getenv('FIREBASE_DATABASE_EMULATOR_HOST') and not args.live_firebase:
+        sys.exit('FIREBASE_DATABASE_EMULATOR_HOST مطلوب (أو --live-firebase للكتابة في القاعدة الفعلية)')
+
+    _, stub_url = start_stub_server(latency=args.stub_latency_ms / 1000)
+    os.environ['TELEGRAM_API_URL'] = stub_url
+    os.environ['SPEECHIFY_API_URL'] = stub_url
+    os.environ.setdefault('TELEGRAM_BOT_TOKEN', '123456:replay')
+    os.environ.setdefault('SPEECHIFY_API_KEY', 'replay')
+    os.environ.setdefault('WEBHOOK_URL', 'http://127.0.0.1')
+    os.environ['HTTP_PREWARM'] = 'false'
+    os.environ.pop('TRACE_RECORD_PATH', None)
+    os.environ['SHARED_CACHE_PATH'] = os.path.join(tempfile.mkdtemp(), 'replay_cache.sqlite3')
+
+    records = read_traces(args.traces)
+    if not records:
+        sys.exit('التسجيل فارغ')
+
+    import main as bot_main
+    from metrics import Metrics
+    app = bot_main.create_app()
+    path = f"/{os.environ['TELEGRAM_BOT_TOKEN']}"
+    speed = None if args.speed == 'max' else float(args.speed)
+
+    # معرفات جديدة حتى لا يتجاهل مانع التكرار تحديثات تشغيل سابق
+    base_id = int(time.time()) * 1000
+    results = Metrics()
+    t0 = records[0]['t']
+    start = time.perf_counter()
+
+    def run(record, kind):
+        latency, status = _replay_one(app.test_client(), path, record['update'])
+        results.observe(kind, latency)
+        results.observe('all', latency)
+        results.incr(f'status.{status}')
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        for i, record in enumerate(records):
+            if speed:
+                due = (record['t'] - t0) / speed
+                delay = due - (time.perf_counter() - start)
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    results.observe('schedule_lag', -delay)
+            record['update']['update_id'] = base_id + i
+            pool.submit(run, record, update_kind(record['update']))
+    elapsed = time.perf_counter() - start
+
+    snapshot = results.snapshot()
+    rows = []
+    for kind, timing in sorted(snapshot['timings'].items(), key=lambda item: item[0] != 'all'):
+        if kind == 'schedule_lag':
+            continue
+        rows.append((kind, f"{timing['count']:>6} | p50 {timing['p50'] * 1000:,.0f} ms | "
+                           f"p95 {timing['p95'] * 1000:,.0f} ms | p99 {timing['p99'] * 1000:,.0f} ms | "
+                           f"max {timing['max'] * 1000:,.0f} ms"))
+    rows.append(('الحالات', ', '.join(f"{name[len('status.'):]}: {count}"
+                                        for name, count in sorted(snapshot['counters'].items()))))
+    rows.append(('الإنتاجية', f'{len(records) / elapsed:,.1f} تحديث/ث خلال {elapsed:,.1f} ث'))
+    if 'schedule_lag' in snapshot['timings']:
+        rows.append(('تأخر الجدولة', f"max {snapshot['timings']['schedule_lag']['max'] * 1000:,.0f} ms"))
+    _report(f"إعادة التشغيل ({len(records)} تحديث، السرعة {args.speed})", rows)
+
+
+# --- الموجه السريع ---
+def _synthetic_updates(count, seed=1):
+    """مزيج تحديثات تقريبي لحركة البوت (عند غياب تسجيل حقيقي)"""
+    rng = random.Random(seed)
+    user = {'id': 100001, 'is_bot': False, 'first_name': 'user', 'username': 'user'}
+    chat = {'id': 100001, 'type': 'private', 'first_name': 'user'}
+
+    def message(**fields):
+        return {'message_id': 1, 'date': 1700000000, 'from': user, 'chat': chat, **fields}
+
+    def command(name):
+        return message(text=f'/{name}', entities=[{'type': 'bot_command', 'offset': 0, 'length': len(name) + 1}])
+
+    kinds = [
+        (40, lambda: {'message': message(text='مرحباً، هذا نص لتحويله إلى صوت ' * rng.randint(1, 6))}),
+        (15, lambda: {'message': message(text=rng.choice(['ok', '👍', 'hi', '?']))}),
+        (6, lambda: {'message': command(rng.choice(['start', 'help', 'premium']))}),
+        (4, lambda: {'message': command(rng.choice(['settings', 'lang', 'stop']))}),
+        (5, lambda: {'message': message(voice={'file_id': 'f', 'file_unique_id': 'u', 'duration': 5})}),
+        (10, lambda: {'message': message(sticker={'file_id': 'f', 'file_unique_id': 'u', 'width': 512,
+                                                  'height': 512, 'is_animated': False})}),
+        (10, lambda: {'callback_query': {'id': '1', 'from': user, 'chat_instance': '1', 'data': 'premium_info_100001',
+                                         'message': message(text='menu')}}),
+        (5, lambda: {'edited_message': message(text='نص معدل', edit_date=1700000001)}),
+        (5, lambda: {'my_chat_member': {'chat': chat, 'from': user, 'date': 1700000000,
+                                        'old_chat_member': {'user': user, 'status': 'member'},
+                                        'new_chat_member': {'user': user, 'status': 'kicked', 'until_date': 0}}}),
+    ]
+    weights = [weight for weight, _ in kinds]
+    builders = [builder for _, builder in kinds]
+    return [dict(update_id=i, **rng.choices(builders, weights)[0]()) for i in range(count)]
+
+
+def _per_update(seconds, count):
+    return f'{seconds / count * 1e6:,.1f} µs/تحديث'
+
+
+def _bench_dispatcher(bot):
+    """Dispatcher محلي بنفس مرشحات main.register_handlers ودوال فارغة
+
+    استيراد main يشغل initialize_bot (Firebase و set_webhook) بالرمز الموجود في البيئة.
+    """
+    import queue
+    from telegram import Update
+    from telegram.ext import (
+        Dispatcher, CommandHandler, MessageHandler, CallbackQueryHandler, TypeHandler, Filters
+    )
+
+    def noop(update, context):
+        pass
+
+    dispatcher = Dispatcher(bot, queue.Queue(), workers=0)
+    dispatcher.add_handler(TypeHandler(Update, noop), group=-1)
+    for command in ('start', 'help', 'stats', 'admin', 'premium'):
+        dispatcher.add_handler(CommandHandler(command, noop))
+    dispatcher.add_handler(MessageHandler(Filters.voice | Filters.audio, noop))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, noop))
+    dispatcher.add_handler(MessageHandler(Filters.document, noop))
+    dispatcher.add_handler(CallbackQueryHandler(noop))
+    return dispatcher
+
+
+def bench_fastpath(args):
+    """كلفة فك JSON وبناء Update والمرور على المعالجات، قبل وبعد الموجه السريع"""
+    import json
+    import fastpath
+
+    if args.traces:
+        from traffic_trace import read_traces
+        updates = [record['update'] for record in read_traces(args.traces)]
+    else:
+        updates = _synthetic_updates(args.updates)
+    bodies = [json.dumps(update, ensure_ascii=False).encode() for update in updates]
+    count = len(bodies)
+    rows = []
+
+    start = time.perf_counter()
+    for body in bodies:
+        json.loads(body)
+    json_time = time.perf_counter() - start
+    rows.append(('json.loads', _per_update(json_time, count)))
+    start = time.perf_counter()
+    for body in bodies:
+        fastpath.loads(body)
+    fast_time = time.perf_counter() - start
+    rows.append((f"fastpath.loads ({'orjson' if fastpath.orjson else 'json'})", _per_update(fast_time, count)))
+
+    try:
+        from telegram import Bot, Update
+        from telegram.ext import CommandHandler
+    except ImportError:
+        Update = None
+
+    if Update is None:
+        router = fastpath.FastPathRouter(['start', 'help', 'stats', 'admin', 'premium'], lambda user_id: False)
+    else:
+        # رمز وهمي دائماً: لا طلب يصل إلى Bot API
+        bot = Bot('123456:bench')
+        dispatcher = _bench_dispatcher(bot)
+        commands = [command for handlers in dispatcher.handlers.values() for handler in handlers
+                    if isinstance(handler, CommandHandler) for command in handler.command]
+        router = fastpath.FastPathRouter(commands, lambda user_id: False)
+
+    start = time.perf_counter()
+    routed = [body for body, update in zip(bodies, updates) if router.route(update)[0]]
+    route_time = time.perf_counter() - start
+    rows.append(('route', f'{_per_update(route_time, count)} | يُمرر {len(routed) / count:.0%}'))
+
+    if Update is None:
+        rows.append(('Update.de_json + المعالجات', 'python-telegram-bot غير مثبت'))
+        _report(f'الموجه السريع ({count} تحديث)', rows)
+        return
+
+    def dispatch_cost(selected, decode):
+        """فك JSON وبناء Update واختيار المعالج (ما يسبق تنفيذ الدوال في process_update)"""
+        start = time.perf_counter()
+        for body in selected:
+            update = Update.de_json(decode(body), bot)
+            for group in dispatcher.groups:
+                for handler in dispatcher.handlers[group]:
+                    check = handler.check_update(update)
+                    if check is not None and check is not False:
+                        break
+        return time.perf_counter() - start
+
+    before = dispatch_cost(bodies, json.loads)
+    after = route_time + fast_time + dispatch_cost(routed, fastpath.loads)
+    rows.append(('قبل (json + de_json + المعالجات للكل)', _per_update(before, count)))
+    rows.append(('بعد (fastpath + de_json للمُمرر فقط)', f'{_per_update(after, count)} | x{before / after:,.1f}'))
+    _report(f'الموجه السريع ({count} تحديث)', rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='قياسات أداء البوت')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    cache = sub.add_parser('cache', help='الذاكرة المشتركة مقابل قاموس لكل عملية')
+    cache.add_argument('--ops', type=int, default=20000)
+    cache.add_argument('--workers', type=int, default=4)
+    cache.add_argument('--keys', type=int, default=2000)
+    cache.set_defaults(func=bench_cache)
+
+    tts = sub.add_parser('tts-formats', help='حجم وزمن كل صيغة صوت من Speechify')
+    tts.add_argument('--voice-id', required=True)
+    tts.add_argument('--text', default='مرحباً، هذا اختبار لقياس حجم وزمن كل صيغة صوت.')
+    tts.add_argument('--runs', type=int, default=3)
+    tts.add_argument('--chat-id', help='قياس زمن الرفع إلى تيليجرام أيضاً (يتطلب TELEGRAM_BOT_TOKEN)')
+    tts.set_defaults(func=bench_tts_formats)
+
+    log = sub.add_parser('logging', help='كلفة التسجيل لكل تحديث قبل وبعد الطابور')
+    log.add_argument('--updates', type=int, default=20000)
+    log.add_argument('--error-every', type=int, default=50)
+    log.set_defaults(func=bench_logging)
+
+    replay = sub.add_parser('replay', help='إعادة تشغيل حركة مسجلة وقياس توزيع زمن الاستجابة')
+    replay.add_argument('traces', nargs='+')
+    replay.add_argument('--speed', default='1', help='1 للزمن الحقيقي، N للتسريع، max بلا انتظار')
+    replay.add_argument('--concurrency', type=int, default=32)
+    replay.add_argument('--stub-latency-ms', type=float, default=50)
+    replay.add_argument('--live-firebase', action='store_true')
+    replay.set_defaults(func=bench_replay)
+
+    fast = sub.add_parser('fastpath', help='فك JSON والتوجيه قبل وبعد الموجه السريع')
+    fast.add_argument('--traces', nargs='+')
+    fast.add_argument('--updates', type=int, default=20000)
+    fast.set_defaults(func=bench_fastpath)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
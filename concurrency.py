@@ -0,0 +1,31 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from config import get_env
+import deadline
+import unit_of_work
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_lock = threading.Lock()
+
+
+def get_executor():
+    """منفذ مشترك لاستدعاءات الإدخال/الإخراج المستقلة داخل التحديث الواحد"""
+    global _executor
+    if _executor is None:
+        with _lock:
+            if _executor is None:
+                size = get_env('IO_POOL_SIZE', 32, int)
+                _executor = ThreadPoolExecutor(max_workers=size, thread_name_prefix='io')
+                logger.info(f"✅ تم تهيئة منفذ الإدخال/الإخراج المشترك ({size} خيط)")
+    return _executor
+
+
+def submit(func, *args, **kwargs):
+    """تنفيذ مهمة على المنفذ المشترك مع نقل ميزانية التحديث ووحدة عمله إليها
+
+    كتابات المهمة (مثل إعادة بناء العقدة المختصرة) تُجمع وتُلغى مع كتابات التحديث.
+    """
+    return get_executor().submit(unit_of_work.bind(deadline.bind(func)), *args, **kwargs)
@@ -0,0 +1,21 @@
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+_TRUE_VALUES = ('1', 'true', 'yes', 'on')
+
+
+def get_env(var_name, default, var_type=str):
+    """قراءة متغير بيئة مع التحقق من النوع"""
+    value = os.getenv(var_name)
+    if value is None or value.strip() == '':
+        return default
+
+    try:
+        if var_type is bool:
+            return value.strip().lower() in _TRUE_VALUES
+        return var_type(value.strip())
+    except (TypeError, ValueError):
+        logger.warning(f"⚠️ قيمة غير صالحة لـ {var_name} ({value}), استخدام القيمة الافتراضية {default}")
+        return default
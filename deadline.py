@@ -0,0 +1,86 @@
+import time
+import logging
+import threading
+from contextlib import contextmanager
+from config import get_env
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# أقل مهلة تستحق بدء استدعاء شبكي
+MIN_TIMEOUT = 0.05
+
+_local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    """انتهت ميزانية زمن التحديث قبل مرحلة معينة"""
+
+    def __init__(self, stage):
+        super().__init__(f"انتهت ميزانية التحديث قبل مرحلة {stage}")
+        self.stage = stage
+
+
+def default_budget():
+    return get_env('UPDATE_BUDGET_SECONDS', 25.0, float)
+
+
+def current():
+    """الموعد النهائي للخيط الحالي (time.monotonic) أو None"""
+    return getattr(_local, 'deadline', None)
+
+
+def set_current(value):
+    _local.deadline = value
+
+
+@contextmanager
+def budget(seconds=None):
+    """تحديد ميزانية زمنية لكل ما يُنفذ داخل الكتلة في هذا الخيط"""
+    previous = current()
+    set_current(time.monotonic() + (seconds or default_budget()))
+    try:
+        yield
+    finally:
+        set_current(previous)
+
+
+def remaining():
+    deadline = current()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+def expire(stage):
+    """تسجيل نفاد الميزانية عند مرحلة ورفع DeadlineExceeded"""
+    metrics.incr(f'deadline.exhausted.{stage}')
+    raise DeadlineExceeded(stage)
+
+
+def check(stage):
+    """رفع DeadlineExceeded إذا لم يبق وقت كافٍ للمرحلة"""
+    left = remaining()
+    if left is not None and left < MIN_TIMEOUT:
+        expire(stage)
+    return left
+
+
+def timeout(default, stage):
+    """مهلة الاستدعاء: الأقل بين المهلة الافتراضية والمتبقي من الميزانية"""
+    left = check(stage)
+    if left is None:
+        return default
+    return left if default is None else min(default, left)
+
+
+def bind(func):
+    """نقل الموعد النهائي إلى خيط آخر (مهام المنفذ المشترك)"""
+    deadline = current()
+
+    def wrapper(*args, **kwargs):
+        previous = current()
+        set_current(deadline)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            set_current(previous)
+    return wrapper
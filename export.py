@@ -0,0 +1,126 @@
+import io
+import os
+import csv
+import gzip
+import json
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FIELDS = [
+    'id',
+    'username',
+    'premium.is_premium',
+    'premium.plan_type',
+    'premium.expires_on',
+    'premium.remaining_chars',
+    'usage.total_chars',
+    'voice_cloned',
+    'voice.status',
+    'first_join',
+    'last_used'
+]
+
+
+def _project(user_id, user_data, fields):
+    """استخراج الحقول المطلوبة (تدعم المسارات المنقوطة مثل premium.is_premium)"""
+    record = {}
+    for field in fields:
+        if field == 'id':
+            record[field] = user_id
+            continue
+        value = user_data
+        for part in field.split('.'):
+            value = value.get(part) if isinstance(value, dict) else None
+        record[field] = value
+    return record
+
+
+def _encode_page(records, fmt, fields, header):
+    """تحويل صفحة من السجلات إلى نص"""
+    buffer = io.StringIO()
+    if fmt == 'csv':
+        writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction='ignore')
+        if header:
+            writer.writeheader()
+        writer.writerows(records)
+    else:
+        for record in records:
+            buffer.write(json.dumps(record, ensure_ascii=False) + '\n')
+    return buffer.getvalue().encode('utf-8')
+
+
+def _load_checkpoint(path):
+    if not path or not os.path.exists(path):
+        return None
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_checkpoint(path, state):
+    """كتابة نقطة الاستئناف بشكل ذري"""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(state, f)
+    os.replace(tmp_path, path)
+
+
+def export_users(firebase, output, fmt='ndjson', fields=None, compress=False,
+                 checkpoint=None, page_size=500):
+    """تصدير المستخدمين إلى NDJSON أو CSV بذاكرة ثابتة مع إمكانية الاستئناف"""
+    if fmt not in ('ndjson', 'csv'):
+        raise ValueError(f"تنسيق غير مدعوم: {fmt}")
+
+    fields = fields or DEFAULT_FIELDS
+    state = _load_checkpoint(checkpoint)
+    if state and state.get('output') != output:
+        raise ValueError(f"نقطة الاستئناف تخص ملفاً آخر: {state.get('output')}")
+
+    resuming = bool(state)
+    exported = state['exported'] if resuming else 0
+    last_key = state['last_key'] if resuming else None
+    if resuming:
+        logger.info(f"▶️ استئناف التصدير بعد المستخدم {last_key} ({exported} سجل)")
+
+    start = time.perf_counter()
+    written = 0
+    page = []
+    with open(output, 'r+b' if resuming else 'wb') as f:
+        # حذف أي بيانات كُتبت بعد آخر نقطة استئناف
+        if resuming:
+            f.truncate(state['offset'])
+            f.seek(state['offset'])
+
+        def flush_page():
+            nonlocal page, written
+            data = _encode_page(page, fmt, fields, header=(fmt == 'csv' and not resuming and written == 0))
+            # كل صفحة عضو gzip مستقل حتى يبقى الملف صالحاً عند الاستئناف
+            f.write(gzip.compress(data) if compress else data)
+            f.flush()
+            written += len(page)
+            page = []
+            if checkpoint:
+                _save_checkpoint(checkpoint, {'output': output, 'last_key': last_key,
+                                              'exported': exported + written, 'offset': f.tell()})
+            elapsed = max(time.perf_counter() - start, 1e-9)
+            logger.info(f"📤 تم تصدير {exported + written} سجل ({written / elapsed:,.0f} سجل/ث)")
+
+        for user_id, user_data in firebase.iter_users(page_size=page_size, start_after=last_key):
+            if not isinstance(user_data, dict):
+                continue
+            page.append(_project(user_id, user_data, fields))
+            last_key = user_id
+            if len(page) >= page_size:
+                flush_page()
+
+        if page or (not resuming and written == 0):
+            flush_page()
+
+    elapsed = time.perf_counter() - start
+    if checkpoint and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    rate = written / elapsed if elapsed > 0 else 0
+    logger.info(f"✅ اكتمل التصدير: {exported + written} سجل إلى {output} ({rate:,.0f} سجل/ث)")
+    return {'records': exported + written, 'written': written, 'seconds': elapsed, 'records_per_second': rate}
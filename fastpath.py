@@ -0,0 +1,84 @@
+import json
+import logging
+from metrics import metrics
+
+try:
+    import orjson
+except ImportError:  # اختياري: json القياسي أبطأ لكنه يكفي
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+_MEDIA_FIELDS = ('voice', 'audio')
+
+
+def loads(data):
+    """فك JSON بأسرع مكتبة متاحة (orjson إن وُجدت)"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def _command(message):
+    """اسم الأمر إذا بدأت الرسالة بكيان bot_command (نفس شرط Filters.command)"""
+    text = message.get('text') or ''
+    for entity in message.get('entities') or ():
+        if entity.get('type') == 'bot_command' and entity.get('offset') == 0:
+            return text[1:entity.get('length', 0)].split('@', 1)[0].lower()
+    return None
+
+
+class FastPathRouter:
+    """تصنيف التحديث من JSON الخام قبل بناء كائنات Update
+
+    route(payload) يعيد (هل يُمرر للمعالجات, السبب). لا يُسقط إلا ما كانت
+    المعالجات ستتجاهله بلا أي أثر سوى تسجيل النشاط.
+    """
+
+    def __init__(self, commands, is_admin, min_text_length=3):
+        self.commands = frozenset(command.lower() for command in commands)
+        self.is_admin = is_admin
+        self.min_text_length = min_text_length
+        logger.info(f"✅ تم تهيئة الموجه السريع | الأوامر: {', '.join(sorted(self.commands))}")
+
+    def route(self, payload):
+        if 'callback_query' in payload:
+            return True, 'callback'
+
+        message = payload.get('message')
+        if not isinstance(message, dict):
+            return False, 'unhandled_update'
+
+        if any(field in message for field in _MEDIA_FIELDS):
+            return True, 'media'
+
+        sender = (message.get('from') or {}).get('id')
+        text = message.get('text')
+        if text is None:
+            # الملفات يقبلها handle_document من المشرفين فقط
+            if 'document' in message and self.is_admin(sender):
+                return True, 'document'
+            return False, 'unhandled_message'
+
+        command = _command(message)
+        if command is not None:
+            return (True, 'command') if command in self.commands else (False, 'unknown_command')
+
+        # ردود المشرف على إجراء منتظر قد تكون قصيرة (حالته في user_data غير متاحة هنا)
+        if len(text.strip()) < self.min_text_length and not self.is_admin(sender):
+            return False, 'short_text'
+        return True, 'text'
+
+    def sender_id(self, payload):
+        """معرف المرسل لتسجيل نشاط التحديثات المسقطة"""
+        for field in ('message', 'edited_message', 'callback_query', 'inline_query', 'my_chat_member'):
+            node = payload.get(field)
+            if isinstance(node, dict):
+                return (node.get('from') or {}).get('id')
+        return None
+
+    def decide(self, payload):
+        """route مع تسجيل القياسات"""
+        routed, reason = self.route(payload)
+        metrics.incr(f'fastpath.{"routed" if routed else "dropped"}.{reason}')
+        return routed
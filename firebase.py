@@ -2,12 +2,45 @@ import os
 import firebase_admin
 from firebase_admin import credentials, db
 import logging
+from contextlib import contextmanager
 from urllib.parse import urlparse
+from config import get_env
+from metrics import metrics
+import unit_of_work
+import deadline
+from concurrency import submit
+from unit_of_work import increment
 
 logger = logging.getLogger(__name__)
+# سطور النجاح المتكررة مع كل تحديث فقط؛ تُؤخذ منها عينات (LOG_SAMPLE_LOGGERS)
+sampled_logger = logging.getLogger(f'{__name__}.sampled')
 
 class FirebaseManager:
-    def __init__(self):
+    # الحقول التي يحتاجها مسار الرسائل، منسوخة في العقدة المختصرة user_quota/<id>.
+    # هي نسخة غير مطبّعة (denormalized) وليست نقلاً: users/<id> يبقى السجل الكامل بنفس حجمه،
+    # وكل كتابة على هذه الحقول تُكتب في المكانين معاً (_hot_updates): مسارات إضافية في نفس
+    # الكتابة متعددة المسارات لا طلب إضافي. التوفير في القراءة فقط: مسار الرسائل يقرأ
+    # العقدة المختصرة، بينما get_user_data يبقى قراءة كاملة للسجل
+    HOT_FIELDS = {
+        'usage/total_chars': 'total_chars',
+        'premium/is_premium': 'is_premium',
+        'premium/plan_type': 'plan_type',
+        'premium/expires_on': 'expires_on',
+        'premium/remaining_chars': 'remaining_chars',
+        'voice/voice_id': 'voice_id',
+        'voice_cloned': 'voice_cloned'
+    }
+    # يُكتب فقط عند بناء العقدة كاملة؛ غيابه يعني أن العقدة جزئية ويجب إعادة بنائها
+    HOT_SCHEMA_VERSION = 1
+    # عدادات stats/ تُحدث في نفس كتابة المستخدم، فتقرأ لوحة المشرف عقدة صغيرة بدل users كاملة
+    STATS_FIELDS = ('users', 'premium_users', 'total_chars')
+
+    def __init__(self, cache=None):
+        self.cache = cache
+        self.USER_CACHE_TTL = get_env('USER_CACHE_TTL', 30.0, float)
+        # نسخة العقدة مع ETag تبقى أطول لإعادة التحقق بدلاً من التنزيل الكامل
+        self.ETAG_CACHE_TTL = get_env('USER_ETAG_CACHE_TTL', 86400.0, float)
+        self.READ_CONCURRENCY = get_env('FIREBASE_READ_CONCURRENCY', 16, int)
         self.cred = self._get_firebase_credentials()
         self._validate_database_url()
         self._initialize_app()
@@ -16,6 +49,11 @@ class FirebaseManager:
 
     def _get_firebase_credentials(self):
         """تهيئة بيانات الاعتماد مع تحسينات التحقق"""
+        if os.getenv('FIREBASE_DATABASE_EMULATOR_HOST'):
+            # المحاكي لا يتحقق من بيانات الاعتماد
+            logger.info(f"🧪 استخدام محاكي Firebase: {os.getenv('FIREBASE_DATABASE_EMULATOR_HOST')}")
+            return credentials.ApplicationDefault()
+
         required_env_vars = [
             'FIREBASE_PROJECT_ID',
             'FIREBASE_PRIVATE_KEY_ID',
@@ -76,7 +114,9 @@ class FirebaseManager:
                         self.cred,
                         {
                             'databaseURL': os.getenv('FIREBASE_DATABASE_URL'),
-                            'databaseAuthVariableOverride': None
+                            'databaseAuthVariableOverride': None,
+                            # حد أعلى لكل طلب؛ ميزانية التحديث تُفحص قبل كل استدعاء
+                            'httpTimeout': get_env('FIREBASE_HTTP_TIMEOUT', 10.0, float)
                         }
                     )
                     logger.info(f"✅ تم تهيئة تطبيق Firebase (المحاولة {attempt + 1})")
@@ -119,17 +159,9 @@ class FirebaseManager:
             return False
 
         try:
-            user_ref = self.ref.child('users').child(str(user_id))
-            
-            # التحقق من وجود بيانات سابقة
-            existing_data = user_ref.get()
-            
-            # دمج البيانات الجديدة مع القديمة (إذا وجدت)
-            if existing_data and isinstance(existing_data, dict):
-                data = {**existing_data, **data}
-            
-            user_ref.set(data)
-            logger.info(f"✅ تم حفظ بيانات المستخدم {user_id} بنجاح")
+            # التحديث يدمج الحقول العليا مع البيانات الموجودة دون قراءتها أولاً
+            self.update_user(user_id, data)
+            sampled_logger.info(f"✅ تم حفظ بيانات المستخدم {user_id} بنجاح", extra={'user_id': user_id})
             return True
         except Exception as e:
             logger.error(f"❌ فشل حفظ بيانات المستخدم {user_id}: {str(e)}", exc_info=True)
@@ -141,8 +173,14 @@ class FirebaseManager:
             logger.error(f"❌ معرف مستخدم غير صالح: {user_id}")
             return {}
 
+        if self.cache:
+            cached = self.cache.get(f'user:{user_id}')
+            if cached is not None:
+                return cached
+
+        deadline.check('firebase')
         try:
-            data = self.ref.child('users').child(str(user_id)).get()
+            data, _ = self._get_with_etag(f'users/{user_id}', f'user_etag:{user_id}')
             
             if not data:
                 logger.debug(f"⚠️ لا توجد بيانات للمستخدم {user_id}")
@@ -152,11 +190,303 @@ class FirebaseManager:
                 logger.warning(f"⚠️ بيانات غير متوقعة للمستخدم {user_id}: {type(data)}")
                 return {}
                 
+            if self.cache:
+                self.cache.set(f'user:{user_id}', data, self.USER_CACHE_TTL)
             return data
         except Exception as e:
             logger.error(f"❌ فشل جلب بيانات المستخدم {user_id}: {str(e)}", exc_info=True)
             return {}
 
+    def get_user_hot(self, user_id):
+        """جلب العقدة المختصرة للحصص فقط (بدلاً من كامل بيانات المستخدم)"""
+        if not user_id or not isinstance(user_id, (int, str)):
+            logger.error(f"❌ معرف مستخدم غير صالح: {user_id}")
+            return {}
+
+        if self.cache:
+            cached = self.cache.get(f'hot:{user_id}')
+            if cached is not None:
+                return cached
+
+        deadline.check('firebase')
+        try:
+            hot, _ = self._get_with_etag(f'user_quota/{user_id}', f'hot_etag:{user_id}')
+            if not isinstance(hot, dict) or hot.get('schema') != self.HOT_SCHEMA_VERSION:
+                # مستخدم لم يُنقل بعد: بناء العقدة من البيانات الكاملة مرة واحدة
+                user_data = self.get_user_data(user_id)
+                if not user_data:
+                    return {}
+                hot = self.build_hot_node(user_data)
+                self._write_hot_node(user_id, hot)
+                logger.info(f"🔀 تم إنشاء عقدة الحصص للمستخدم {user_id}")
+
+            if self.cache:
+                self.cache.set(f'hot:{user_id}', hot, self.USER_CACHE_TTL)
+            return hot
+        except Exception as e:
+            logger.error(f"❌ فشل جلب حصص المستخدم {user_id}: {str(e)}", exc_info=True)
+            return {}
+
+    def _write_hot_node(self, user_id, hot):
+        """حفظ عقدة حصص أعيد بناؤها (داخل وحدة العمل إن وُجدت، فتُلغى مع التراجع)"""
+        path = f'user_quota/{user_id}'
+        uow = unit_of_work.current()
+        if uow is not None:
+            # الكتابات المعلقة على حقول العقدة تُطبق فوقها ولا تضيع
+            uow.add_base(path, hot)
+            return
+        deadline.check('firebase')
+        self.ref.child(path).set(hot)
+        metrics.incr('firebase.writes')
+
+    def _get_with_etag(self, path, cache_key):
+        """قراءة عقدة مع إعادة التحقق بـ ETag: لا تُنزل القيمة إلا إذا تغيرت"""
+        ref = self.ref.child(path)
+        entry = self.cache.get(cache_key) if self.cache else None
+        if entry:
+            changed, data, etag = ref.get_if_changed(entry['etag'])
+            if not changed:
+                metrics.incr('firebase.etag.not_modified')
+                return entry['data'], entry['etag']
+            metrics.incr('firebase.etag.modified')
+        else:
+            data, etag = ref.get(etag=True)
+
+        if self.cache:
+            self.cache.set(cache_key, {'data': data, 'etag': etag}, self.ETAG_CACHE_TTL)
+        return data, etag
+
+    def update_if_unchanged(self, user_id, path, mutate, attempts=3, extra=None):
+        """تعديل شرطي لعقدة فرعية للمستخدم (تزامن متفائل بـ ETag)
+
+        mutate(القيمة الحالية) يعيد القيمة الجديدة، أو None لإلغاء الكتابة.
+        extra: مسارات من الجذر (مثل فرق العدادات) تُكتب فقط إذا نجحت الكتابة الشرطية،
+        أو دالة تأخذ القيمة التي استُبدلت وتعيدها (الفرق يتبع ما كان مكتوباً فعلاً)
+        يعيد (هل كُتبت, آخر قيمة معروفة).
+        """
+        deadline.check('firebase')
+        ref = self.ref.child('users').child(str(user_id)).child(path)
+        value, etag = ref.get(etag=True)
+        for _ in range(attempts):
+            new_value = mutate(value)
+            if new_value is None:
+                return False, value
+            previous = value
+            written, value, etag = ref.set_if_unchanged(etag, new_value)
+            if written:
+                if callable(extra):
+                    extra = extra(previous)
+                committed = {**self._hot_updates(user_id, {path: new_value}), **(extra or {})}
+                self.write_committed(committed, user_ids=[user_id])
+                self._keep_mirror(user_id, committed)
+                return True, new_value
+            metrics.incr('firebase.etag.conflict')
+        logger.warning(f"⚠️ تعارض مستمر في تعديل {path} للمستخدم {user_id}")
+        return False, value
+
+    def flip_flags(self, user_ids, path, value):
+        """كتابة حقل منطقي لعدة مستخدمين بشرط أن قيمته الحالية عكس value (ETag لكل مستخدم)
+
+        يعيد (من قلبه هذا الاستدعاء, من تعذر التحقق منه). من غيّره كاتب آخر إلى value
+        في الأثناء لا يُعد، فلا يُحسب فرق العدادات مرتين.
+        """
+        def flip(user_id):
+            deadline.check('firebase')
+            ref = self.ref.child('users').child(str(user_id)).child(path)
+            current, etag = ref.get(etag=True)
+            if bool(current) == value:
+                return False
+            written, _, _ = ref.set_if_unchanged(etag, value)
+            if not written:
+                metrics.incr('firebase.etag.conflict')
+            return written
+
+        flipped, failed = [], []
+        for start in range(0, len(user_ids), self.READ_CONCURRENCY):
+            batch = user_ids[start:start + self.READ_CONCURRENCY]
+            futures = [(user_id, submit(flip, user_id)) for user_id in batch]
+            for user_id, future in futures:
+                try:
+                    if future.result():
+                        flipped.append(user_id)
+                except Exception as e:
+                    logger.error(f"❌ فشل تعديل {path} للمستخدم {user_id}: {str(e)}")
+                    failed.append(user_id)
+        return flipped, failed
+
+    def write_committed(self, updates, user_ids=()):
+        """كتابة فورية لتوابع كتابة شرطية نُفذت فعلاً (نسخ الحقول والعدادات)
+
+        لا تُؤجل ولا تُفحص المهلة: إلغاؤها مع وحدة العمل عند خطأ لاحق، أو تخطيها
+        عند نفاد المهلة، يترك النسخة والعدادات مخالفة لما كُتب.
+        """
+        self.ref.update(updates)
+        metrics.incr('firebase.writes')
+        for user_id in user_ids:
+            self.invalidate_user(user_id)
+
+    def _keep_mirror(self, user_id, updates):
+        """منع عقدة مختصرة أعيد بناؤها في وحدة العمل الحالية من استبدال النسخة الجديدة"""
+        uow = unit_of_work.current()
+        base = f'user_quota/{user_id}'
+        if uow is not None and any(p == base or p.startswith(base + '/') for p in uow.updates):
+            uow.add({p: v for p, v in updates.items() if p.startswith(base + '/')})
+
+    def read_many(self, paths, shallow=False):
+        """قراءة عدة عقد بالتوازي على دفعات (RTDB لا يدعم جلب عدة مسارات في طلب واحد)"""
+        results = {}
+        for start in range(0, len(paths), self.READ_CONCURRENCY):
+            batch = paths[start:start + self.READ_CONCURRENCY]
+            deadline.check('firebase')
+            futures = [(path, submit(self.ref.child(path).get, shallow=shallow)) for path in batch]
+            for path, future in futures:
+                results[path] = future.result()
+            metrics.incr('firebase.batched_reads', len(batch))
+        return results
+
+    @classmethod
+    def build_hot_node(cls, user_data):
+        """استخراج حقول الحصص من بيانات المستخدم الكاملة"""
+        hot = {'schema': cls.HOT_SCHEMA_VERSION}
+        for path, field in cls.HOT_FIELDS.items():
+            value = user_data
+            for part in path.split('/'):
+                value = value.get(part) if isinstance(value, dict) else None
+            if value is not None:
+                hot[field] = value
+        return hot
+
+    @classmethod
+    def _hot_updates(cls, user_id, updates):
+        """ترجمة تحديثات users/<id> إلى تحديثات العقدة المختصرة"""
+        hot_updates = {}
+        for path, value in updates.items():
+            for hot_path, field in cls.HOT_FIELDS.items():
+                if hot_path == path:
+                    hot_updates[f'user_quota/{user_id}/{field}'] = value
+                elif hot_path.startswith(path + '/'):
+                    # استبدال عقدة أب (مثل premium) يستبدل الحقل أو يحذفه
+                    nested = value
+                    for part in hot_path[len(path) + 1:].split('/'):
+                        nested = nested.get(part) if isinstance(nested, dict) else None
+                    hot_updates[f'user_quota/{user_id}/{field}'] = nested
+        return hot_updates
+
+    @classmethod
+    def user_paths(cls, user_id, updates):
+        """مسارات الكتابة من الجذر لتحديثات users/<id> مع نسخ الحقول المختصرة"""
+        multi_path = {f'users/{user_id}/{path}': value for path, value in updates.items()}
+        multi_path.update(cls._hot_updates(user_id, updates))
+        return multi_path
+
+    def update_user(self, user_id, updates, extra=None):
+        """تحديث بيانات المستخدم والعقدة المختصرة في كتابة واحدة متعددة المسارات
+
+        extra: مسارات إضافية من جذر القاعدة تُكتب في نفس العملية
+        """
+        multi_path = self.user_paths(user_id, updates)
+        if extra:
+            multi_path.update(extra)
+        self.write(multi_path, user_ids=[user_id])
+
+    def write(self, updates, user_ids=(), defer=True, durable=False, on_failure=None):
+        """كتابة متعددة المسارات، تُؤجل إلى نهاية التحديث داخل وحدة العمل
+
+        defer=False: كتابة فورية حتى داخل وحدة العمل (العمليات الجماعية المقسمة)
+        durable: لا تُلغى مع كتابات معالج فشل لاحقاً
+        on_failure: يُستدعى إذا لم تُنفذ وحدة العمل (الكتابة الفورية ترفع الخطأ للمستدعي)
+        """
+        uow = unit_of_work.current() if defer else None
+        if uow is not None:
+            uow.add(updates, user_ids, durable=durable)
+            if on_failure:
+                uow.on_failure(on_failure)
+            return
+        deadline.check('firebase')
+        self.ref.update(updates)
+        metrics.incr('firebase.writes')
+        for user_id in user_ids:
+            self.invalidate_user(user_id)
+
+    @contextmanager
+    def unit_of_work(self):
+        """تجميع كل كتابات الكتلة في تحديث واحد عند نهايتها (وإلغاؤها عند الخطأ)
+
+        فشل الكتابة النهائية يُرفع للمستدعي: الويب هوك يرد 500 ويلغي حجز التحديث
+        فيعيد تيليجرام إرساله بدلاً من فقدان الخصم والعدادات بصمت.
+        """
+        uow = unit_of_work.begin()
+        if uow is None:
+            # وحدة عمل خارجية نشطة وهي من تنفذ الكتابة
+            yield unit_of_work.current()
+            return
+
+        try:
+            yield uow
+        except Exception:
+            unit_of_work.rollback()
+            uow.failed()
+            raise
+        else:
+            try:
+                uow.commit(self.ref)
+            except Exception as e:
+                uow.failed()
+                metrics.incr('uow.commit_failed')
+                logger.error(f"❌ فشل تنفيذ كتابات التحديث ({len(uow.updates)} مسار): {str(e)}", exc_info=True)
+                raise
+        finally:
+            unit_of_work.end()
+            for user_id in uow.user_ids:
+                self.invalidate_user(user_id)
+
+    def rollback(self):
+        """إلغاء كتابات وحدة العمل الحالية"""
+        unit_of_work.rollback()
+
+    def backfill_hot_mirror(self, batch_size=500):
+        """بناء نسخة حقول الحصص user_quota لكل المستخدمين الحاليين على دفعات
+
+        لا تحذف الحقول من users/<id>: النسخة إضافية لتصغير قراءات مسار الرسائل فقط.
+        """
+        migrated = 0
+        updates = {}
+        for user_id, user_data in self.iter_users(page_size=batch_size):
+            if not isinstance(user_data, dict):
+                continue
+            updates[f'user_quota/{user_id}'] = self.build_hot_node(user_data)
+            if len(updates) >= batch_size:
+                self.ref.update(updates)
+                migrated += len(updates)
+                logger.info(f"🔀 تم نسخ حصص {migrated} مستخدم إلى user_quota")
+                updates = {}
+
+        if updates:
+            self.ref.update(updates)
+            migrated += len(updates)
+        logger.info(f"✅ اكتمل بناء نسخة الحصص: {migrated}")
+        return migrated
+
+    def recount_stats(self, page_size=500):
+        """ضبط عدادات stats/ على القيم الفعلية (بعد انحراف أو لأول مرة)"""
+        stats = dict.fromkeys(self.STATS_FIELDS, 0)
+        for _, user_data in self.iter_users(page_size=page_size):
+            if not isinstance(user_data, dict):
+                continue
+            stats['users'] += 1
+            if (user_data.get('premium') or {}).get('is_premium'):
+                stats['premium_users'] += 1
+            chars = (user_data.get('usage') or {}).get('total_chars', 0)
+            stats['total_chars'] += chars if isinstance(chars, (int, float)) else 0
+        self.ref.update({f'stats/{name}': value for name, value in stats.items()})
+        logger.info(f"✅ تم ضبط العدادات المجمعة: {stats}")
+        return stats
+
+    def invalidate_user(self, user_id):
+        """حذف نسخة المستخدم من الذاكرة المشتركة بعد أي كتابة"""
+        if self.cache:
+            self.cache.delete(f'user:{user_id}', f'hot:{user_id}')
+
     def update_usage(self, user_id, chars_used):
         """تحديث استخدام الأحرف مع التحقق من القيم"""
         if not isinstance(chars_used, int) or chars_used <= 0:
@@ -165,24 +495,28 @@ class FirebaseManager:
 
         try:
             updates = {
-                'usage/total_chars': db.Increment(chars_used),
+                'usage/total_chars': increment(chars_used),
                 'last_used': {'.sv': 'timestamp'}
             }
             
             # إضافة تحديث إضافي للمستخدمين المميزين
-            user_data = self.get_user_data(user_id)
-            if user_data.get('premium', {}).get('is_premium', False):
-                updates['premium/remaining_chars'] = db.Increment(-chars_used)
+            if self.get_user_hot(user_id).get('is_premium', False):
+                updates['premium/remaining_chars'] = increment(-chars_used)
             
-            self.ref.child('users').child(str(user_id)).update(updates)
-            logger.info(f"✅ تم تحديث استخدام الأحرف للمستخدم {user_id}: +{chars_used}")
+            self.update_user(user_id, updates, extra={'stats/total_chars': increment(chars_used)})
+            sampled_logger.info(f"✅ تم تحديث استخدام الأحرف للمستخدم {user_id}: +{chars_used}",
+                                extra={'user_id': user_id, 'chars': chars_used})
             return True
         except Exception as e:
             logger.error(f"❌ فشل تحديث استخدام الأحرف للمستخدم {user_id}: {str(e)}", exc_info=True)
             return False
 
-    def update_voice_clone(self, user_id, voice_data):
-        """تحديث بيانات الصوت مع التحقق من الهيكل"""
+    def update_voice_clone(self, user_id, voice_data, sample_hash=None, reused=False):
+        """تحديث بيانات الصوت مع التحقق من الهيكل
+
+        sample_hash: بصمة العينة لفهرسة الصوت الناتج في voice_hashes
+        reused: الصوت مأخوذ من الفهرس دون استنساخ جديد
+        """
         required_fields = ['voice_id', 'status']
         if not all(field in voice_data for field in required_fields):
             logger.error(f"❌ بيانات الصوت ناقصة الحقول المطلوبة: {voice_data}")
@@ -194,14 +528,118 @@ class FirebaseManager:
                 'voice_cloned': True,
                 'last_voice_update': {'.sv': 'timestamp'}
             }
-            
-            self.ref.child('users').child(str(user_id)).update(updates)
-            logger.info(f"✅ تم تحديث بيانات الصوت للمستخدم {user_id}")
+
+            extra = {}
+            if sample_hash:
+                extra[f'voice_hashes/{user_id}/{sample_hash}'] = voice_data['voice_id']
+            if reused:
+                extra['stats/avoided_clones'] = {'.sv': {'increment': 1}}
+
+            self.update_user(user_id, updates, extra=extra)
+            logger.info(f"✅ تم تحديث بيانات الصوت للمستخدم {user_id}",
+                        extra={'user_id': user_id, 'reused': reused})
             return True
         except Exception as e:
             logger.error(f"❌ فشل تحديث بيانات الصوت للمستخدم {user_id}: {str(e)}", exc_info=True)
             return False
 
+    def get_voice_by_hash(self, user_id, sample_hash):
+        """جلب الصوت المستنسخ سابقاً من نفس العينة (None إذا لم يوجد)"""
+        deadline.check('firebase')
+        try:
+            return self.ref.child('voice_hashes').child(str(user_id)).child(sample_hash).get()
+        except Exception as e:
+            logger.error(f"❌ فشل البحث في فهرس الأصوات للمستخدم {user_id}: {str(e)}", exc_info=True)
+            return None
+
+    @staticmethod
+    def normalize_username(username):
+        """توحيد اسم المستخدم لاستخدامه كمفتاح في الفهرس"""
+        if not username:
+            return None
+        return username.strip().lstrip('@').lower() or None
+
+    @classmethod
+    def username_index_updates(cls, user_id, username, old_username=None):
+        """مسارات فهرس usernames لتغيير اسم المستخدم (من جذر القاعدة)"""
+        new_key = cls.normalize_username(username)
+        old_key = cls.normalize_username(old_username)
+        updates = {}
+        if old_key and old_key != new_key:
+            updates[f'usernames/{old_key}'] = None
+        if new_key:
+            updates[f'usernames/{new_key}'] = int(user_id)
+        return updates
+
+    def update_username(self, user_id, username, old_username=None):
+        """تحديث اسم المستخدم وفهرس usernames في كتابة واحدة"""
+        new_key = self.normalize_username(username)
+        old_key = self.normalize_username(old_username)
+
+        updates = {f'users/{user_id}/username': username}
+        updates.update(self.username_index_updates(user_id, username, old_username))
+
+        try:
+            self.write(updates, user_ids=[user_id])
+            logger.info(f"✅ تم تحديث فهرس اسم المستخدم {user_id}: {old_key} -> {new_key}")
+            return True
+        except Exception as e:
+            logger.error(f"❌ فشل تحديث فهرس اسم المستخدم {user_id}: {str(e)}", exc_info=True)
+            return False
+
+    def get_user_id_by_username(self, username):
+        """جلب معرف المستخدم من فهرس usernames بقراءة واحدة"""
+        key = self.normalize_username(username)
+        if not key:
+            return None
+
+        deadline.check('firebase')
+        try:
+            user_id = self.ref.child('usernames').child(key).get()
+            return int(user_id) if user_id else None
+        except Exception as e:
+            logger.error(f"❌ فشل البحث عن اسم المستخدم {key}: {str(e)}", exc_info=True)
+            return None
+
+    def iter_users(self, page_size=500, start_after=None):
+        """المرور على المستخدمين صفحة بصفحة مرتبين حسب المفتاح"""
+        last_key = start_after
+        while True:
+            query = self.ref.child('users').order_by_key()
+            if last_key is not None:
+                query = query.start_at(str(last_key))
+            page = query.limit_to_first(page_size + (1 if last_key is not None else 0)).get() or {}
+
+            items = [(k, v) for k, v in page.items() if k != str(last_key)]
+            if not items:
+                return
+            for user_id, user_data in items:
+                yield user_id, user_data
+            last_key = items[-1][0]
+            if len(items) < page_size:
+                return
+
+    def backfill_username_index(self, batch_size=500):
+        """بناء فهرس usernames للمستخدمين الحاليين على دفعات"""
+        indexed = 0
+        updates = {}
+        for user_id, user_data in self.iter_users(page_size=batch_size):
+            key = self.normalize_username(user_data.get('username') if isinstance(user_data, dict) else None)
+            if not key:
+                continue
+            updates[f'usernames/{key}'] = int(user_id)
+            if len(updates) >= batch_size:
+                self.ref.update(updates)
+                indexed += len(updates)
+                logger.info(f"📇 تمت فهرسة {indexed} اسم مستخدم")
+                updates = {}
+
+        if updates:
+            self.ref.update(updates)
+            indexed += len(updates)
+        logger.info(f"✅ اكتملت فهرسة أسماء المستخدمين: {indexed}")
+        return indexed
+
     def get_all_users(self, filters=None):
         """جلب جميع المستخدمين مع إمكانية التصفية"""
         try:
@@ -223,7 +661,20 @@ class FirebaseManager:
     def delete_user(self, user_id):
         """حذف مستخدم مع التحقق من الصلاحيات"""
         try:
-            self.ref.child('users').child(str(user_id)).delete()
+            hot = self.get_user_hot(user_id)
+            updates = {
+                f'users/{user_id}': None,
+                f'user_quota/{user_id}': None,
+                f'voice_hashes/{user_id}': None
+            }
+            if hot:
+                # العدادات المجمعة لا تشمل المحذوفين (مثل إعادة العد)
+                updates['stats/users'] = increment(-1)
+                updates['stats/total_chars'] = increment(-(hot.get('total_chars') or 0))
+                if hot.get('is_premium'):
+                    updates['stats/premium_users'] = increment(-1)
+            self.ref.update(updates)
+            self.invalidate_user(user_id)
             logger.info(f"✅ تم حذف المستخدم {user_id} بنجاح")
             return True
         except Exception as e:
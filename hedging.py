@@ -0,0 +1,117 @@
+import logging
+import threading
+from concurrent.futures import wait, FIRST_COMPLETED
+from config import get_env
+from metrics import metrics
+from concurrency import submit
+import deadline
+
+logger = logging.getLogger(__name__)
+
+
+class RequestHedger:
+    """إرسال طلب ثانٍ مطابق إذا تأخر الأول عن نسبة مئوية من زمن أول بايت"""
+
+    # أقل عدد عينات قبل الاعتماد على النسبة المئوية بدلاً من التأخير الافتراضي
+    MIN_SAMPLES = 50
+
+    def __init__(self, name, latency_metric):
+        self.name = name
+        self.latency_metric = latency_metric
+        prefix = name.upper()
+        self.ENABLED = get_env(f'{prefix}_HEDGE_ENABLED', False, bool)
+        self.MAX_CHARS = get_env(f'{prefix}_HEDGE_MAX_CHARS', 300, int)
+        self.PERCENTILE = get_env(f'{prefix}_HEDGE_PERCENTILE', 95.0, float)
+        self.DEFAULT_DELAY = get_env(f'{prefix}_HEDGE_DEFAULT_DELAY', 1.0, float)
+        self.MIN_DELAY = get_env(f'{prefix}_HEDGE_MIN_DELAY', 0.2, float)
+        # نسبة الطلبات الإضافية القصوى من الطلبات المؤهلة
+        self.MAX_RATIO = get_env(f'{prefix}_HEDGE_MAX_RATIO', 0.05, float)
+
+        self._lock = threading.Lock()
+        self._budget = 1.0
+        self._budget_cap = 10.0
+        if self.ENABLED:
+            logger.info(
+                f"✅ تم تفعيل الطلبات الاحتياطية لـ {name} | p{self.PERCENTILE:g} | "
+                f"حتى {self.MAX_CHARS} حرف | حد الحمل الإضافي {self.MAX_RATIO:.0%}"
+            )
+
+    def eligible(self, text):
+        return self.ENABLED and len(text) <= self.MAX_CHARS
+
+    def delay(self):
+        """التأخير قبل الطلب الاحتياطي (من توزيع زمن أول بايت الحديث)"""
+        if metrics.sample_count(self.latency_metric) < self.MIN_SAMPLES:
+            return self.DEFAULT_DELAY
+        return max(self.MIN_DELAY, metrics.percentile(self.latency_metric, self.PERCENTILE))
+
+    def _deposit(self):
+        # كل طلب مؤهل يضيف MAX_RATIO من طلب احتياطي إلى الرصيد
+        with self._lock:
+            self._budget = min(self._budget_cap, self._budget + self.MAX_RATIO)
+
+    def _withdraw(self):
+        with self._lock:
+            if self._budget >= 1.0:
+                self._budget -= 1.0
+                return True
+            return False
+
+    def call(self, open_stream, close_stream):
+        """تنفيذ open_stream مع طلب احتياطي عند التأخر
+
+        open_stream: يفتح الطلب ويعود بعد وصول أول بايت
+        close_stream: يغلق نتيجة الطلب الخاسر
+        """
+        metrics.incr(f'{self.name}.hedge.eligible')
+        self._deposit()
+
+        primary = submit(open_stream)
+        wait_for = self.delay()
+        left = deadline.remaining()
+        if left is not None:
+            wait_for = min(wait_for, max(0.0, left))
+        done, _ = wait([primary], timeout=wait_for)
+        if done:
+            return primary.result()
+        if not self._withdraw():
+            metrics.incr(f'{self.name}.hedge.throttled')
+            return primary.result()
+
+        metrics.incr(f'{self.name}.hedge.issued')
+        hedge = submit(open_stream)
+        roles = {primary: 'primary', hedge: 'hedge'}
+        pending = set(roles)
+        winner = None
+        error = None
+        while pending and winner is None:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is not None:
+                    error = future.exception()
+                elif winner is None:
+                    winner = future
+                else:
+                    close_stream(future.result())
+
+        # الطلب الخاسر: إلغاؤه إن لم يبدأ، أو إغلاق رده عند وصوله
+        for future in pending:
+            if not future.cancel():
+                future.add_done_callback(lambda f: f.exception() is None and close_stream(f.result()))
+
+        if winner is None:
+            raise error
+        metrics.incr(f'{self.name}.hedge.won.{roles[winner]}')
+        return winner.result()
+
+    def stats(self):
+        eligible = metrics.counter(f'{self.name}.hedge.eligible')
+        issued = metrics.counter(f'{self.name}.hedge.issued')
+        return {
+            'eligible': eligible,
+            'issued': issued,
+            'hedge_rate': issued / eligible if eligible else 0.0,
+            'hedge_wins': metrics.counter(f'{self.name}.hedge.won.hedge'),
+            'primary_wins': metrics.counter(f'{self.name}.hedge.won.primary'),
+            'throttled': metrics.counter(f'{self.name}.hedge.throttled')
+        }
@@ -0,0 +1,122 @@
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+from config import get_env
+from metrics import metrics
+import deadline
+
+logger = logging.getLogger(__name__)
+
+
+def _instrumented(base):
+    """مجمع اتصالات يسجل زمن انتظار الاتصال وعدد الاتصالات الجديدة لكل مضيف"""
+
+    class InstrumentedPool(base):
+        def _get_conn(self, timeout=None):
+            # مع pool_block=True لا ينتظر الحجز أكثر من المتبقي من ميزانية التحديث
+            # (أو HTTP_POOL_TIMEOUT خارجها) بدلاً من الانتظار بلا حد
+            left = deadline.check('http_pool')
+            limit = get_env('HTTP_POOL_TIMEOUT', 30.0, float) if left is None else left
+            bounded_by_deadline = timeout is None or limit < timeout
+            timeout = limit if bounded_by_deadline else timeout
+            start = time.perf_counter()
+            try:
+                return super()._get_conn(timeout)
+            except Exception as e:
+                # EmptyPoolError من نسخة urllib3 الخاصة بالمجمع (المثبتة أو المضمنة في PTB)
+                if type(e).__name__ == 'EmptyPoolError' and left is not None and bounded_by_deadline:
+                    deadline.expire('http_pool')
+                raise
+            finally:
+                metrics.observe(f'http.{self.host}.checkout_wait', time.perf_counter() - start)
+                metrics.incr(f'http.{self.host}.requests')
+
+        def _new_conn(self):
+            metrics.incr(f'http.{self.host}.new_connections')
+            return super()._new_conn()
+
+    InstrumentedPool.__name__ = f'Instrumented{base.__name__}'
+    return InstrumentedPool
+
+
+_INSTRUMENTED = {}
+
+
+def _instrumented_for(base):
+    """نسخة مقاسة من صنف المجمع نفسه (نسخة واحدة لكل صنف)"""
+    if base not in _INSTRUMENTED:
+        _INSTRUMENTED[base] = _instrumented(base)
+    return _INSTRUMENTED[base]
+
+
+def instrument_pool_manager(pool_manager):
+    """تفعيل القياس على PoolManager من urllib3
+
+    الأصناف المقاسة تُبنى من أصناف المدير نفسه: PTB 13 يستخدم نسخته المضمنة
+    telegram.vendor.ptb_urllib3 ولا تقبل مجمعات urllib3 المثبتة في النظام.
+    """
+    pool_manager.pool_classes_by_scheme = {
+        scheme: _instrumented_for(pool_class)
+        for scheme, pool_class in pool_manager.pool_classes_by_scheme.items()
+    }
+    return pool_manager
+
+
+class InstrumentedAdapter(HTTPAdapter):
+    """محول requests بمجمعات اتصالات مقاسة"""
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        instrument_pool_manager(self.poolmanager)
+
+
+def pool_size():
+    """حجم المجمع لكل مضيف حسب تزامن العامل"""
+    configured = get_env('HTTP_POOL_SIZE', 0, int)
+    if configured > 0:
+        return configured
+    # كل خيط قد يحجز اتصالاً: خيوط gunicorn للعامل + المنفذ المشترك + خيوط الأجزاء
+    # + عمال الاستطلاع + خيط العمليات الجماعية للمشرف
+    threads = get_env('GUNICORN_THREADS', 1, int) + get_env('IO_POOL_SIZE', 32, int) + 1
+    if get_env('SHARDING_ENABLED', False, bool):
+        threads += get_env('SHARD_WORKERS', 16, int)
+    if get_env('BOT_MODE', 'webhook').lower() == 'polling':
+        threads += get_env('POLL_WORKERS', 8, int)
+    return max(10, threads)
+
+
+def prewarm(name, func, connections):
+    """فتح عدة اتصالات مسبقاً حتى لا تقع مصافحة TLS في مسار الطلب"""
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=connections) as executor:
+        results = list(executor.map(lambda _: _safe_call(func), range(connections)))
+    logger.info(
+        f"🔥 تم تسخين {sum(results)}/{connections} اتصال إلى {name} "
+        f"في {(time.perf_counter() - start) * 1000:.0f} ms"
+    )
+
+
+def _safe_call(func):
+    try:
+        func()
+        return True
+    except Exception as e:
+        logger.warning(f"⚠️ فشل تسخين الاتصال: {str(e)}")
+        return False
+
+
+def pool_stats():
+    """نسبة إعادة استخدام الاتصالات لكل مضيف"""
+    counters = metrics.snapshot()['counters']
+    stats = {}
+    for name, value in counters.items():
+        if name.startswith('http.') and name.endswith('.requests'):
+            host = name[len('http.'):-len('.requests')]
+            new = counters.get(f'http.{host}.new_connections', 0)
+            stats[host] = {
+                'requests': value,
+                'new_connections': new,
+                'reuse_ratio': 1 - new / value if value else 0.0
+            }
+    return stats
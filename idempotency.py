@@ -0,0 +1,65 @@
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+from config import get_env
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class UpdateDeduplicator:
+    """منع معالجة نفس التحديث مرتين عند إعادة إرساله من تيليجرام"""
+
+    def __init__(self, store=None):
+        self.CAPACITY = get_env('UPDATE_DEDUPE_CAPACITY', 10000, int)
+        self.TTL = get_env('UPDATE_DEDUPE_TTL', 3600.0, float)
+        self.store = store
+        self._seen = OrderedDict()
+        self._lock = threading.Lock()
+        logger.info(
+            f"✅ تم تهيئة منع تكرار التحديثات | السعة: {self.CAPACITY} | مشترك: {'نعم' if store else 'لا'}"
+        )
+
+    def claim(self, update_id):
+        """حجز التحديث للمعالجة، وإرجاع False إذا كان مكرراً"""
+        if update_id is None:
+            return True
+
+        metrics.incr('updates.received')
+        with self._lock:
+            if update_id in self._seen:
+                self._seen.move_to_end(update_id)
+                claimed = False
+            else:
+                self._seen[update_id] = True
+                if len(self._seen) > self.CAPACITY:
+                    self._seen.popitem(last=False)
+                claimed = True
+
+        # التحقق من العمليات الأخرى فقط إذا لم يُرَ التحديث محلياً
+        if claimed and self.store:
+            try:
+                claimed = self.store.compare_and_set(f'update:{update_id}', None, 1, self.TTL)
+            except sqlite3.Error as e:
+                # القفل المشغول ليس تكراراً: معالجة التحديث أفضل من إسقاطه
+                metrics.incr('updates.dedupe_unavailable')
+                logger.warning(f"⚠️ تعذر التحقق من تكرار التحديث {update_id}: {str(e)}")
+
+        if not claimed:
+            metrics.incr('updates.duplicate')
+            logger.info(f"تم تجاهل تحديث مكرر: {update_id}")
+        return claimed
+
+    def release(self, update_id):
+        """إلغاء الحجز حتى تُعاد معالجة التحديث بعد فشل الويب هوك"""
+        if update_id is None:
+            return
+        with self._lock:
+            self._seen.pop(update_id, None)
+        if self.store:
+            self.store.delete(f'update:{update_id}')
+
+    def duplicate_rate(self):
+        received = metrics.counter('updates.received')
+        return metrics.counter('updates.duplicate') / received if received else 0.0
@@ -0,0 +1,168 @@
+import re
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import itertools
+from collections import OrderedDict
+from logging.handlers import QueueHandler, QueueListener
+from config import get_env
+from metrics import metrics
+
+DEFAULT_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+
+# خصائص LogRecord القياسية؛ ما عداها حقول إضافية مُمررة عبر extra
+_RESERVED = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+_listener = None
+
+# الأرقام (معرفات المستخدمين والقيم) لا تميز خطأً عن آخر
+_DIGITS = re.compile(r'\d+')
+
+
+def _quote(value):
+    text = str(value)
+    if not text or any(c in text for c in ' ="\n'):
+        return json.dumps(text, ensure_ascii=False)
+    return text
+
+
+class KeyValueFormatter(logging.Formatter):
+    """سطر واحد بصيغة key=value مع حقول extra"""
+
+    def format(self, record):
+        parts = [
+            f'ts={self.formatTime(record, "%Y-%m-%dT%H:%M:%S")}',
+            f'level={record.levelname}',
+            f'logger={record.name}',
+            f'msg={_quote(record.getMessage())}'
+        ]
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith('_'):
+                parts.append(f'{key}={_quote(value)}')
+        if record.exc_info:
+            parts.append(f'exc={_quote(self.formatException(record.exc_info))}')
+        return ' '.join(parts)
+
+
+class SampledLogger(logging.Logger):
+    """مسجل يمرر سجل INFO واحداً من كل N ويتخطى الباقي قبل إنشاء LogRecord"""
+
+    sample_every = 1
+
+    def info(self, msg, *args, **kwargs):
+        if self.sample_every > 1 and next(self._sample_counter) % self.sample_every:
+            metrics.incr('logging.sampled_out')
+            return
+        super().info(msg, *args, **kwargs)
+
+
+def enable_sampling(names, every):
+    """تفعيل أخذ العينات لسجلات INFO في المسجلات كثيفة الحجم (الأخطاء لا تتأثر)
+
+    تُحدد المسجلات بالاسم الكامل (مثل firebase.sampled) لأن تغيير الفئة لا يمتد
+    إلى المسجلات الأبناء ولا إلى الأب؛ سطور التشغيل العارضة تبقى كاملة.
+    """
+    for name in names:
+        sampled = logging.getLogger(name)
+        sampled.__class__ = SampledLogger
+        sampled.sample_every = max(1, every)
+        sampled._sample_counter = itertools.count()
+
+
+class ErrorRateLimiter(logging.Filter):
+    """كتم تكرار نفس الخطأ (نفس السطر ونوع الاستثناء ونص الرسالة دون أرقامها) خلال نافذة زمنية"""
+
+    MAX_KEYS = 1000
+
+    def __init__(self, window):
+        super().__init__()
+        self.window = window
+        self._lock = threading.Lock()
+        self._seen = OrderedDict()
+
+    def filter(self, record):
+        if record.levelno < logging.ERROR or self.window <= 0:
+            return True
+        exc_type = record.exc_info[0].__name__ if record.exc_info and record.exc_info[0] else None
+        # رسائل مختلفة من نفس السطر (مسار آخر أو سبب آخر) لا يكتم بعضها بعضاً
+        message = hash(_DIGITS.sub('#', record.getMessage()))
+        key = (record.name, record.lineno, exc_type, message)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._seen.get(key)
+            if entry and now - entry[0] < self.window:
+                entry[1] += 1
+                metrics.incr('logging.errors_suppressed')
+                return False
+            if entry and entry[1]:
+                record.suppressed = entry[1]
+            self._seen[key] = [now, 0]
+            self._seen.move_to_end(key)
+            if len(self._seen) > self.MAX_KEYS:
+                self._seen.popitem(last=False)
+        return True
+
+
+class NonBlockingQueueHandler(QueueHandler):
+    """إرسال السجلات إلى طابور دون تنسيقها أو انتظار الكتابة على خيط الطلب"""
+
+    def prepare(self, record):
+        # التنسيق (بما فيه تتبع الاستثناء) يتم في خيط المستمع
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            metrics.incr('logging.dropped')
+
+
+class _Listener(QueueListener):
+    def enqueue_sentinel(self):
+        # الانتظار حتى يتسع الطابور بدلاً من فقدان إشارة الإيقاف
+        self.queue.put(self._sentinel)
+
+
+def setup_logging(level=logging.INFO, handler=None):
+    """تهيئة التسجيل عبر طابور يكتب منه خيط مستقل
+
+    handler: معالج الكتابة الفعلي (الافتراضي stderr)
+    """
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    if handler is None:
+        handler = logging.StreamHandler()
+    if get_env('LOG_FORMAT', 'kv') == 'kv':
+        handler.setFormatter(KeyValueFormatter())
+    else:
+        handler.setFormatter(logging.Formatter(DEFAULT_FORMAT))
+
+    queue_handler = NonBlockingQueueHandler(queue.Queue(get_env('LOG_QUEUE_SIZE', 10000, int)))
+    queue_handler.addFilter(ErrorRateLimiter(get_env('LOG_ERROR_WINDOW', 60.0, float)))
+
+    sampled = [name.strip() for name in get_env('LOG_SAMPLE_LOGGERS', 'firebase.sampled').split(',') if name.strip()]
+    enable_sampling(sampled, get_env('LOG_SAMPLE_EVERY', 10, int))
+
+    root = logging.getLogger()
+    root.handlers[:] = [queue_handler]
+    root.setLevel(level)
+
+    _listener = _Listener(queue_handler.queue, handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(shutdown_logging)
+    return _listener
+
+
+def shutdown_logging():
+    """تفريغ الطابور وإيقاف خيط الكتابة"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -1,27 +1,43 @@
 import os
+import io
+import time
+import hashlib
 import logging
-import tempfile
 import json
-from flask import Flask, request, jsonify
+from concurrent.futures import TimeoutError as FuturesTimeout
+from flask import Flask, request, jsonify, abort, send_file
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram.error import RetryAfter
+from telegram.utils.request import Request
 from telegram.ext import (
     Updater,
     CommandHandler,
     MessageHandler,
     Filters,
     Dispatcher,
-    CallbackQueryHandler
+    CallbackQueryHandler,
+    TypeHandler
 )
 import requests
-from requests.adapters import HTTPAdapter
 from urllib3.util.retry import Retry
 from datetime import datetime
+from config import get_env
+from metrics import metrics
+from concurrency import submit
+from unit_of_work import increment
+import deadline
+from deadline import DeadlineExceeded
+from http_pool import InstrumentedAdapter, instrument_pool_manager, pool_size, pool_stats, prewarm
+from segment_cache import split_sentences
+from log_setup import setup_logging
+from sharding import user_key
+import profiler
+import memory
+import fastpath
+import webhook_reply
 
-# تهيئة التسجيل
-logging.basicConfig(
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    level=logging.INFO
-)
+# تهيئة التسجيل (الكتابة من خيط مستقل حتى لا تُبطئ خيوط الطلبات)
+setup_logging(logging.INFO)
 logger = logging.getLogger(__name__)
 
 # تهيئة التطبيق
@@ -36,10 +52,31 @@ firebase_manager = None
 subscription_manager = None
 admin_panel = None
 premium_manager = None
+message_sender = None
+shared_cache = None
+update_deduplicator = None
+activity_tracker = None
+output_format_policy = None
+segment_cache = None
+
+# webhook أو polling
+BOT_MODE = get_env('BOT_MODE', 'webhook').lower()
+
+# قابلة للتغيير لتشغيل البوت ضد خوادم بديلة (إعادة تشغيل التسجيلات)
+SPEECHIFY_API_URL = get_env('SPEECHIFY_API_URL', 'https://api.sws.speechify.com').rstrip('/')
+TELEGRAM_API_URL = get_env('TELEGRAM_API_URL', 'https://api.telegram.org').rstrip('/')
+TRACE_RECORD_PATH = get_env('TRACE_RECORD_PATH', '')
+trace_recorder = None
+tts_hedger = None
+shard_workers = None
+shard_router = None
+fast_router = None
 
 def initialize_bot():
     global bot, updater, dispatcher, session
-    global firebase_manager, subscription_manager, admin_panel, premium_manager
+    global firebase_manager, subscription_manager, admin_panel, premium_manager, message_sender
+    global shared_cache, update_deduplicator, activity_tracker, output_format_policy, segment_cache
+    global trace_recorder, tts_hedger, shard_workers, shard_router, fast_router
 
     # 1. تهيئة اتصال الطلبات
     session = requests.Session()
@@ -48,14 +85,23 @@ def initialize_bot():
         backoff_factor=1,
         status_forcelist=[500, 502, 503, 504]
     )
-    adapter = HTTPAdapter(max_retries=retry_strategy)
+    # حجم المجمع يطابق تزامن العامل حتى لا تُفتح وتُغلق اتصالات TLS عند الذروة
+    adapter = InstrumentedAdapter(
+        max_retries=retry_strategy,
+        pool_maxsize=pool_size(),
+        pool_block=True
+    )
     session.mount("https://", adapter)
     session.mount("http://", adapter)
 
-    # 2. تهيئة Firebase
+    # 2. تهيئة الذاكرة المشتركة بين العمليات و Firebase
+    if get_env('SHARED_CACHE_ENABLED', True, bool):
+        from shared_cache import SharedCache
+        shared_cache = SharedCache()
+
     try:
         from firebase import FirebaseManager
-        firebase_manager = FirebaseManager()
+        firebase_manager = FirebaseManager(cache=shared_cache)
     except Exception as e:
         logger.error(f"فشل تهيئة Firebase: {str(e)}")
         raise
@@ -64,48 +110,116 @@ def initialize_bot():
     from subscription import SubscriptionManager
     from admin import AdminPanel
     from premium import PremiumManager
+    from messenger import MessageSender
+    
+    from idempotency import UpdateDeduplicator
+    from activity import ActivityTracker
+    from audio_formats import OutputFormatPolicy
+    from segment_cache import SegmentCache
+    from hedging import RequestHedger
     
-    subscription_manager = SubscriptionManager(firebase_manager)
-    premium_manager = PremiumManager(firebase_manager)
-    admin_panel = AdminPanel(firebase_manager, premium_manager)
+    message_sender = MessageSender()
+    output_format_policy = OutputFormatPolicy()
+    segment_cache = SegmentCache()
+    tts_hedger = RequestHedger('tts', 'tts.first_byte')
+    update_deduplicator = UpdateDeduplicator(store=shared_cache)
+    activity_tracker = ActivityTracker(firebase_manager, cache=shared_cache)
+    subscription_manager = SubscriptionManager(firebase_manager, message_sender, cache=shared_cache)
+    premium_manager = PremiumManager(firebase_manager, cache=shared_cache)
+    admin_panel = AdminPanel(firebase_manager, premium_manager, message_sender, activity=activity_tracker)
 
     # 4. التحقق من متغيرات البيئة
     BOT_TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
     WEBHOOK_URL = os.getenv('WEBHOOK_URL')
-    API_KEY = os.getenv('SPEECHIFY_API_KEY')
 
-    if not all([BOT_TOKEN, WEBHOOK_URL, API_KEY]):
-        missing = [var for var in ['BOT_TOKEN', 'WEBHOOK_URL', 'API_KEY'] if not os.getenv(var)]
+    # وضع الاستطلاع لا يحتاج رابط ويب هوك عام
+    required = ['TELEGRAM_BOT_TOKEN', 'SPEECHIFY_API_KEY']
+    if BOT_MODE == 'webhook':
+        required.append('WEBHOOK_URL')
+    missing = [var for var in required if not os.getenv(var)]
+    if missing:
         raise ValueError(f"متغيرات البيئة المفقودة: {', '.join(missing)}")
 
     # 5. تهيئة بوت التليجرام
-    bot = Bot(token=BOT_TOKEN)
+    telegram_request = Request(con_pool_size=pool_size())
+    instrument_pool_manager(telegram_request._con_pool)
+    bot = Bot(
+        token=BOT_TOKEN,
+        request=telegram_request,
+        base_url=f'{TELEGRAM_API_URL}/bot',
+        base_file_url=f'{TELEGRAM_API_URL}/file/bot'
+    )
     updater = Updater(bot=bot, use_context=True)
     dispatcher = updater.dispatcher
 
+    # تسجيل حركة الويب هوك (اختياري) لإعادة تشغيلها لاحقاً
+    if TRACE_RECORD_PATH:
+        from traffic_trace import TraceRecorder
+        trace_recorder = TraceRecorder(TRACE_RECORD_PATH)
+
+    # توجيه تحديثات كل مستخدم إلى جزء ثابت (وعقدة ثابتة عند تحديد SHARD_NODES)
+    if get_env('SHARDING_ENABLED', False, bool):
+        # الأجزاء والحجوزات داخل العملية: عامل gunicorn ثانٍ على نفس العضو يعالج نفس
+        # المستخدم بالتوازي (التزامن داخل العامل عبر GUNICORN_THREADS)
+        workers = get_env('GUNICORN_WORKERS', get_env('WEB_CONCURRENCY', 1, int), int)
+        if workers > 1:
+            raise ValueError(f"التوزيع يتطلب عامل gunicorn واحداً لكل عقدة (الحالي: {workers})")
+        from sharding import ShardWorkers, ShardRouter
+        shard_workers = ShardWorkers()
+        shard_router = ShardRouter(session)
+
+    if get_env('MEMORY_TRACKING', False, bool):
+        memory.tracker.start()
+
     # 6. تسجيل المعالجات
     register_handlers()
 
-    # 7. تعيين ويب هوك
-    set_webhook(BOT_TOKEN, WEBHOOK_URL)
+    # إسقاط التحديثات التي لن يأخذها أي معالج قبل بناء كائنات Update
+    if get_env('FASTPATH_ENABLED', True, bool):
+        commands = [
+            command
+            for handlers in dispatcher.handlers.values()
+            for handler in handlers if isinstance(handler, CommandHandler)
+            for command in handler.command
+        ]
+        fast_router = fastpath.FastPathRouter(commands, admin_panel.is_admin)
+
+    # 7. تعيين ويب هوك (وضع الاستطلاع يحذفه عند بدء التشغيل)
+    if BOT_MODE == 'webhook':
+        set_webhook(BOT_TOKEN, WEBHOOK_URL)
+
+    # 8. تسخين الاتصالات إلى Speechify و Bot API
+    if get_env('HTTP_PREWARM', True, bool):
+        connections = get_env('HTTP_PREWARM_CONNECTIONS', 2, int)
+        prewarm('Speechify', lambda: session.head(SPEECHIFY_API_URL, timeout=5), connections)
+        prewarm('Telegram', bot.get_me, connections)
 
     logger.info("✅ تم تهيئة البوت بنجاح")
     return app
 
 def register_handlers():
+    # كل معالج مغلف بقياس الذاكرة حتى يُنسب النمو والتخصيصات الكبيرة إليه
+    tracked = memory.tracker.track
+
+    # تتبع النشاط اليومي قبل باقي المعالجات
+    dispatcher.add_handler(TypeHandler(Update, tracked(track_activity)), group=-1)
+
     # الأوامر الأساسية
-    dispatcher.add_handler(CommandHandler("start", handle_start))
-    dispatcher.add_handler(CommandHandler("help", handle_help))
-    dispatcher.add_handler(CommandHandler("stats", handle_stats))
-    dispatcher.add_handler(CommandHandler("admin", handle_admin))
-    dispatcher.add_handler(CommandHandler("premium", handle_premium))
+    dispatcher.add_handler(CommandHandler("start", tracked(handle_start)))
+    dispatcher.add_handler(CommandHandler("help", tracked(handle_help)))
+    dispatcher.add_handler(CommandHandler("stats", tracked(handle_stats)))
+    dispatcher.add_handler(CommandHandler("admin", tracked(handle_admin)))
+    dispatcher.add_handler(CommandHandler("premium", tracked(handle_premium)))
 
     # معالجات الرسائل
-    dispatcher.add_handler(MessageHandler(Filters.voice | Filters.audio, handle_audio))
-    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, handle_text))
+    dispatcher.add_handler(MessageHandler(Filters.voice | Filters.audio, tracked(handle_audio)))
+    dispatcher.add_handler(MessageHandler(Filters.text & ~Filters.command, tracked(handle_text)))
+
+    # ملفات المشرف (قوائم المعرفات للعمليات الجماعية)
+    dispatcher.add_handler(MessageHandler(Filters.document, tracked(handle_document)))
 
     # معالجات الضغطات
-    dispatcher.add_handler(CallbackQueryHandler(handle_callback_query))
+    dispatcher.add_handler(CallbackQueryHandler(tracked(handle_callback_query)))
 
     # معالج الأخطاء
     dispatcher.add_error_handler(handle_errors)
@@ -122,7 +236,7 @@ def set_webhook(bot_token, webhook_url):
         # تعيين الويب هوك الجديد
         success = bot.set_webhook(
             url=full_url,
-            max_connections=40,
+            max_connections=get_env('WEBHOOK_MAX_CONNECTIONS', 40, int),
             allowed_updates=["message", "callback_query"]
         )
         
@@ -137,24 +251,57 @@ def set_webhook(bot_token, webhook_url):
 def handle_errors(update, context):
     """معالجة الأخطاء العامة"""
     try:
-        logger.error(f"حدث خطأ: {context.error}", exc_info=True)
+        if isinstance(context.error, DeadlineExceeded):
+            logger.warning(f"⏱ {context.error}")
+        else:
+            logger.error(f"حدث خطأ: {context.error}", exc_info=True)
+
+        # المعالج لم يكتمل: لا تُنفذ كتاباته الجزئية ولا رده المحجوز (المرسل يبتلع
+        # الاستثناء فيُرد على الويب هوك بنجاح)
+        firebase_manager.rollback()
+        webhook_reply.discard()
+
+        # نفدت ميزانية التحديث: رد واحد بمهلة مستقلة قصيرة
+        if isinstance(context.error, DeadlineExceeded):
+            if update and update.effective_chat:
+                with deadline.budget(get_env('BUSY_REPLY_TIMEOUT', 5.0, float)):
+                    message_sender.send_message(
+                        context.bot,
+                        update.effective_chat.id,
+                        "⏳ البوت مشغول حالياً، يرجى المحاولة مرة أخرى بعد قليل.",
+                        dedupe_key='busy'
+                    )
+            return
+        
+        # لا نرسل رسالة خطأ عند تجاوز حد تيليجرام حتى لا نزيد الضغط
+        if isinstance(context.error, RetryAfter):
+            return
         
         if update and update.effective_chat:
             error_msg = "⚠️ حدث خطأ غير متوقع. يرجى المحاولة لاحقًا."
-            context.bot.send_message(
-                chat_id=update.effective_chat.id,
-                text=error_msg,
+            message_sender.send_message(
+                context.bot,
+                update.effective_chat.id,
+                error_msg,
                 parse_mode='HTML'
             )
     except Exception as e:
         logger.error(f"❌ فشل في معالجة الخطأ: {str(e)}")
 
+def track_activity(update, context):
+    """تسجيل نشاط المستخدم اليومي"""
+    if update.effective_user:
+        activity_tracker.record(update.effective_user.id)
+
 # --- معالجات الأوامر ---
 def handle_start(update, context):
     """معالجة أمر /start"""
     user = update.effective_user
     chat = update.effective_chat
     
+    # قراءة بيانات المستخدم بالتوازي مع فحص القنوات
+    user_data_future = submit(firebase_manager.get_user_data, user.id)
+
     # التحقق من القنوات المطلوبة أولاً
     if not subscription_manager.check_required_channels(user.id, context):
         return
@@ -180,27 +327,34 @@ def handle_start(update, context):
 """
     
     try:
-        context.bot.send_message(
-            chat_id=chat.id,
-            text=welcome_msg,
-            parse_mode='HTML'
+        message_sender.send_message(
+            context.bot,
+            chat.id,
+            welcome_msg,
+            parse_mode='HTML',
+            inline=True
         )
         
         # تسجيل المستخدم الجديد
-        register_new_user(user)
+        register_new_user(user, user_data_future.result())
         
+    except (RetryAfter, DeadlineExceeded):
+        # تُعالج في handle_errors دون إرسال رسالة إضافية
+        raise
     except Exception as e:
         logger.error(f"فشل في معالجة أمر /start: {str(e)}")
-        context.bot.send_message(
-            chat_id=chat.id,
-            text="❌ حدث خطأ أثناء معالجة طلبك",
+        message_sender.send_message(
+            context.bot,
+            chat.id,
+            "❌ حدث خطأ أثناء معالجة طلبك",
             parse_mode='HTML'
         )
 
-def register_new_user(user):
+def register_new_user(user, user_data=None):
     """تسجيل مستخدم جديد في Firebase"""
     try:
-        user_data = firebase_manager.get_user_data(user.id)
+        if user_data is None:
+            user_data = firebase_manager.get_user_data(user.id)
         
         if not user_data:
             new_user = {
@@ -215,8 +369,20 @@ def register_new_user(user):
                 'language_code': user.language_code
             }
             
-            firebase_manager.save_user_data(user.id, new_user)
+            # السجل وفهرس اسم المستخدم في كتابة واحدة متعددة المسارات
+            firebase_manager.update_user(
+                user.id,
+                new_user,
+                extra={
+                    **firebase_manager.username_index_updates(user.id, user.username),
+                    'stats/users': increment(1)
+                }
+            )
+            activity_tracker.record_signup(user.id)
             logger.info(f"تم تسجيل مستخدم جديد: {user.id}")
+        elif user_data.get('username') != user.username:
+            # تحديث فهرس اسم المستخدم عند تغييره
+            firebase_manager.update_username(user.id, user.username, user_data.get('username'))
     except Exception as e:
         logger.error(f"فشل تسجيل مستخدم جديد: {str(e)}")
 
@@ -242,10 +408,12 @@ def handle_help(update, context):
 للاستفسارات: @support
 """
     
-    context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=help_msg,
-        parse_mode='HTML'
+    message_sender.send_message(
+        context.bot,
+        update.effective_chat.id,
+        help_msg,
+        parse_mode='HTML',
+        inline=True
     )
 
 def handle_stats(update, context):
@@ -253,9 +421,10 @@ def handle_stats(update, context):
     user_id = update.effective_user.id
     
     if not admin_panel.is_admin(user_id):
-        context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="⛔ ليس لديك صلاحية الوصول إلى هذه الميزة",
+        message_sender.send_message(
+            context.bot,
+            update.effective_chat.id,
+            "⛔ ليس لديك صلاحية الوصول إلى هذه الميزة",
             parse_mode='HTML'
         )
         return
@@ -267,12 +436,15 @@ def handle_stats(update, context):
 👥 المستخدمون: {stats['total_users']}
 💎 المشتركون: {stats['premium_users']}
 🔄 النشطاء اليوم: {stats['active_today']}
+📅 النشطاء أسبوعياً: {stats['active_week']}
+🗓 النشطاء شهرياً: {stats['active_month']}
 📨 إجمالي الأحرف: {stats['total_requests']:,}
 """
     
-    context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=stats_msg,
+    message_sender.send_message(
+        context.bot,
+        update.effective_chat.id,
+        stats_msg,
         parse_mode='HTML'
     )
 
@@ -281,16 +453,18 @@ def handle_admin(update, context):
     user_id = update.effective_user.id
     
     if not admin_panel.is_admin(user_id):
-        context.bot.send_message(
-            chat_id=update.effective_chat.id,
-            text="⛔ ليس لديك صلاحية الوصول إلى هذه الميزة",
+        message_sender.send_message(
+            context.bot,
+            update.effective_chat.id,
+            "⛔ ليس لديك صلاحية الوصول إلى هذه الميزة",
             parse_mode='HTML'
         )
         return
     
-    context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text="👨‍💻 لوحة تحكم المشرفين",
+    message_sender.send_message(
+        context.bot,
+        update.effective_chat.id,
+        "👨‍💻 لوحة تحكم المشرفين",
         parse_mode='HTML',
         reply_markup=admin_panel.get_admin_dashboard()
     )
@@ -300,11 +474,13 @@ def handle_premium(update, context):
     user_id = update.effective_user.id
     message = premium_manager.get_info_message(user_id)
     
-    context.bot.send_message(
-        chat_id=update.effective_chat.id,
-        text=message,
+    message_sender.send_message(
+        context.bot,
+        update.effective_chat.id,
+        message,
         parse_mode='HTML',
-        reply_markup=premium_manager.get_upgrade_keyboard(user_id)
+        reply_markup=premium_manager.get_upgrade_keyboard(user_id),
+        inline=True
     )
 
 # --- معالجات الرسائل ---
@@ -322,9 +498,10 @@ def handle_audio(update, context):
         
         # إذا لم يكن هناك ملف صوتي
         if not file:
-            context.bot.send_message(
-                chat_id=chat.id,
-                text="⚠️ الرجاء إرسال مقطع صوتي فقط (بين 10-30 ثانية).",
+            message_sender.send_message(
+                context.bot,
+                chat.id,
+                "⚠️ الرجاء إرسال مقطع صوتي فقط (بين 10-30 ثانية).",
                 parse_mode='HTML'
             )
             return
@@ -332,31 +509,54 @@ def handle_audio(update, context):
         # التحقق من حجم الملف (5MB كحد أقصى)
         file_size = file.file_size / (1024 * 1024)  # حجم الملف بالميجابايت
         if file_size > 5:
-            context.bot.send_message(
-                chat_id=chat.id,
-                text="⚠️ الملف كبير جداً (الحد الأقصى 5MB)",
+            message_sender.send_message(
+                context.bot,
+                chat.id,
+                "⚠️ الملف كبير جداً (الحد الأقصى 5MB)",
                 parse_mode='HTML'
             )
             return
         
         # تنزيل الملف الصوتي
-        tg_file = context.bot.get_file(file.file_id)
-        audio_data = session.get(tg_file.file_path, timeout=10).content
+        tg_file = context.bot.get_file(file.file_id, timeout=deadline.timeout(None, 'telegram'))
+        audio_data = session.get(tg_file.file_path, timeout=deadline.timeout(10, 'download')).content
         
         # استنساخ الصوت مع إضافة بيانات الموافقة
         clone_voice(user.id, audio_data, context)
         
+    except (RetryAfter, DeadlineExceeded):
+        raise
     except Exception as e:
         logger.error(f"فشل معالجة الملف الصوتي: {str(e)}")
-        context.bot.send_message(
-            chat_id=chat.id,
-            text="❌ حدث خطأ أثناء معالجة الملف الصوتي",
+        message_sender.send_message(
+            context.bot,
+            chat.id,
+            "❌ حدث خطأ أثناء معالجة الملف الصوتي",
             parse_mode='HTML'
         )
 
 def clone_voice(user_id, audio_data, context):
     """استنساخ الصوت باستخدام API مع بيانات الموافقة"""
     try:
+        # نفس العينة من نفس المستخدم تعيد الصوت المستنسخ سابقاً دون رفع جديد
+        sample_hash = hashlib.sha256(audio_data).hexdigest()
+        existing_voice_id = firebase_manager.get_voice_by_hash(user_id, sample_hash)
+        if existing_voice_id:
+            firebase_manager.update_voice_clone(user_id, {
+                'voice_id': existing_voice_id,
+                'status': 'active',
+                'timestamp': {'.sv': 'timestamp'}
+            }, reused=True)
+            metrics.incr('voice_clone.avoided')
+            logger.info(f"♻️ إعادة استخدام صوت مستنسخ للمستخدم {user_id} ({sample_hash[:12]})")
+            message_sender.send_message(
+                context.bot,
+                user_id,
+                "✅ تم تفعيل صوتك المستنسخ سابقاً من نفس المقطع! يمكنك الآن إرسال النصوص",
+                parse_mode='HTML'
+            )
+            return
+
         # بيانات الموافقة (Consent Data) - مطلوبة في API
         consent_data = {
             "fullName": f"User_{user_id}",
@@ -373,10 +573,10 @@ def clone_voice(user_id, audio_data, context):
         
         # إرسال الطلب إلى API
         response = session.post(
-            'https://api.sws.speechify.com/v1/voices',  # أو الرابط الصحيح للـ API
+            f'{SPEECHIFY_API_URL}/v1/voices',
             headers={'Authorization': f'Bearer {os.getenv("SPEECHIFY_API_KEY")}'},
             files=files,
-            timeout=30
+            timeout=deadline.timeout(30, 'clone')
         )
         
         if response.status_code == 200:
@@ -389,42 +589,60 @@ def clone_voice(user_id, audio_data, context):
                 'timestamp': {'.sv': 'timestamp'}
             }
             
-            firebase_manager.update_voice_clone(user_id, voice_data)
+            firebase_manager.update_voice_clone(user_id, voice_data, sample_hash=sample_hash)
+            metrics.incr('voice_clone.created')
             
-            context.bot.send_message(
-                chat_id=user_id,
-                text="✅ تم استنساخ صوتك بنجاح! يمكنك الآن إرسال النصوص",
+            message_sender.send_message(
+                context.bot,
+                user_id,
+                "✅ تم استنساخ صوتك بنجاح! يمكنك الآن إرسال النصوص",
                 parse_mode='HTML'
             )
         else:
             error_msg = response.json().get('message', 'Unknown error')
-            context.bot.send_message(
-                chat_id=user_id,
-                text=f"❌ فشل استنساخ الصوت: {error_msg}",
+            message_sender.send_message(
+                context.bot,
+                user_id,
+                f"❌ فشل استنساخ الصوت: {error_msg}",
                 parse_mode='HTML'
             )
             
+    except (RetryAfter, DeadlineExceeded):
+        raise
     except json.JSONDecodeError:
         logger.error("فشل تحليل رد API")
-        context.bot.send_message(
-            chat_id=user_id,
-            text="❌ حدث خطأ في معالجة الرد من الخادم",
+        message_sender.send_message(
+            context.bot,
+            user_id,
+            "❌ حدث خطأ في معالجة الرد من الخادم",
             parse_mode='HTML'
         )
     except Exception as e:
         logger.error(f"فشل استنساخ الصوت: {str(e)}")
-        context.bot.send_message(
-            chat_id=user_id,
-            text="❌ حدث خطأ غير متوقع أثناء استنساخ الصوت",
+        message_sender.send_message(
+            context.bot,
+            user_id,
+            "❌ حدث خطأ غير متوقع أثناء استنساخ الصوت",
             parse_mode='HTML'
         )
 
+def handle_document(update, context):
+    """الملفات مقبولة فقط كرد على إجراء مشرف منتظر"""
+    user = update.effective_user
+    if context.user_data.get('admin_action') and admin_panel.is_admin(user.id):
+        admin_panel.handle_admin_document(update, context)
+
 def handle_text(update, context):
     """معالجة الرسائل النصية وتحويلها إلى صوت"""
     user = update.effective_user
     chat = update.effective_chat
     text = update.message.text
 
+    # ردود المشرف على إجراءات لوحة التحكم
+    if context.user_data.get('admin_action') and admin_panel.is_admin(user.id):
+        admin_panel.handle_admin_message(update, context)
+        return
+
     # تخطي الرسائل القصيرة جدًا
     if len(text.strip()) < 3:
         return
@@ -434,81 +652,158 @@ def handle_text(update, context):
         return
 
     try:
-        # جلب بيانات المستخدم من Firebase
-        user_data = firebase_manager.get_user_data(user.id)
-        voice_id = user_data.get('voice', {}).get('voice_id')
+        # جلب عقدة الحصص فقط (تحتوي voice_id)
+        hot = firebase_manager.get_user_hot(user.id)
+        voice_id = hot.get('voice_id')
 
         if not voice_id:
-            context.bot.send_message(
-                chat_id=chat.id,
-                text="❌ يرجى استنساخ صوتك أولاً بإرسال مقطع صوتي (10-30 ثانية).",
+            message_sender.send_message(
+                context.bot,
+                chat.id,
+                "❌ يرجى استنساخ صوتك أولاً بإرسال مقطع صوتي (10-30 ثانية).",
                 parse_mode='HTML'
             )
             return
 
-        # تحويل النص إلى صوت مع إرسال الطلب بالطريقة الصحيحة
-        audio_file = convert_text_to_speech(user.id, voice_id, text, context)
+        # تحويل النص إلى صوت بالصيغة المحددة لخطة المستخدم
+        audio_format = output_format_policy.format_for(hot.get('is_premium', False))
+        audio_file = convert_text_to_speech(user.id, voice_id, text, context, audio_format)
 
         if audio_file:
             # إرسال الصوت إلى المستخدم
-            context.bot.send_voice(
-                chat_id=chat.id,
-                voice=audio_file,
+            message_sender.send_voice(
+                context.bot,
+                chat.id,
+                audio_file,
                 reply_to_message_id=update.message.message_id
             )
-            audio_file.close()  # إغلاق الملف المؤقت بعد الإرسال
+            audio_file.close()
+
+            # الصوت أُرسل: الخصم بميزانية مستقلة كي لا يسقطه انتهاء مهلة التحديث،
+            # وبالعقدة المقروءة أعلاه (تُنفذ مع باقي كتابات التحديث في نهايته)
+            with deadline.budget(get_env('BILLING_TIMEOUT', 5.0, float)):
+                premium_manager.deduct_chars(user.id, len(text), hot=hot)
 
+    except (RetryAfter, DeadlineExceeded):
+        raise
     except Exception as e:
         logger.error(f"فشل معالجة النص: {str(e)}", exc_info=True)
-        context.bot.send_message(
-            chat_id=chat.id,
-            text="❌ حدث خطأ أثناء معالجة النص",
+        message_sender.send_message(
+            context.bot,
+            chat.id,
+            "❌ حدث خطأ أثناء معالجة النص",
             parse_mode='HTML'
         )
 
-def convert_text_to_speech(user_id, voice_id, text, context):
-    """تحويل النص إلى صوت باستخدام API (مُحسّن)"""
+class TTSError(Exception):
+    """فشل Speechify في توليد الصوت (مع رسالة الخطأ من API)"""
+
+
+def synthesize_speech(voice_id, text, audio_format, hedge=True):
+    """طلب واحد إلى Speechify (مع طلب احتياطي للنصوص القصيرة) وإرجاع بايتات الصوت
+
+    hedge=False داخل مهام المنفذ المشترك: الطلب الاحتياطي يحتاج خيوطه هو أيضاً
+    """
+    def open_stream():
+        return _open_tts_stream(voice_id, text, audio_format)
+
+    if hedge and tts_hedger.eligible(text):
+        response, stream, first_chunk = tts_hedger.call(open_stream, _close_tts_stream)
+    else:
+        response, stream, first_chunk = open_stream()
+
+    # مهلة requests لكل قراءة وليست للرد كاملاً، فنفحص الميزانية مع كل جزء
+    chunks = [first_chunk]
+    with response:
+        for chunk in stream:
+            deadline.check('speechify')
+            if chunk:
+                chunks.append(chunk)
+    audio = b''.join(chunks)
+    metrics.incr(f'tts.bytes.{audio_format}', len(audio))
+    metrics.incr(f'tts.responses.{audio_format}')
+    metrics.incr('tts.synthesized_chars', len(text))
+    return audio
+
+
+def _open_tts_stream(voice_id, text, audio_format):
+    """فتح طلب التوليد وقراءة أول جزء (لقياس زمن أول بايت)"""
+    start = time.perf_counter()
+    spec = output_format_policy.spec(audio_format)
+    payload = {
+        "input": text,
+        "voice_id": voice_id,
+        "output_format": audio_format,
+        "model": "simba-multilingual"  # <-- هذا الحقل ضروري لبعض APIs
+    }
+
+    # إرسال الطلب مع الرؤوس المطلوبة
+    response = session.post(
+        f'{SPEECHIFY_API_URL}/v1/audio/stream',
+        headers={
+            'Authorization': f'Bearer {os.getenv("SPEECHIFY_API_KEY")}',
+            'Content-Type': 'application/json',
+            'Accept': spec['accept']
+        },
+        json=payload,
+        stream=True,  # للتعامل مع البيانات الكبيرة
+        timeout=deadline.timeout(30, 'speechify')
+    )
+
+    if response.status_code != 200:
+        try:
+            raise TTSError(response.json().get('message', response.text))
+        finally:
+            response.close()
+
+    stream = response.iter_content(chunk_size=4096)
     try:
-        # إعداد بيانات الطلب كما في الكود الأول
-        payload = {
-            "input": text,
-            "voice_id": voice_id,
-            "output_format": "mp3",
-            "model": "simba-multilingual"  # <-- هذا الحقل ضروري لبعض APIs
-        }
+        first_chunk = next(stream, b'')
+    except Exception:
+        response.close()
+        raise
+    metrics.observe('tts.first_byte', time.perf_counter() - start)
+    return response, stream, first_chunk
 
-        # إرسال الطلب مع الرؤوس المطلوبة
-        response = session.post(
-            'https://api.sws.speechify.com/v1/audio/stream',  # نفس عنوان الكود الأول
-            headers={
-                'Authorization': f'Bearer {os.getenv("SPEECHIFY_API_KEY")}',
-                'Content-Type': 'application/json',
-                'Accept': 'audio/mpeg'  # مهم لاستقبال الصوت كـ MP3
-            },
-            json=payload,
-            stream=True,  # للتعامل مع البيانات الكبيرة
-            timeout=30
-        )
 
-        if response.status_code == 200:
-            # حفظ الصوت في ملف مؤقت كما في الكود الأول
-            temp_audio = tempfile.NamedTemporaryFile(suffix='.mp3', delete=False)
-            for chunk in response.iter_content(chunk_size=4096):
-                if chunk:
-                    temp_audio.write(chunk)
-            temp_audio.close()
+def _close_tts_stream(result):
+    response, _, _ = result
+    response.close()
+
 
-            return open(temp_audio.name, 'rb')  # إرجاع الملف للاستخدام
+def convert_text_to_speech(user_id, voice_id, text, context, audio_format='ogg'):
+    """تحويل النص إلى صوت باستخدام API (مُحسّن)"""
+    try:
+        spec = output_format_policy.spec(audio_format)
 
+        # الصيغ القابلة للدمج تُقسم إلى جمل فلا يُولد إلا الجديد منها،
+        # أما OGG/Opus فتُخزن كنص كامل لأن دمج تدفقاتها لا ينتج ملفاً صالحاً
+        if spec['concatenable']:
+            segments = split_sentences(text) or [text.strip()]
         else:
-            error_msg = response.json().get('message', response.text)
-            context.bot.send_message(
-                chat_id=user_id,
-                text=f"❌ فشل تحويل النص: {error_msg}",
-                parse_mode='HTML'
-            )
-            return None
+            segments = [text.strip()]
 
+        audio = segment_cache.synthesize(
+            voice_id,
+            audio_format,
+            segments,
+            lambda sentence, parallel: synthesize_speech(voice_id, sentence, audio_format, hedge=not parallel)
+        )
+
+        audio_file = io.BytesIO(audio)
+        audio_file.name = f'voice{spec["suffix"]}'
+        return audio_file
+
+    except DeadlineExceeded:
+        raise
+    except TTSError as e:
+        message_sender.send_message(
+            context.bot,
+            user_id,
+            f"❌ فشل تحويل النص: {str(e)}",
+            parse_mode='HTML'
+        )
+        return None
     except Exception as e:
         logger.error(f"فشل تحويل النص إلى صوت: {str(e)}", exc_info=True)
         return None
@@ -517,9 +812,10 @@ def convert_text_to_speech(user_id, voice_id, text, context):
 def handle_callback_query(update, context):
     """معالجة ضغطات الأزرار"""
     query = update.callback_query
-    query.answer()
-    
     data = query.data
+
+    # إجراءات المشرف قد تطول (إحصائيات، عمليات جماعية) فيُجاب الزر فوراً بطلب مستقل
+    message_sender.answer_callback_query(query, inline=not data.startswith('admin_'))
     
     if data.startswith('admin_'):
         admin_panel.handle_admin_actions(update, context)
@@ -540,32 +836,37 @@ def handle_premium_callback(update, context):
     if action == 'monthly':
         # تفعيل اشتراك شهري
         if premium_manager.activate_premium(user_id):
-            query.edit_message_text(
-                text="✅ تم تفعيل الاشتراك المميز بنجاح!",
+            message_sender.edit_message_text(
+                query,
+                "✅ تم تفعيل الاشتراك المميز بنجاح!",
                 parse_mode='HTML'
             )
         else:
-            query.edit_message_text(
-                text="❌ فشل في التفعيل، يرجى المحاولة لاحقاً",
+            message_sender.edit_message_text(
+                query,
+                "❌ فشل في التفعيل، يرجى المحاولة لاحقاً",
                 parse_mode='HTML'
             )
     elif action == 'trial':
         # تفعيل تجربة مجانية
         if premium_manager.activate_premium(user_id, is_trial=True):
-            query.edit_message_text(
-                text="🎁 تم تفعيل التجربة المجانية بنجاح!",
+            message_sender.edit_message_text(
+                query,
+                "🎁 تم تفعيل التجربة المجانية بنجاح!",
                 parse_mode='HTML'
             )
         else:
-            query.edit_message_text(
-                text="❌ فشل في تفعيل التجربة",
+            message_sender.edit_message_text(
+                query,
+                "❌ فشل في تفعيل التجربة",
                 parse_mode='HTML'
             )
     elif action == 'info':
         # عرض معلومات الاشتراك
         message = premium_manager.get_info_message(user_id)
-        query.edit_message_text(
-            text=message,
+        message_sender.edit_message_text(
+            query,
+            message,
             parse_mode='HTML',
             reply_markup=premium_manager.get_upgrade_keyboard(user_id)
         )
@@ -575,17 +876,225 @@ def handle_premium_callback(update, context):
 def index():
     return "Bot is running!"
 
+def require_debug_token():
+    """حماية مسارات التصحيح برمز DEBUG_TOKEN"""
+    token = os.getenv('DEBUG_TOKEN')
+    if not token or request.headers.get('X-Debug-Token') != token:
+        abort(403)
+
+@app.route('/debug/metrics')
+def debug_metrics():
+    """القياسات الحالية للعامل (مع إحصائيات مجمعات الاتصال)"""
+    require_debug_token()
+    snapshot = metrics.snapshot()
+    snapshot['http_pools'] = pool_stats()
+    snapshot['http_pool_size'] = pool_size()
+    snapshot['tts_hedging'] = tts_hedger.stats()
+    return jsonify(snapshot)
+
+@app.route('/debug/shards')
+def debug_shards():
+    """حمل كل جزء محلي وحالة حلقة العقد"""
+    require_debug_token()
+    if not shard_workers:
+        return jsonify({'enabled': False})
+    return jsonify({'enabled': True, 'shards': shard_workers.stats(), 'ring': shard_router.stats()})
+
+@app.route('/debug/profile')
+def debug_profile():
+    """عينات مكدسات كل الخيوط بصيغة collapsed (flamegraph.pl / speedscope)"""
+    require_debug_token()
+    seconds = request.args.get('seconds', 10.0, type=float)
+    hz = request.args.get('hz', 100, type=int)
+    try:
+        stacks = profiler.sampler.sample(seconds, hz)
+    except profiler.ProfileBusy:
+        return jsonify({'error': 'profile already running'}), 409
+    return app.response_class(profiler.format_collapsed(stacks), mimetype='text/plain')
+
+@app.route('/debug/memory')
+def debug_memory():
+    """حالة tracemalloc وإحصائيات الذاكرة لكل معالج"""
+    require_debug_token()
+    return jsonify(memory.tracker.stats())
+
+@app.route('/debug/memory/<action>', methods=['POST'])
+def debug_memory_toggle(action):
+    """تشغيل أو إيقاف tracemalloc (يبطئ التخصيصات أثناء عمله)"""
+    require_debug_token()
+    if action == 'start':
+        changed = memory.tracker.start(request.args.get('frames', type=int))
+    elif action == 'stop':
+        changed = memory.tracker.stop()
+    else:
+        abort(404)
+    return jsonify({'changed': changed, 'tracing': memory.tracker.stats()['tracing']})
+
+@app.route('/debug/memory/snapshots', methods=['POST'])
+def debug_memory_snapshot():
+    """أخذ لقطة وإرجاع أكبر مواقع التخصيص والفرق عن اللقطة السابقة"""
+    require_debug_token()
+    limit = request.args.get('limit', 20, type=int)
+    previous = memory.tracker.snapshot_names()
+    try:
+        name = memory.tracker.take_snapshot(request.args.get('name'))
+    except RuntimeError:
+        return jsonify({'error': 'tracemalloc is not tracing'}), 409
+    result = {'name': name, 'top': memory.tracker.top(name, limit)}
+    previous = [snapshot for snapshot in previous if snapshot != name]
+    if previous:
+        result['diff_from'] = previous[-1]
+        result['diff'] = memory.tracker.diff(previous[-1], name, limit)
+    return jsonify(result)
+
+@app.route('/debug/memory/diff')
+def debug_memory_diff():
+    """الفرق بين لقطتين محفوظتين (?old=&new=&limit=&key=lineno|filename|traceback)"""
+    require_debug_token()
+    key_type = request.args.get('key', 'lineno')
+    if key_type not in ('lineno', 'filename', 'traceback'):
+        abort(400)
+    try:
+        diff = memory.tracker.diff(
+            request.args.get('old', ''), request.args.get('new', ''),
+            request.args.get('limit', 20, type=int), key_type
+        )
+    except KeyError:
+        abort(404)
+    return jsonify({'diff': diff})
+
+@app.route('/debug/memory/snapshots/<name>')
+def debug_memory_download(name):
+    """تنزيل لقطة بصيغة tracemalloc.Snapshot.load للتحليل خارج الخادم"""
+    require_debug_token()
+    try:
+        path = memory.tracker.dump(name)
+    except KeyError:
+        abort(404)
+    return send_file(path, mimetype='application/octet-stream', as_attachment=True,
+                     download_name=os.path.basename(path))
+
+@app.route('/internal/shard', methods=['POST'])
+def shard_forwarded():
+    """تحديث محول من عقدة أخرى لأن هذه العقدة مالكة المستخدم"""
+    if not shard_router or not shard_router.TOKEN or request.headers.get('X-Shard-Token') != shard_router.TOKEN:
+        abort(403)
+    with deadline.budget():
+        return _handle_webhook_payload(route=False)
+
 @app.route(f'/{os.getenv("TELEGRAM_BOT_TOKEN")}', methods=['POST'])
 def webhook():
     """معالجة طلبات الويب هوك"""
+    # الميزانية تبدأ من وصول الطلب وتشمل كل الاستدعاءات التالية
+    with deadline.budget():
+        return _handle_webhook_payload()
+
+def _handle_webhook_payload(route=True):
     try:
-        update = Update.de_json(request.get_json(), bot)
-        dispatcher.process_update(update)
+        payload = fastpath.loads(request.get_data())
+    except ValueError:
+        payload = None
+    if not isinstance(payload, dict):
+        payload = {}
+    update_id = payload.get('update_id')
+    if trace_recorder and route:
+        trace_recorder.record(payload)
+
+    # لا معالج سيأخذ التحديث: يكفي تسجيل النشاط (ما يفعله track_activity)
+    if fast_router and not fast_router.decide(payload):
+        activity_tracker.record(fast_router.sender_id(payload))
+        return jsonify({'status': 'ok'}), 200
+
+    # المستخدم تملكه عقدة أخرى: تحويله إليها (ومعالجته محلياً إن تعذر الاتصال بها)
+    if route and shard_router:
+        node = shard_router.owner(user_key(payload))
+        if node:
+            try:
+                response = shard_router.forward(node, payload)
+            except requests.RequestException:
+                # ربما استلمته المالكة: إعادة الإرسال من تيليجرام تصلها وتمر بحجوزاتها
+                return jsonify({'status': 'error'}), 500
+            if response is not None:
+                # رد العقدة المالكة كما هو (قد يحمل استدعاء رد الويب هوك، أو 500 لإعادة الإرسال)
+                return app.response_class(response.content, status=response.status_code, mimetype='application/json')
+
+    # تيليجرام يعيد إرسال التحديث إذا تأخر الرد، فنؤكد استلام المكرر فوراً
+    if not update_deduplicator.claim(update_id):
+        return jsonify({'status': 'ok'}), 200
+
+    try:
+        update = Update.de_json(payload, bot)
+        # المحول يُعالج قبل الرد أيضاً: فشل كتابات التحديث يصل للعقدة المصدر (500) فتعيده
+        # تيليجرام، والمكرر يصل لهذه العقدة نفسها فيمر بحجوزاتها
+        with webhook_reply.slot() as reply:
+            if shard_workers:
+                # الانتظار يحافظ على دلالة الرد (500 عند الفشل) وعلى ترتيب رسائل المستخدم
+                future = shard_workers.submit(user_key(payload), webhook_reply.bind(dispatch_with_reply), update)
+                left = deadline.remaining()
+                try:
+                    future.result(timeout=None if left is None else max(0.0, left))
+                except FuturesTimeout:
+                    if not reply.detach():
+                        future.result()
+                    else:
+                        # جزء عالق أو مزدحم: لا يُحجز خيط الطلب، والحجز يبقى لأن المعالجة مستمرة
+                        metrics.incr('shard.result_timeout')
+                        logger.warning(f"⏱ انتهت الميزانية قبل معالجة التحديث {update_id} في جزئه")
+                        return jsonify({'status': 'ok'}), 200
+            else:
+                dispatch_update(update)
+        # رد وحيد وضعه المعالج في جسم الاستجابة: تيليجرام ينفذه دون طلب صادر
+        inline = reply.payload()
+        if inline and not reply.expired():
+            return jsonify(inline), 200
+        if inline:
+            # معالجة طويلة: قد تكون تيليجرام تخلت عن الطلب فيضيع جسم الرد، والتحديث
+            # المعاد يرفضه منع التكرار؛ فيُرسل الرد بطلب صادر
+            send_reserved_reply(reply)
         return jsonify({'status': 'ok'}), 200
     except Exception as e:
         logger.error(f"خطأ في الويب هوك: {str(e)}")
+        update_deduplicator.release(update_id)
         return jsonify({'status': 'error'}), 500
 
+def send_reserved_reply(reply):
+    """إرسال استدعاء رد الويب هوك المحجوز بطلب صادر بمهلة مستقلة قصيرة"""
+    try:
+        with deadline.budget(get_env('BUSY_REPLY_TIMEOUT', 5.0, float)):
+            message_sender.send_reserved(bot, reply)
+    except Exception as e:
+        logger.error(f"❌ فشل إرسال الرد المحجوز ({reply.method}): {str(e)}")
+
+def dispatch_with_reply(update):
+    """تنفيذ التحديث على خيط الجزء؛ إن توقف خيط الطلب عن انتظاره يُرسل الرد المحجوز هنا"""
+    reply = webhook_reply.current()
+    try:
+        dispatch_update(update)
+    finally:
+        if reply is not None and reply.finish() and reply.payload():
+            send_reserved_reply(reply)
+
+def dispatch_update(update):
+    """تنفيذ معالجات التحديث مع تجميع كتابات Firebase في كتابة واحدة
+
+    الاستثناء الوحيد: الكتابات الشرطية (ETag) على الاشتراك وتوابعها (write_committed)
+    تُنفذ فوراً لأن الشرط لا يُجمع مع تحديث متعدد المسارات.
+    """
+    with firebase_manager.unit_of_work():
+        dispatcher.process_update(update)
+
+def process_polled_update(update):
+    """معالجة تحديث مستلم عبر getUpdates"""
+    # قد تُعاد الدفعة بعد انقطاع قبل تأكيد الإزاحة
+    if not update_deduplicator.claim(update.update_id):
+        return
+    try:
+        with deadline.budget():
+            dispatch_update(update)
+    except Exception:
+        update_deduplicator.release(update.update_id)
+        raise
+
 # --- تشغيل التطبيق ---
 app = initialize_bot()
 
@@ -593,5 +1102,9 @@ def create_app():
     return app
 
 if __name__ == '__main__':
-    port = int(os.getenv('PORT', 5000))
-    app.run(host='0.0.0.0', port=port)
+    if BOT_MODE == 'polling':
+        from polling import PollingRunner
+        PollingRunner(bot, process_polled_update).run()
+    else:
+        port = int(os.getenv('PORT', 5000))
+        app.run(host='0.0.0.0', port=port)
@@ -0,0 +1,124 @@
+"""أوامر صيانة قاعدة البيانات
+
+الاستخدام:
+    python manage.py backfill-usernames [--batch-size N]
+    python manage.py activity-report [--cohort YYYY-MM-DD] [--days N]
+    python manage.py prune-activity [--retention-days N]
+    python manage.py backfill-hot-mirror [--batch-size N]
+    python manage.py recount-premium [--batch-size N]
+    python manage.py export OUTPUT [--format ndjson|csv] [--gzip] [--fields a,b.c] [--checkpoint FILE]
+"""
+import sys
+import logging
+import argparse
+from datetime import datetime, timedelta, timezone
+
+logging.basicConfig(
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+    level=logging.INFO
+)
+logger = logging.getLogger(__name__)
+
+
+def _firebase():
+    from firebase import FirebaseManager
+    return FirebaseManager()
+
+
+def backfill_usernames(args):
+    """بناء فهرس usernames للمستخدمين الحاليين"""
+    indexed = _firebase().backfill_username_index(batch_size=args.batch_size)
+    print(f"تمت فهرسة {indexed} اسم مستخدم")
+
+
+def backfill_hot_mirror(args):
+    """نسخ حقول الحصص إلى user_quota للمستخدمين الحاليين (users/<id> لا يتغير)"""
+    migrated = _firebase().backfill_hot_mirror(batch_size=args.batch_size)
+    print(f"تم نقل {migrated} مستخدم")
+
+
+def recount_premium(args):
+    """إعادة حساب العدادات stats/ (المستخدمون، المميزون، الأحرف) من بيانات المستخدمين"""
+    stats = _firebase().recount_stats(page_size=args.batch_size)
+    print(f"المستخدمون: {stats['users']} | المميزون: {stats['premium_users']} | الأحرف: {stats['total_chars']}")
+
+
+def activity_report(args):
+    """عرض DAU/WAU/MAU ومنحنى الاحتفاظ"""
+    from activity import ActivityTracker
+    tracker = ActivityTracker(_firebase())
+
+    print(f"DAU: {tracker.daily_active()}")
+    print(f"WAU: {tracker.weekly_active()}")
+    print(f"MAU: {tracker.monthly_active()}")
+
+    cohort = (datetime.strptime(args.cohort, '%Y-%m-%d').date() if args.cohort
+              else datetime.now(timezone.utc).date() - timedelta(days=args.days))
+    curve = tracker.retention(cohort, days=args.days)
+    print(f"الاحتفاظ لمجموعة {cohort}: " + (', '.join(f'D{i}={r:.1%}' for i, r in enumerate(curve, 1)) or 'لا توجد بيانات'))
+
+
+def prune_activity(args):
+    """حذف عُقد النشاط الأقدم من مدة الاحتفاظ"""
+    from activity import ActivityTracker
+    removed = ActivityTracker(_firebase()).prune(args.retention_days)
+    print(f"تم حذف {removed} عقدة")
+
+
+def export(args):
+    """تصدير المستخدمين إلى ملف"""
+    from export import export_users
+    fields = [f.strip() for f in args.fields.split(',') if f.strip()] if args.fields else None
+    result = export_users(
+        _firebase(),
+        args.output,
+        fmt=args.format,
+        fields=fields,
+        compress=args.gzip,
+        checkpoint=args.checkpoint,
+        page_size=args.page_size
+    )
+    print(f"تم تصدير {result['records']:,} سجل ({result['records_per_second']:,.0f} سجل/ث)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='أوامر صيانة البوت')
+    sub = parser.add_subparsers(dest='command', required=True)
+
+    backfill = sub.add_parser('backfill-usernames', help='بناء فهرس usernames -> user_id')
+    backfill.add_argument('--batch-size', type=int, default=500)
+    backfill.set_defaults(func=backfill_usernames)
+
+    migrate = sub.add_parser('backfill-hot-mirror', aliases=['migrate-hot-nodes'],
+                             help='بناء نسخة الحصص المختصرة user_quota (نسخة وليست نقلاً)')
+    migrate.add_argument('--batch-size', type=int, default=500)
+    migrate.set_defaults(func=backfill_hot_mirror)
+
+    recount = sub.add_parser('recount-premium', help='إعادة حساب العدادات المجمعة (المستخدمون، المميزون، الأحرف)')
+    recount.add_argument('--batch-size', type=int, default=500)
+    recount.set_defaults(func=recount_premium)
+
+    report = sub.add_parser('activity-report', help='المستخدمون النشطون ومنحنى الاحتفاظ')
+    report.add_argument('--cohort', help='يوم مجموعة الانضمام (YYYY-MM-DD)')
+    report.add_argument('--days', type=int, default=7)
+    report.set_defaults(func=activity_report)
+
+    prune = sub.add_parser('prune-activity', help='حذف عُقد النشاط القديمة')
+    prune.add_argument('--retention-days', type=int)
+    prune.set_defaults(func=prune_activity)
+
+    exp = sub.add_parser('export', help='تصدير المستخدمين إلى NDJSON أو CSV')
+    exp.add_argument('output')
+    exp.add_argument('--format', choices=['ndjson', 'csv'], default='ndjson')
+    exp.add_argument('--gzip', action='store_true')
+    exp.add_argument('--fields', help='الحقول مفصولة بفواصل (مثال: id,premium.is_premium)')
+    exp.add_argument('--checkpoint', help='ملف نقطة الاستئناف')
+    exp.add_argument('--page-size', type=int, default=500)
+    exp.set_defaults(func=export)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
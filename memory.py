@@ -0,0 +1,204 @@
+import os
+import re
+import sys
+import time
+import logging
+import functools
+import threading
+import tracemalloc
+from config import get_env
+from metrics import metrics
+
+try:
+    import resource
+except ImportError:  # غير متوفر على Windows
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# إطارات tracemalloc نفسه لا تفيد في التقارير
+_SNAPSHOT_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+_UNSAFE_NAME = re.compile(r'[^\w.-]')
+
+
+def _max_rss_kb():
+    """أعلى RSS وصلت إليه العملية (KB)"""
+    if resource is None:
+        return 0
+    value = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS يعيد القيمة بالبايت
+    return value // 1024 if sys.platform == 'darwin' else value
+
+
+def _stat_dict(stat):
+    frame = stat.traceback[0]
+    return {
+        'where': f'{frame.filename}:{frame.lineno}',
+        'size_kb': round(stat.size / 1024, 1),
+        'count': stat.count
+    }
+
+
+def _diff_dict(stat):
+    result = _stat_dict(stat)
+    result['size_diff_kb'] = round(stat.size_diff / 1024, 1)
+    result['count_diff'] = stat.count_diff
+    return result
+
+
+class MemoryTracker:
+    """لقطات tracemalloc عند الطلب وإحصائيات الذاكرة لكل معالج"""
+
+    def __init__(self):
+        self.FRAMES = get_env('MEMORY_TRACE_FRAMES', 10, int)
+        self.MAX_SNAPSHOTS = get_env('MEMORY_MAX_SNAPSHOTS', 5, int)
+        self.SNAPSHOT_DIR = get_env('MEMORY_SNAPSHOT_DIR', '/tmp')
+        self._lock = threading.Lock()
+        self._snapshots = {}
+        self._handlers = {}
+        # الذروة تُنسب لمعالج فقط إذا لم يبدأ غيره أثناء تنفيذه
+        self._running = 0
+        self._starts = 0
+
+    # --- tracemalloc ---
+    def start(self, frames=None):
+        if tracemalloc.is_tracing():
+            return False
+        tracemalloc.start(frames or self.FRAMES)
+        logger.info(f"🧠 بدء تتبع الذاكرة (tracemalloc) بعمق {frames or self.FRAMES} إطار")
+        return True
+
+    def stop(self):
+        if not tracemalloc.is_tracing():
+            return False
+        tracemalloc.stop()
+        with self._lock:
+            # اللقطات القديمة تبقى صالحة، لكن ذروة المعالجات لم تعد تُقاس
+            self._running = 0
+        logger.info("🧠 إيقاف تتبع الذاكرة")
+        return True
+
+    def take_snapshot(self, name=None):
+        """أخذ لقطة وحفظها باسم (تُحذف الأقدم عند تجاوز MAX_SNAPSHOTS)"""
+        if not tracemalloc.is_tracing():
+            raise RuntimeError('tracemalloc is not tracing')
+        snapshot = tracemalloc.take_snapshot().filter_traces(_SNAPSHOT_FILTERS)
+        # الاسم يدخل في مسار ملف التنزيل
+        name = _UNSAFE_NAME.sub('_', name or time.strftime('%Y%m%d-%H%M%S'))
+        with self._lock:
+            self._snapshots.pop(name, None)
+            self._snapshots[name] = snapshot
+            while len(self._snapshots) > self.MAX_SNAPSHOTS:
+                self._snapshots.pop(next(iter(self._snapshots)))
+        metrics.incr('memory.snapshots')
+        return name
+
+    def snapshot_names(self):
+        with self._lock:
+            return list(self._snapshots)
+
+    def _get(self, name):
+        with self._lock:
+            snapshot = self._snapshots.get(name)
+        if snapshot is None:
+            raise KeyError(name)
+        return snapshot
+
+    def top(self, name, limit=20, key_type='lineno'):
+        """أكبر مواقع التخصيص في لقطة"""
+        stats = self._get(name).statistics(key_type)
+        return [_stat_dict(stat) for stat in stats[:limit]]
+
+    def diff(self, old, new, limit=20, key_type='lineno'):
+        """أكبر الفروق بين لقطتين (الأكثر نمواً أولاً)"""
+        stats = self._get(new).compare_to(self._get(old), key_type)
+        return [_diff_dict(stat) for stat in stats[:limit]]
+
+    def dump(self, name):
+        """حفظ اللقطة في ملف يُقرأ بـ tracemalloc.Snapshot.load"""
+        path = os.path.join(self.SNAPSHOT_DIR, f'tracemalloc-{os.getpid()}-{name}.pickle')
+        self._get(name).dump(path)
+        return path
+
+    # --- إحصائيات المعالجات ---
+    def track(self, func):
+        """تغليف معالج لقياس نمو RSS والذاكرة المتبقية وذروة التخصيص أثناءه"""
+        name = func.__name__
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracing = tracemalloc.is_tracing()
+            rss_before = _max_rss_kb()
+            solo = False
+            if tracing:
+                with self._lock:
+                    self._running += 1
+                    self._starts += 1
+                    start_id = self._starts
+                    solo = self._running == 1
+                    if solo:
+                        tracemalloc.reset_peak()
+                current_before = tracemalloc.get_traced_memory()[0]
+            try:
+                return func(*args, **kwargs)
+            finally:
+                traced = None
+                if tracing and tracemalloc.is_tracing():
+                    current, peak = tracemalloc.get_traced_memory()
+                    with self._lock:
+                        solo = solo and self._starts == start_id
+                        self._running = max(0, self._running - 1)
+                    traced = (current - current_before, peak - current_before if solo else None)
+                self._record(name, _max_rss_kb() - rss_before, traced)
+        return wrapper
+
+    def _record(self, name, rss_growth_kb, traced):
+        with self._lock:
+            stats = self._handlers.get(name)
+            if stats is None:
+                stats = self._handlers[name] = {
+                    'calls': 0,
+                    'rss_growth_kb': 0,
+                    'rss_growth_calls': 0,
+                    'retained_kb': 0.0,
+                    'peak_kb': 0.0,
+                    'peak_samples': 0
+                }
+            stats['calls'] += 1
+            if rss_growth_kb > 0:
+                # المعالج الذي رفع أعلى RSS للعملية
+                stats['rss_growth_kb'] += rss_growth_kb
+                stats['rss_growth_calls'] += 1
+            if traced is not None:
+                retained, peak = traced
+                stats['retained_kb'] += retained / 1024
+                if peak is not None:
+                    stats['peak_kb'] = max(stats['peak_kb'], peak / 1024)
+                    stats['peak_samples'] += 1
+
+    def stats(self):
+        tracing = tracemalloc.is_tracing()
+        current, peak = tracemalloc.get_traced_memory() if tracing else (0, 0)
+        with self._lock:
+            handlers = {
+                name: dict(values, retained_kb=round(values['retained_kb'], 1), peak_kb=round(values['peak_kb'], 1))
+                for name, values in self._handlers.items()
+            }
+            snapshots = list(self._snapshots)
+        return {
+            'tracing': tracing,
+            'traced_kb': round(current / 1024, 1),
+            'traced_peak_kb': round(peak / 1024, 1),
+            'max_rss_kb': _max_rss_kb(),
+            'snapshots': snapshots,
+            'handlers': handlers
+        }
+
+
+tracker = MemoryTracker()
@@ -0,0 +1,209 @@
+import time
+import math
+import logging
+import threading
+from collections import OrderedDict
+from telegram.error import RetryAfter
+from config import get_env
+from metrics import metrics
+import deadline
+import webhook_reply
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """دلو رموز لتحديد معدل الإرسال"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def reserve(self):
+        """حجز رمز وإرجاع مدة الانتظار اللازمة قبل استخدامه"""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.rate
+
+    def refund(self):
+        """إعادة رمز محجوز لم يُستخدم"""
+        self.tokens = min(self.capacity, self.tokens + 1)
+
+
+class MessageSender:
+    """طبقة موحدة لكل الرسائل الصادرة إلى تيليجرام"""
+
+    MAX_TRACKED_CHATS = 10000
+
+    def __init__(self):
+        self.GLOBAL_RATE = get_env('TG_GLOBAL_RATE', 30.0, float)
+        self.CHAT_RATE = get_env('TG_CHAT_RATE', 1.0, float)
+        self.CHAT_BURST = get_env('TG_CHAT_BURST', 3, int)
+        self.MAX_WAIT = get_env('TG_MAX_THROTTLE_WAIT', 10.0, float)
+        self.MAX_RETRIES = get_env('TG_MAX_RETRIES', 2, int)
+        self.DEDUPE_WINDOW = get_env('TG_DEDUPE_WINDOW', 300.0, float)
+
+        self._lock = threading.Lock()
+        self._global_bucket = TokenBucket(self.GLOBAL_RATE, self.GLOBAL_RATE)
+        self._chat_buckets = OrderedDict()
+        self._recent = OrderedDict()
+        self._paused_until = 0.0
+        logger.info(
+            f"✅ تم تهيئة مرسل الرسائل | عام: {self.GLOBAL_RATE}/ث | لكل محادثة: {self.CHAT_RATE}/ث"
+        )
+
+    def _chat_bucket(self, chat_id):
+        """دلو المحادثة (مع حد أقصى لعدد المحادثات المتتبعة)"""
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.CHAT_RATE, self.CHAT_BURST)
+            if len(self._chat_buckets) > self.MAX_TRACKED_CHATS:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    def _throttle(self, chat_id):
+        """الانتظار حتى يسمح الدلو العام ودلو المحادثة بالإرسال
+
+        إذا تجاوز الانتظار MAX_WAIT أو ميزانية التحديث لا يُرسل شيء (RetryAfter أو
+        DeadlineExceeded) وتُعاد الرموز المحجوزة، فلا يُتجاوز الحد أبداً.
+        """
+        left = deadline.remaining()
+        with self._lock:
+            chat_bucket = self._chat_bucket(chat_id)
+            wait = max(
+                self._global_bucket.reserve(),
+                chat_bucket.reserve(),
+                self._paused_until - time.monotonic()
+            )
+            rejected = wait > self.MAX_WAIT or (wait > 0 and left is not None and wait >= left)
+            if rejected:
+                self._global_bucket.refund()
+                chat_bucket.refund()
+        if wait > self.MAX_WAIT:
+            metrics.incr('telegram.throttle_rejected')
+            raise RetryAfter(math.ceil(wait))
+        if rejected:
+            deadline.expire('telegram')
+        if wait > 0:
+            metrics.observe('telegram.throttle_delay', wait)
+            time.sleep(wait)
+
+    def _claim_dedupe(self, chat_id, dedupe_key):
+        """تسجيل الرسالة، وإرجاع False إذا أُرسلت نفسها مؤخراً"""
+        key = (chat_id, dedupe_key)
+        now = time.monotonic()
+        with self._lock:
+            while self._recent and next(iter(self._recent.values())) < now - self.DEDUPE_WINDOW:
+                self._recent.popitem(last=False)
+            if key in self._recent:
+                return False
+            self._recent[key] = now
+            return True
+
+    def _release_dedupe(self, chat_id, dedupe_key):
+        with self._lock:
+            self._recent.pop((chat_id, dedupe_key), None)
+
+    def call(self, func, chat_id, *args, dedupe_key=None, **kwargs):
+        """تنفيذ استدعاء إرسال مع تحديد المعدل واحترام retry_after"""
+        if dedupe_key and not self._claim_dedupe(chat_id, dedupe_key):
+            metrics.incr('telegram.deduplicated')
+            logger.debug(f"تم تجاهل رسالة مكررة ({dedupe_key}) للمحادثة {chat_id}")
+            return None
+
+        try:
+            for attempt in range(self.MAX_RETRIES + 1):
+                self._throttle(chat_id)
+                # مهلة الطلب لا تتجاوز المتبقي من ميزانية التحديث
+                left = deadline.timeout(None, 'telegram')
+                call_kwargs = kwargs if left is None else {'timeout': left, **kwargs}
+                start = time.perf_counter()
+                try:
+                    result = func(*args, **call_kwargs)
+                    metrics.observe('telegram.send_latency', time.perf_counter() - start)
+                    metrics.incr('telegram.sent')
+                    return result
+                except RetryAfter as e:
+                    metrics.incr('telegram.retry_after')
+                    if attempt >= self.MAX_RETRIES or e.retry_after > self.MAX_WAIT:
+                        raise
+                    logger.warning(f"⚠️ تجاوز حد تيليجرام، الانتظار {e.retry_after} ثانية (المحادثة {chat_id})")
+                    with self._lock:
+                        self._paused_until = max(self._paused_until, time.monotonic() + e.retry_after)
+        except Exception:
+            if dedupe_key:
+                self._release_dedupe(chat_id, dedupe_key)
+            metrics.incr('telegram.failed')
+            raise
+
+    def _reply_inline(self, method, chat_id, params, dedupe_key=None):
+        """إعادة الاستدعاء في جسم رد الويب هوك بدلاً من طلب صادر
+
+        تيليجرام لا يعيد نتيجته، فيُستخدم فقط لرد وحيد لا يُبنى عليه ولا يتبعه إرسال آخر.
+        """
+        if dedupe_key and not self._claim_dedupe(chat_id, dedupe_key):
+            metrics.incr('telegram.deduplicated')
+            return None
+        # يخضع لنفس حدود الإرسال لأن تيليجرام يحتسبه كرسالة صادرة
+        self._throttle(chat_id)
+        webhook_reply.put(method, params)
+        metrics.incr('telegram.inline')
+        return None
+
+    def send_reserved(self, bot, reply):
+        """تنفيذ الاستدعاء المحجوز في رد الويب هوك كطلب صادر (تأخرت المعالجة)
+
+        أسماء Bot API (sendMessage) متوفرة كأسماء بديلة في Bot.
+        """
+        metrics.incr('telegram.inline_fallback')
+        return self.call(getattr(bot, reply.method), reply.kwargs.get('chat_id'), **reply.kwargs)
+
+    def send_message(self, bot, chat_id, text, dedupe_key=None, inline=False, **kwargs):
+        """إرسال رسالة نصية
+
+        inline=True: في رد الويب هوك إن كان متاحاً (لا تُعاد كائن Message)
+        """
+        if inline and webhook_reply.available():
+            return self._reply_inline('sendMessage', chat_id, {'chat_id': chat_id, 'text': text, **kwargs}, dedupe_key)
+        return self.call(bot.send_message, chat_id, dedupe_key=dedupe_key,
+                         chat_id=chat_id, text=text, **kwargs)
+
+    def answer_callback_query(self, query, inline=False, **kwargs):
+        """إيقاف مؤشر التحميل على الزر (في رد الويب هوك عند inline=True)
+
+        الإجابة ليست رسالة فلا تخضع لحدود الإرسال.
+        """
+        if inline and webhook_reply.available():
+            webhook_reply.put('answerCallbackQuery', {'callback_query_id': query.id, **kwargs})
+            metrics.incr('telegram.inline')
+            return None
+        return query.answer(**kwargs)
+
+    def send_voice(self, bot, chat_id, voice, **kwargs):
+        """إرسال رسالة صوتية"""
+        def attempt(**extra):
+            # إعادة المؤشر لبداية الملف حتى تُرسل المحاولة التالية كامل الصوت
+            if hasattr(voice, 'seek'):
+                voice.seek(0)
+            return bot.send_voice(chat_id=chat_id, voice=voice, **kwargs, **extra)
+        return self.call(attempt, chat_id)
+
+    def reply_text(self, message, text, **kwargs):
+        """الرد على رسالة"""
+        return self.call(message.reply_text, message.chat_id, text, **kwargs)
+
+    def edit_message_text(self, query, text, **kwargs):
+        """تعديل نص رسالة زر"""
+        return self.call(query.edit_message_text, query.message.chat_id, text=text, **kwargs)
+
+    def edit_text(self, message, text, **kwargs):
+        """تعديل نص رسالة مرسلة"""
+        return self.call(message.edit_text, message.chat_id, text, **kwargs)
@@ -0,0 +1,89 @@
+import time
+import threading
+from collections import deque
+from contextlib import contextmanager
+
+
+class Metrics:
+    """سجل بسيط للعدادات والتوقيتات داخل العملية"""
+
+    def __init__(self, sample_size=1024):
+        self.sample_size = sample_size
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._timings = {}
+
+    def incr(self, name, value=1):
+        """زيادة عداد"""
+        with self._lock:
+            self._counters[name] = self._counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        """تسجيل مدة (بالثواني)"""
+        with self._lock:
+            timing = self._timings.get(name)
+            if timing is None:
+                timing = self._timings[name] = {
+                    'count': 0,
+                    'total': 0.0,
+                    'max': 0.0,
+                    'samples': deque(maxlen=self.sample_size)
+                }
+            timing['count'] += 1
+            timing['total'] += seconds
+            timing['max'] = max(timing['max'], seconds)
+            timing['samples'].append(seconds)
+
+    @contextmanager
+    def timer(self, name):
+        """قياس مدة كتلة من الكود"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def counter(self, name):
+        """قراءة قيمة عداد"""
+        with self._lock:
+            return self._counters.get(name, 0)
+
+    def sample_count(self, name):
+        """عدد العينات المحفوظة لتوقيت"""
+        with self._lock:
+            timing = self._timings.get(name)
+            return len(timing['samples']) if timing else 0
+
+    def percentile(self, name, pct):
+        """حساب نسبة مئوية من العينات الأخيرة"""
+        with self._lock:
+            timing = self._timings.get(name)
+            samples = sorted(timing['samples']) if timing else []
+        if not samples:
+            return None
+        index = min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))
+        return samples[index]
+
+    def snapshot(self):
+        """نسخة من جميع القياسات الحالية"""
+        with self._lock:
+            counters = dict(self._counters)
+            timings = {name: (t['count'], t['total'], t['max'], sorted(t['samples']))
+                       for name, t in self._timings.items()}
+
+        result = {'counters': counters, 'timings': {}}
+        for name, (count, total, maximum, samples) in timings.items():
+            def pick(pct):
+                return samples[min(len(samples) - 1, int(round(pct / 100 * (len(samples) - 1))))] if samples else 0
+            result['timings'][name] = {
+                'count': count,
+                'avg': total / count if count else 0,
+                'max': maximum,
+                'p50': pick(50),
+                'p95': pick(95),
+                'p99': pick(99)
+            }
+        return result
+
+
+metrics = Metrics()
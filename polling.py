@@ -0,0 +1,101 @@
+import time
+import signal
+import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait
+from config import get_env
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class PollingRunner:
+    """تشغيل البوت عبر getUpdates بدفعات كبيرة مع الحفاظ على ترتيب كل محادثة"""
+
+    def __init__(self, bot, handle_update, allowed_updates=None):
+        self.bot = bot
+        self.handle_update = handle_update
+        self.allowed_updates = allowed_updates or ["message", "callback_query"]
+        self.BATCH_SIZE = min(100, get_env('POLL_BATCH_SIZE', 100, int))
+        self.WORKERS = get_env('POLL_WORKERS', 8, int)
+        self.POLL_TIMEOUT = get_env('POLL_TIMEOUT', 30, int)
+        self.offset = None
+        self._stop = threading.Event()
+        self._executor = ThreadPoolExecutor(max_workers=self.WORKERS, thread_name_prefix='poll')
+
+    @staticmethod
+    def _ordering_key(update):
+        """تحديثات نفس المحادثة تُعالج بالتسلسل"""
+        if update.effective_chat:
+            return update.effective_chat.id
+        if update.effective_user:
+            return update.effective_user.id
+        return update.update_id
+
+    def _process_group(self, updates):
+        for update in updates:
+            try:
+                self.handle_update(update)
+            except Exception as e:
+                logger.error(f"❌ فشل معالجة التحديث {update.update_id}: {str(e)}", exc_info=True)
+
+    def process_batch(self, updates):
+        """معالجة دفعة على مجمع الخيوط ثم الانتظار حتى تنتهي كلها"""
+        groups = OrderedDict()
+        for update in updates:
+            groups.setdefault(self._ordering_key(update), []).append(update)
+
+        start = time.perf_counter()
+        futures = [self._executor.submit(self._process_group, group) for group in groups.values()]
+        wait(futures)
+        elapsed = time.perf_counter() - start
+
+        newest = max((u.effective_message.date.timestamp() for u in updates
+                      if u.effective_message and u.effective_message.date), default=None)
+        lag = time.time() - newest if newest else 0.0
+
+        metrics.incr('polling.updates', len(updates))
+        metrics.observe('polling.batch_time', elapsed)
+        metrics.observe('polling.lag', lag)
+        logger.info(
+            f"📥 دفعة: {len(updates)} تحديث | {len(groups)} محادثة | "
+            f"التأخر: {lag:.1f} ث | الإنتاجية: {len(updates) / max(elapsed, 1e-6):,.1f} تحديث/ث"
+        )
+
+    def run(self):
+        """حلقة الاستطلاع (الإزاحة تُؤكد فقط بعد انتهاء معالجة الدفعة)"""
+        self.bot.delete_webhook()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            signal.signal(sig, lambda *_: self.stop())
+        logger.info(f"▶️ بدء الاستطلاع | الدفعة: {self.BATCH_SIZE} | العمال: {self.WORKERS}")
+
+        while not self._stop.is_set():
+            try:
+                updates = self.bot.get_updates(
+                    offset=self.offset,
+                    limit=self.BATCH_SIZE,
+                    timeout=self.POLL_TIMEOUT,
+                    allowed_updates=self.allowed_updates
+                )
+            except Exception as e:
+                logger.error(f"❌ فشل جلب التحديثات: {str(e)}")
+                self._stop.wait(1)
+                continue
+
+            if not updates:
+                continue
+
+            metrics.observe('polling.batch_size', len(updates))
+            self.process_batch(updates)
+            # تأكيد الدفعة في الطلب التالي لـ getUpdates
+            self.offset = updates[-1].update_id + 1
+
+        # تأكيد آخر دفعة قبل الخروج حتى لا تُعاد
+        if self.offset is not None:
+            self.bot.get_updates(offset=self.offset, limit=1, timeout=0)
+        self._executor.shutdown(wait=True)
+        logger.info("⏹ تم إيقاف الاستطلاع")
+
+    def stop(self):
+        self._stop.set()
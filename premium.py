@@ -2,15 +2,20 @@ import os
 from datetime import datetime, timedelta
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ParseMode
 import logging
-from firebase_admin import db
+from config import get_env
+import deadline
+from unit_of_work import increment
 import math
 
 logger = logging.getLogger(__name__)
 
 class PremiumManager:
-    def __init__(self, firebase):
+    INFO_ERROR_MESSAGE = "⚠️ تعذر تحميل معلومات الاشتراك"
+
+    def __init__(self, firebase, cache=None):
         """Initialize Premium Manager with Firebase connection"""
         self.firebase = firebase
+        self.cache = cache
         self._load_config()
         self._validate_config()  # تمت إضافة هذه الدالة
         logger.info("✅ تم تهيئة مدير الاشتراك المميز بنجاح")
@@ -35,6 +40,10 @@ class PremiumManager:
             logger.warning("أحرف التجربة لا يمكن أن تكون سالبة، تم التعيين إلى 0")
             self.TRIAL_CHARS = 0
 
+        self.INFO_CACHE_TTL = self._safe_get_env('PREMIUM_INFO_CACHE_TTL', 60, int)
+        # عدد المستخدمين في كل كتابة متعددة المسارات للعمليات الجماعية
+        self.BULK_CHUNK_SIZE = get_env('BULK_PREMIUM_CHUNK_SIZE', 200, int)
+
     def _validate_config(self):
         """Validates that all premium configuration is properly loaded
         
@@ -67,35 +76,67 @@ class PremiumManager:
             logger.warning(f"قيمة غير صالحة لـ {var_name} ({value}), استخدام الافتراضي: {default}. الخطأ: {str(e)}")
             return default
 
+    def _activation_updates(self, admin_id=None, is_trial=False):
+        """حقول تفعيل الاشتراك (مشتركة بين التفعيل الفردي والجماعي)"""
+        now = datetime.now()
+        if is_trial and self.TRIAL_DAYS > 0:
+            expiry_date = now + timedelta(days=self.TRIAL_DAYS)
+            remaining_chars = self.TRIAL_CHARS
+            plan_type = 'trial'
+        else:
+            expiry_date = now + timedelta(days=30)
+            remaining_chars = self.CHARS_MONTHLY
+            plan_type = 'premium'
+
+        return {
+            'premium': {
+                'is_premium': True,
+                'plan_type': plan_type,
+                'activated_on': {'.sv': 'timestamp'},
+                'expires_on': expiry_date.timestamp(),
+                'remaining_chars': remaining_chars,
+                'total_chars': remaining_chars,
+                'activated_by': 'admin' if admin_id else 'user',
+                'admin_id': admin_id
+            },
+            'voice_cloned': True
+        }
+
+    @staticmethod
+    def _deactivation_updates():
+        return {
+            'premium/is_premium': False,
+            'premium/deactivated_on': {'.sv': 'timestamp'},
+            'premium/remaining_chars': 0
+        }
+
+    @staticmethod
+    def _premium_count_delta(delta):
+        """تعديل العداد الإجمالي stats/premium_users في نفس كتابة المستخدم"""
+        return {'stats/premium_users': increment(delta)} if delta else None
+
+    @staticmethod
+    def _was_premium(previous):
+        return isinstance(previous, dict) and bool(previous.get('is_premium'))
+
     def activate_premium(self, user_id, admin_id=None, is_trial=False):
         """تفعيل اشتراك مميز أو تجريبي"""
         try:
-            now = datetime.now()
-            if is_trial and self.TRIAL_DAYS > 0:
-                expiry_date = now + timedelta(days=self.TRIAL_DAYS)
-                remaining_chars = self.TRIAL_CHARS
-                plan_type = 'trial'
-            else:
-                expiry_date = now + timedelta(days=30)
-                remaining_chars = self.CHARS_MONTHLY
-                plan_type = 'premium'
+            updates = self._activation_updates(admin_id, is_trial)
 
-            updates = {
-                'premium': {
-                    'is_premium': True,
-                    'plan_type': plan_type,
-                    'activated_on': {'.sv': 'timestamp'},
-                    'expires_on': expiry_date.timestamp(),
-                    'remaining_chars': remaining_chars,
-                    'total_chars': remaining_chars,
-                    'activated_by': 'admin' if admin_id else 'user',
-                    'admin_id': admin_id
-                },
-                'voice_cloned': True
-            }
+            # العداد يتبع القيمة التي استبدلتها الكتابة الشرطية، لا قراءة سابقة لها
+            def extra(previous):
+                paths = self.firebase.user_paths(user_id, {'voice_cloned': updates['voice_cloned']})
+                paths.update(self._premium_count_delta(0 if self._was_premium(previous) else 1) or {})
+                return paths
 
-            self.firebase.ref.child('users').child(str(user_id)).update(updates)
-            logger.info(f"تم تفعيل الاشتراك للمستخدم {user_id} (نوع: {plan_type})")
+            written, _ = self.firebase.update_if_unchanged(
+                user_id, 'premium', lambda current: updates['premium'], extra=extra
+            )
+            self._invalidate(user_id)
+            if not written:
+                return False
+            logger.info(f"تم تفعيل الاشتراك للمستخدم {user_id} (نوع: {updates['premium']['plan_type']})")
             return True
         except Exception as e:
             logger.error(f"فشل تفعيل الاشتراك: {str(e)}", exc_info=True)
@@ -104,25 +145,63 @@ class PremiumManager:
     def check_premium_status(self, user_id):
         """التحقق من حالة الاشتراك"""
         try:
-            user_data = self.firebase.get_user_data(user_id) or {}
-            premium = user_data.get('premium', {})
+            premium = self.firebase.get_user_hot(user_id) or {}
             
             if not premium.get('is_premium'):
                 return False
-                
-            if datetime.now().timestamp() > premium.get('expires_on', 0):
-                return self.deactivate_premium(user_id)
-                
-            if (premium.get('plan_type') != 'trial' and 
-                premium.get('remaining_chars', 0) <= 0):
-                return self.deactivate_premium(user_id)
-                
-            return True
+
+            if not self._should_deactivate(premium):
+                return True
+
+            # النسخة المخزنة قد تسبق تجديداً من المشرف، فالإلغاء مشروط بعدم تغير العقدة
+            def deactivate(current):
+                if not isinstance(current, dict) or not self._should_deactivate(current):
+                    return None
+                return {
+                    **current,
+                    'is_premium': False,
+                    'deactivated_on': {'.sv': 'timestamp'},
+                    'remaining_chars': 0
+                }
+
+            # العداد يُنقص في نفس الكتابة الفورية مع نسخة الحصص، لا في وحدة العمل
+            _, current = self.firebase.update_if_unchanged(
+                user_id, 'premium', deactivate, extra=self._premium_count_delta(-1)
+            )
+            self._invalidate(user_id)
+            return bool(isinstance(current, dict) and current.get('is_premium'))
         except Exception as e:
             logger.error(f"خطأ في التحقق من الحالة: {str(e)}", exc_info=True)
             return False
 
+    @staticmethod
+    def _should_deactivate(premium):
+        """انتهت المدة أو نفدت أحرف الاشتراك غير التجريبي"""
+        if not premium.get('is_premium'):
+            return False
+        if datetime.now().timestamp() > premium.get('expires_on', 0):
+            return True
+        return premium.get('plan_type') != 'trial' and premium.get('remaining_chars', 0) <= 0
+
+    def _invalidate(self, user_id):
+        """حذف النسخ المخزنة بعد تعديل اشتراك المستخدم"""
+        self.firebase.invalidate_user(user_id)
+        if self.cache:
+            self.cache.delete(f'premium_info:{user_id}')
+
     def get_info_message(self, user_id):
+        """رسالة معلومات الاشتراك (من الذاكرة المشتركة إن وُجدت)"""
+        if self.cache:
+            cached = self.cache.get(f'premium_info:{user_id}')
+            if cached:
+                return cached
+
+        message = self._render_info_message(user_id)
+        if self.cache and message != self.INFO_ERROR_MESSAGE:
+            self.cache.set(f'premium_info:{user_id}', message, self.INFO_CACHE_TTL)
+        return message
+
+    def _render_info_message(self, user_id):
         """إنشاء رسالة معلومات الاشتراك"""
         try:
             user_data = self.firebase.get_user_data(user_id) or {}
@@ -156,7 +235,7 @@ class PremiumManager:
                 )
         except Exception as e:
             logger.error(f"فشل إنشاء رسالة المعلومات: {str(e)}", exc_info=True)
-            return "⚠️ تعذر تحميل معلومات الاشتراك"
+            return self.INFO_ERROR_MESSAGE
 
     def _generate_progress_bar(self, used, total, length=10):
         """إنشاء شريط تقدم مرئي"""
@@ -178,23 +257,28 @@ class PremiumManager:
         buttons = [btn for btn in buttons if btn is not None]
         return InlineKeyboardMarkup(buttons)
 
-    def deduct_chars(self, user_id, chars_used):
-        """خصم الأحرف المستخدمة"""
+    def deduct_chars(self, user_id, chars_used, hot=None):
+        """خصم الأحرف المستخدمة
+
+        hot: عقدة الحصص المقروءة قبل إرسال الصوت، فلا يحتاج الخصم قراءة بعده
+        """
         if not isinstance(chars_used, int) or chars_used <= 0:
             logger.error(f"قيمة أحرف غير صالحة: {chars_used}")
             return False
 
         try:
             updates = {
-                'usage/total_chars': db.Increment(chars_used),
+                'usage/total_chars': increment(chars_used),
                 'last_used': {'.sv': 'timestamp'}
             }
 
-            user_data = self.firebase.get_user_data(user_id) or {}
-            if user_data.get('premium', {}).get('is_premium') and user_data.get('premium', {}).get('plan_type') != 'trial':
-                updates['premium/remaining_chars'] = db.Increment(-chars_used)
+            if hot is None:
+                hot = self.firebase.get_user_hot(user_id) or {}
+            if hot.get('is_premium') and hot.get('plan_type') != 'trial':
+                updates['premium/remaining_chars'] = increment(-chars_used)
 
-            self.firebase.ref.child('users').child(str(user_id)).update(updates)
+            self.firebase.update_user(user_id, updates, extra={'stats/total_chars': increment(chars_used)})
+            self._invalidate(user_id)
             return True
         except Exception as e:
             logger.error(f"فشل خصم الأحرف: {str(e)}", exc_info=True)
@@ -203,13 +287,106 @@ class PremiumManager:
     def deactivate_premium(self, user_id):
         """إلغاء الاشتراك المميز"""
         try:
-            updates = {
-                'premium/is_premium': False,
-                'premium/deactivated_on': {'.sv': 'timestamp'},
-                'premium/remaining_chars': 0
-            }
-            self.firebase.ref.child('users').child(str(user_id)).update(updates)
-            return True
+            def deactivate(current):
+                current = current if isinstance(current, dict) else {}
+                return {**current, **{path.split('/', 1)[1]: value for path, value in self._deactivation_updates().items()}}
+
+            written, _ = self.firebase.update_if_unchanged(
+                user_id, 'premium', deactivate,
+                extra=lambda previous: self._premium_count_delta(-1 if self._was_premium(previous) else 0)
+            )
+            self._invalidate(user_id)
+            return written
         except Exception as e:
             logger.error(f"فشل إلغاء الاشتراك: {str(e)}", exc_info=True)
             return False
+
+    def _premium_states(self, user_ids):
+        """حالة الاشتراك الحالية لكل مستخدم موجود (قراءات مجمعة بدون الذاكرة المؤقتة)"""
+        hot_nodes = self.firebase.read_many([f'user_quota/{user_id}' for user_id in user_ids])
+        states = {}
+        unmigrated = []
+        for user_id in user_ids:
+            hot = hot_nodes[f'user_quota/{user_id}']
+            if isinstance(hot, dict) and hot.get('schema') == self.firebase.HOT_SCHEMA_VERSION:
+                states[user_id] = bool(hot.get('is_premium'))
+            else:
+                unmigrated.append(user_id)
+
+        if unmigrated:
+            # مستخدمون بدون عقدة حصص: التحقق من وجودهم ثم قراءة الحقل نفسه
+            exists = self.firebase.read_many([f'users/{user_id}' for user_id in unmigrated], shallow=True)
+            found = [user_id for user_id in unmigrated if exists[f'users/{user_id}']]
+            flags = self.firebase.read_many([f'users/{user_id}/premium/is_premium' for user_id in found])
+            for user_id in found:
+                states[user_id] = bool(flags[f'users/{user_id}/premium/is_premium'])
+        return states
+
+    def bulk_set_premium(self, user_ids, activate, admin_id=None):
+        """تفعيل أو إلغاء الاشتراك لقائمة مستخدمين بكتابات متعددة المسارات مقسمة
+
+        is_premium يُقلب شرطياً (ETag) لكل مستخدم قبل كتابة دفعته، والعداد يتغير بعدد من
+        قلبه هذا الاستدعاء فقط (لا بحالة مقروءة قد يسبقها تفعيل أو إلغاء آخر).
+
+        يعيد تقريراً بالقوائم: changed (تغيرت حالتهم)، renewed (مميزون جُدد اشتراكهم)،
+        skipped (غير مميزين عند الإلغاء)، missing (غير موجودين)، failed (فشلت كتابة دفعتهم)
+        """
+        report = {'changed': [], 'renewed': [], 'skipped': [], 'missing': [], 'failed': []}
+        states = self._premium_states(user_ids)
+
+        targets = []
+        for user_id in user_ids:
+            if user_id not in states:
+                report['missing'].append(user_id)
+            elif activate or states[user_id]:
+                targets.append(user_id)
+            else:
+                report['skipped'].append(user_id)
+
+        updates = self._activation_updates(admin_id) if activate else self._deactivation_updates()
+        for start in range(0, len(targets), self.BULK_CHUNK_SIZE):
+            chunk = targets[start:start + self.BULK_CHUNK_SIZE]
+            try:
+                deadline.check('bulk_premium')
+            except deadline.DeadlineExceeded:
+                report['failed'].extend(targets[start:])
+                break
+
+            candidates = [user_id for user_id in chunk if states[user_id] != activate]
+            flipped, failed = self.firebase.flip_flags(candidates, 'premium/is_premium', activate)
+            flipped, failed = set(flipped), set(failed)
+            report['failed'].extend(user_id for user_id in chunk if user_id in failed)
+            # من ألغى اشتراكه كاتب آخر في الأثناء لم يعد مميزاً؛ ومن فعّله آخر يُجدد فقط
+            lost = [user_id for user_id in candidates if user_id not in flipped and user_id not in failed]
+            if not activate:
+                report['skipped'].extend(lost)
+            written = [
+                user_id for user_id in chunk
+                if user_id not in failed and (activate or user_id not in lost)
+            ]
+
+            multi_path = {}
+            for user_id in written:
+                multi_path.update(self.firebase.user_paths(user_id, updates))
+            multi_path.update(self._premium_count_delta(len(flipped) if activate else -len(flipped)) or {})
+            if not multi_path:
+                continue
+            try:
+                # الأعلام قُلبت فعلاً: بقية الحقول والعداد تُكتب فوراً دون فحص المهلة
+                self.firebase.write_committed(multi_path, user_ids=written)
+            except Exception as e:
+                logger.error(f"فشل كتابة دفعة الاشتراكات ({len(written)} مستخدم): {str(e)}", exc_info=True)
+                if flipped:
+                    logger.warning(f"⚠️ {len(flipped)} علم اشتراك قُلب دون تعديل العداد؛ شغّل manage.py recount-premium")
+                report['failed'].extend(written)
+                continue
+            for user_id in written:
+                report['changed' if user_id in flipped else 'renewed'].append(user_id)
+                if self.cache:
+                    self.cache.delete(f'premium_info:{user_id}')
+
+        logger.info(
+            f"{'تفعيل' if activate else 'إلغاء'} جماعي للاشتراك: "
+            f"{len(report['changed'])} تغيرت حالتهم | {len(report['missing'])} غير موجود | {len(report['failed'])} فشل"
+        )
+        return report
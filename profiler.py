@@ -0,0 +1,87 @@
+import re
+import sys
+import time
+import logging
+import threading
+from collections import Counter
+from config import get_env
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+# أسماء الخيوط المرقمة (shard-3, poll_0) تُجمع تحت اسم واحد
+_THREAD_SUFFIX = re.compile(r'[-_]\d+(_\d+)?$')
+
+
+class ProfileBusy(Exception):
+    """يوجد تسجيل آخر قيد التنفيذ في هذا العامل"""
+
+
+def _thread_label(thread_id, names):
+    return _THREAD_SUFFIX.sub('', names.get(thread_id, f'thread-{thread_id}'))
+
+
+def _collapse(frame):
+    """تحويل الإطار إلى سطر بصيغة collapsed (من الجذر إلى الإطار الحالي)"""
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f'{code.co_filename.rsplit("/", 1)[-1]}:{code.co_name}:{frame.f_lineno}')
+        frame = frame.f_back
+    parts.reverse()
+    return ';'.join(parts)
+
+
+class StackSampler:
+    """تسجيل عينات من مكدسات كل الخيوط عند الطلب فقط (لا كلفة عند الخمول)"""
+
+    def __init__(self):
+        self.MAX_SECONDS = get_env('PROFILE_MAX_SECONDS', 60.0, float)
+        self.MAX_HZ = get_env('PROFILE_MAX_HZ', 250, int)
+        self._lock = threading.Lock()
+
+    def sample(self, seconds=10.0, hz=100):
+        """أخذ العينات لمدة seconds بمعدل hz وإرجاع Counter للمكدسات المطوية"""
+        seconds = min(max(seconds, 0.1), self.MAX_SECONDS)
+        hz = min(max(hz, 1), self.MAX_HZ)
+        if not self._lock.acquire(blocking=False):
+            raise ProfileBusy()
+        try:
+            logger.info(f"🔬 بدء تسجيل المكدسات لمدة {seconds:g} ثانية بمعدل {hz} Hz")
+            own = threading.get_ident()
+            interval = 1.0 / hz
+            stacks = Counter()
+            samples = 0
+            started = time.perf_counter()
+            next_at = started
+            while True:
+                names = {thread.ident: thread.name for thread in threading.enumerate()}
+                for thread_id, frame in sys._current_frames().items():
+                    if thread_id == own:
+                        continue
+                    stacks[f'{_thread_label(thread_id, names)};{_collapse(frame)}'] += 1
+                samples += 1
+                next_at += interval
+                now = time.perf_counter()
+                if now - started >= seconds:
+                    break
+                if next_at > now:
+                    time.sleep(next_at - now)
+                else:
+                    # التأخر عن الجدول: لا نحاول التعويض بعينات متلاحقة
+                    next_at = now
+
+            elapsed = time.perf_counter() - started
+            metrics.incr('profiler.runs')
+            logger.info(f"✅ انتهى التسجيل: {samples} عينة في {elapsed:.1f} ثانية ({len(stacks)} مكدس)")
+            return stacks
+        finally:
+            self._lock.release()
+
+
+def format_collapsed(stacks):
+    """نص collapsed (مكدس ثم عدد العينات) لأدوات flamegraph و speedscope"""
+    return ''.join(f'{stack} {count}\n' for stack, count in stacks.most_common())
+
+
+sampler = StackSampler()
@@ -0,0 +1,96 @@
+import re
+import logging
+import threading
+from collections import OrderedDict
+from config import get_env
+from metrics import metrics
+from concurrency import submit
+
+logger = logging.getLogger(__name__)
+
+# نهاية الجملة: علامات الترقيم العربية واللاتينية أو سطر جديد
+_SENTENCE_END = re.compile(r'(?<=[.!?؟…。])\s+|\n+')
+
+
+def split_sentences(text):
+    """تقسيم النص إلى جمل مع الإبقاء على علامات الترقيم"""
+    return [part.strip() for part in _SENTENCE_END.split(text) if part and part.strip()]
+
+
+class SegmentCache:
+    """ذاكرة LRU لمقاطع الصوت لكل (voice_id, صيغة, جملة) بحد أقصى للحجم"""
+
+    def __init__(self, max_bytes=None):
+        self.max_bytes = max_bytes or get_env('TTS_SEGMENT_CACHE_MB', 64, int) * 1024 * 1024
+        # أقصى عدد طلبات توليد متزامنة لمقاطع النص الواحد
+        self.CONCURRENCY = get_env('TTS_SEGMENT_CONCURRENCY', 4, int)
+        self._lock = threading.Lock()
+        self._segments = OrderedDict()
+        self._size = 0
+        logger.info(f"✅ تم تهيئة ذاكرة مقاطع الصوت ({self.max_bytes // (1024 * 1024)} MB)")
+
+    def get(self, voice_id, audio_format, sentence):
+        key = (voice_id, audio_format, sentence)
+        with self._lock:
+            audio = self._segments.get(key)
+            if audio is not None:
+                self._segments.move_to_end(key)
+        return audio
+
+    def put(self, voice_id, audio_format, sentence, audio):
+        if len(audio) > self.max_bytes:
+            return
+        key = (voice_id, audio_format, sentence)
+        with self._lock:
+            old = self._segments.pop(key, None)
+            if old is not None:
+                self._size -= len(old)
+            self._segments[key] = audio
+            self._size += len(audio)
+            while self._size > self.max_bytes:
+                _, evicted = self._segments.popitem(last=False)
+                self._size -= len(evicted)
+
+    def synthesize(self, voice_id, audio_format, segments, synthesize_fn):
+        """تجميع الصوت من المقاطع المخزنة وتوليد الناقص منها فقط
+
+        المقاطع الناقصة تُولد بالتوازي (حتى CONCURRENCY) على المنفذ المشترك.
+        synthesize_fn(sentence, parallel): parallel=True عند التنفيذ على المنفذ المشترك
+        فلا تبدأ الدالة مهاماً متداخلة عليه.
+        """
+        found = {}
+        hits = 0
+        saved_chars = 0
+        for sentence in segments:
+            audio = found.get(sentence) or self.get(voice_id, audio_format, sentence)
+            if audio is not None:
+                found[sentence] = audio
+                hits += 1
+                saved_chars += len(sentence)
+
+        missing = list(dict.fromkeys(sentence for sentence in segments if sentence not in found))
+        if len(missing) == 1:
+            found[missing[0]] = synthesize_fn(missing[0], False)
+            self.put(voice_id, audio_format, missing[0], found[missing[0]])
+        else:
+            for start in range(0, len(missing), self.CONCURRENCY):
+                batch = missing[start:start + self.CONCURRENCY]
+                futures = [(sentence, submit(synthesize_fn, sentence, True)) for sentence in batch]
+                for sentence, future in futures:
+                    found[sentence] = future.result()
+                    self.put(voice_id, audio_format, sentence, found[sentence])
+        parts = [found[sentence] for sentence in segments]
+
+        metrics.incr('tts.segments.hit', hits)
+        metrics.incr('tts.segments.miss', len(segments) - hits)
+        metrics.incr('tts.segments.saved_chars', saved_chars)
+        if hits:
+            logger.info(
+                f"♻️ مقاطع مخزنة: {hits}/{len(segments)} | أحرف موفرة: {saved_chars}"
+            )
+        return b''.join(parts)
+
+    def hit_ratio(self):
+        hits = metrics.counter('tts.segments.hit')
+        total = hits + metrics.counter('tts.segments.miss')
+        return hits / total if total else 0.0
@@ -0,0 +1,224 @@
+import time
+import queue
+import bisect
+import hashlib
+import logging
+import threading
+from concurrent.futures import Future
+import requests
+from urllib3.exceptions import NewConnectionError
+from config import get_env
+from metrics import metrics
+import deadline
+
+logger = logging.getLogger(__name__)
+
+
+def user_key(payload):
+    """مفتاح التوجيه من JSON التحديث الخام (معرف المستخدم إن وُجد)"""
+    for field in ('message', 'edited_message', 'callback_query', 'inline_query'):
+        sender = (payload.get(field) or {}).get('from') or {}
+        if 'id' in sender:
+            return sender['id']
+    return payload.get('update_id', 0)
+
+
+def _hash(value):
+    return int.from_bytes(hashlib.md5(str(value).encode()).digest()[:8], 'big')
+
+
+def _not_delivered(error):
+    """فشل قبل وصول الطلب إلى العقدة (لا اتصال)، فمعالجته في مكان آخر لا تكررها"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    # requests يغلف MaxRetryError وسببه الفعلي في reason
+    cause = error.args[0] if error.args else None
+    return isinstance(getattr(cause, 'reason', cause), NewConnectionError)
+
+
+class HashRing:
+    """حلقة تجزئة متسقة بعقد افتراضية: تغيير عضو ينقل حصته فقط"""
+
+    def __init__(self, nodes=(), vnodes=100):
+        self.vnodes = vnodes
+        self.nodes = []
+        self._points = ([], [])
+        self.set_nodes(nodes)
+
+    def set_nodes(self, nodes):
+        points = sorted(
+            (_hash(f'{node}#{i}'), node)
+            for node in nodes
+            for i in range(self.vnodes)
+        )
+        # استبدال واحد حتى لا يرى القارئ نصف حلقة أثناء إعادة البناء
+        self._points = ([point for point, _ in points], [node for _, node in points])
+        self.nodes = sorted(set(nodes))
+
+    def node_for(self, key):
+        keys, owners = self._points
+        if not keys:
+            return None
+        return owners[bisect.bisect(keys, _hash(key)) % len(keys)]
+
+
+class ShardWorkers:
+    """طابور وخيط لكل جزء: تحديثات المستخدم الواحد تُعالج بالترتيب في نفس الخيط"""
+
+    def __init__(self, count=None, queue_size=None):
+        self.count = count or get_env('SHARD_WORKERS', 16, int)
+        queue_size = queue_size or get_env('SHARD_QUEUE_SIZE', 1000, int)
+        self._queues = [queue.Queue(queue_size) for _ in range(self.count)]
+        self._busy = [0.0] * self.count
+        for index in range(self.count):
+            threading.Thread(target=self._run, args=(index,), name=f'shard-{index}', daemon=True).start()
+        logger.info(f"✅ تم تهيئة {self.count} جزء محلي لمعالجة التحديثات")
+
+    def shard_for(self, key):
+        return _hash(key) % self.count
+
+    def submit(self, key, func, *args):
+        """إضافة مهمة إلى طابور الجزء الخاص بالمفتاح وإرجاع Future"""
+        index = self.shard_for(key)
+        future = Future()
+        left = deadline.remaining()
+        try:
+            self._queues[index].put(
+                (deadline.bind(func), args, future, time.perf_counter()),
+                timeout=None if left is None else max(0.0, left)
+            )
+        except queue.Full:
+            deadline.expire('shard_queue')
+        metrics.incr(f'shard.{index}.enqueued')
+        return future
+
+    def _run(self, index):
+        work = self._queues[index]
+        while True:
+            func, args, future, enqueued_at = work.get()
+            if not future.set_running_or_notify_cancel():
+                continue
+            started = time.perf_counter()
+            metrics.observe(f'shard.{index}.wait', started - enqueued_at)
+            try:
+                future.set_result(func(*args))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                elapsed = time.perf_counter() - started
+                self._busy[index] += elapsed
+                metrics.observe(f'shard.{index}.service', elapsed)
+                metrics.incr(f'shard.{index}.processed')
+
+    def stats(self):
+        """حمل كل جزء لإظهار الأجزاء الساخنة"""
+        return [
+            {
+                'shard': index,
+                'queue_depth': self._queues[index].qsize(),
+                'processed': metrics.counter(f'shard.{index}.processed'),
+                'busy_seconds': round(self._busy[index], 3),
+                'wait_p95': metrics.percentile(f'shard.{index}.wait', 95)
+            }
+            for index in range(self.count)
+        ]
+
+
+class ShardRouter:
+    """توجيه التحديث إلى العقدة المالكة للمستخدم عبر حلقة التجزئة
+
+    كل عضو في SHARD_NODES عملية واحدة (عامل gunicorn واحد)، فالأجزاء وحجوزات
+    التحديثات المحلية فيها هي وحدها المالكة لمستخدميها.
+    """
+
+    def __init__(self, session, nodes=None, self_node=None):
+        self.session = session
+        configured = nodes or get_env('SHARD_NODES', '')
+        self.members = [node.strip().rstrip('/') for node in configured.split(',') if node.strip()]
+        self.self_node = (self_node or get_env('SHARD_SELF', '')).rstrip('/')
+        self.TOKEN = get_env('SHARD_TOKEN', '')
+        self.DOWN_SECONDS = get_env('SHARD_DOWN_SECONDS', 30.0, float)
+        # المالكة ترد بعد المعالجة: مهلة القراءة هي المتبقي من الميزانية ما لم تُحدد
+        self.FORWARD_TIMEOUT = get_env('SHARD_FORWARD_TIMEOUT', 0.0, float) or None
+        self.CONNECT_TIMEOUT = get_env('SHARD_CONNECT_TIMEOUT', 3.0, float)
+
+        if self.self_node and self.self_node not in self.members:
+            self.members.append(self.self_node)
+        self._lock = threading.Lock()
+        self._down = {}
+        self.ring = HashRing(self.members, get_env('SHARD_VNODES', 100, int))
+        logger.info(f"✅ حلقة التوزيع: {len(self.members)} عقدة | هذه العقدة: {self.self_node or '-'}")
+
+    def _refresh(self):
+        """إعادة العقد المتوقفة بعد انتهاء مهلتها وإعادة بناء الحلقة عند التغيير"""
+        now = time.monotonic()
+        with self._lock:
+            recovered = [node for node, until in self._down.items() if until <= now]
+            for node in recovered:
+                del self._down[node]
+            if recovered:
+                self._rebuild()
+                logger.info(f"🔁 عودة العقد إلى الحلقة: {recovered}")
+
+    def _rebuild(self):
+        self.ring.set_nodes([node for node in self.members if node not in self._down])
+        metrics.incr('shard.rebalance')
+
+    def mark_down(self, node):
+        with self._lock:
+            self._down[node] = time.monotonic() + self.DOWN_SECONDS
+            self._rebuild()
+        logger.warning(f"⚠️ إخراج العقدة {node} من الحلقة لمدة {self.DOWN_SECONDS:g} ثانية")
+
+    def owner(self, key):
+        """العقدة المالكة للمفتاح، أو None إذا كانت هذه العقدة"""
+        if not self.self_node:
+            return None
+        if self._down:
+            self._refresh()
+        node = self.ring.node_for(key)
+        return None if node in (None, self.self_node) else node
+
+    def _timeout(self):
+        read = deadline.timeout(self.FORWARD_TIMEOUT, 'shard_forward')
+        return (self.CONNECT_TIMEOUT if read is None else min(self.CONNECT_TIMEOUT, read), read)
+
+    def forward(self, node, payload):
+        """إرسال التحديث إلى العقدة المالكة وإرجاع ردها
+
+        يعيد None فقط إذا لم يصل الطلب إليها فيُعالج محلياً. ما عدا ذلك (مثل انتهاء
+        مهلة القراءة) ربما استلمته المالكة، فيُرفع الخطأ دون إخراجها من الحلقة.
+        """
+        try:
+            response = self.session.post(
+                f'{node}/internal/shard',
+                json=payload,
+                headers={'X-Shard-Token': self.TOKEN},
+                timeout=self._timeout()
+            )
+            metrics.incr(f'shard.forwarded.{node}')
+            return response
+        except deadline.DeadlineExceeded:
+            raise
+        except Exception as e:
+            if not _not_delivered(e):
+                logger.error(f"❌ لم يتأكد استلام {node} للتحديث المحول: {str(e)}")
+                metrics.incr('shard.forward_unconfirmed')
+                raise
+            logger.error(f"❌ فشل تحويل التحديث إلى {node}: {str(e)}")
+            metrics.incr('shard.forward_failed')
+            self.mark_down(node)
+            return None
+
+    def stats(self):
+        return {
+            'self': self.self_node,
+            'members': self.members,
+            'active': self.ring.nodes,
+            'down': sorted(self._down),
+            'forwarded': {node: metrics.counter(f'shard.forwarded.{node}') for node in self.members},
+            'forward_failed': metrics.counter('shard.forward_failed'),
+            'forward_unconfirmed': metrics.counter('shard.forward_unconfirmed')
+        }
@@ -0,0 +1,167 @@
+import os
+import json
+import time
+import sqlite3
+import logging
+import tempfile
+import threading
+from config import get_env
+
+logger = logging.getLogger(__name__)
+
+_MISSING = object()
+
+
+class SharedCache:
+    """ذاكرة مؤقتة محلية مشتركة بين عمليات gunicorn (مبنية على SQLite)"""
+
+    # لا نحدّث وقت الوصول في كل قراءة حتى لا تتحول القراءات إلى كتابات
+    TOUCH_INTERVAL = 5.0
+    EVICT_EVERY = 100
+
+    def __init__(self, path=None, max_entries=None, default_ttl=None):
+        self.path = path or get_env(
+            'SHARED_CACHE_PATH',
+            os.path.join(tempfile.gettempdir(), 'voice_bot_cache.sqlite3')
+        )
+        self.max_entries = max_entries or get_env('SHARED_CACHE_MAX_ENTRIES', 50000, int)
+        self.default_ttl = default_ttl or get_env('SHARED_CACHE_TTL', 60.0, float)
+        self._local = threading.local()
+        self._writes = 0
+        self._init_schema()
+        logger.info(f"✅ تم تهيئة الذاكرة المشتركة: {self.path} (الحد: {self.max_entries})")
+
+    def _conn(self):
+        """اتصال SQLite خاص بكل خيط"""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5, isolation_level=None, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn = conn
+        return conn
+
+    def _init_schema(self):
+        self._conn().execute(
+            'CREATE TABLE IF NOT EXISTS cache ('
+            ' key TEXT PRIMARY KEY,'
+            ' value TEXT NOT NULL,'
+            ' expires_at REAL NOT NULL,'
+            ' accessed_at REAL NOT NULL)'
+        )
+        self._conn().execute('CREATE INDEX IF NOT EXISTS cache_accessed ON cache (accessed_at)')
+
+    @staticmethod
+    def _dumps(value):
+        return json.dumps(value, ensure_ascii=False, sort_keys=True)
+
+    def get(self, key, default=None):
+        """قراءة قيمة غير منتهية الصلاحية (الفشل يُعامل كعدم وجود)"""
+        now = time.time()
+        try:
+            row = self._conn().execute(
+                'SELECT value, expires_at, accessed_at FROM cache WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None:
+                return default
+
+            value, expires_at, accessed_at = row
+            if expires_at <= now:
+                self._conn().execute('DELETE FROM cache WHERE key = ? AND expires_at <= ?', (key, now))
+                return default
+
+            if now - accessed_at > self.TOUCH_INTERVAL:
+                self._conn().execute('UPDATE cache SET accessed_at = ? WHERE key = ?', (now, key))
+            return json.loads(value)
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ فشل القراءة من الذاكرة المشتركة ({key}): {str(e)}")
+            return default
+
+    def set(self, key, value, ttl=None):
+        """حفظ قيمة مع مدة صلاحية"""
+        now = time.time()
+        try:
+            self._conn().execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, self._dumps(value), now + (ttl or self.default_ttl), now)
+            )
+            self._maybe_evict()
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ فشل الكتابة في الذاكرة المشتركة ({key}): {str(e)}")
+
+    def delete(self, *keys):
+        """حذف مفتاح أو أكثر"""
+        if not keys:
+            return
+        try:
+            self._conn().executemany('DELETE FROM cache WHERE key = ?', [(k,) for k in keys])
+        except sqlite3.Error as e:
+            logger.warning(f"⚠️ فشل الحذف من الذاكرة المشتركة ({', '.join(keys)}): {str(e)}")
+
+    def compare_and_set(self, key, expected, value, ttl=None):
+        """تعيين القيمة فقط إذا كانت القيمة الحالية تساوي expected (None = غير موجود)
+
+        False تعني تعارضاً فعلياً فقط. فشل SQLite (مثل database is locked) يُرفع
+        sqlite3.Error ليقرر المستدعي (الحجوزات تتجاهل الذاكرة المشتركة عندها).
+        """
+        conn = self._conn()
+        now = time.time()
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            row = conn.execute(
+                'SELECT value FROM cache WHERE key = ? AND expires_at > ?', (key, now)
+            ).fetchone()
+            current = row[0] if row else None
+            if current != (None if expected is None else self._dumps(expected)):
+                conn.execute('ROLLBACK')
+                return False
+
+            conn.execute(
+                'INSERT OR REPLACE INTO cache (key, value, expires_at, accessed_at) VALUES (?, ?, ?, ?)',
+                (key, self._dumps(value), now + (ttl or self.default_ttl), now)
+            )
+            conn.execute('COMMIT')
+        except Exception:
+            self._rollback(conn)
+            raise
+        self._maybe_evict()
+        return True
+
+    @staticmethod
+    def _rollback(conn):
+        try:
+            conn.execute('ROLLBACK')
+        except sqlite3.Error:
+            # لا توجد معاملة مفتوحة (فشل COMMIT نفسه أنهاها)
+            pass
+
+    def get_or_set(self, key, factory, ttl=None):
+        """قراءة القيمة أو حسابها وحفظها عند عدم وجودها"""
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = factory()
+            self.set(key, value, ttl)
+        return value
+
+    def _maybe_evict(self):
+        """حذف المنتهي ثم الأقدم وصولاً عند تجاوز الحد"""
+        self._writes += 1
+        if self._writes % self.EVICT_EVERY:
+            return
+
+        try:
+            conn = self._conn()
+            conn.execute('DELETE FROM cache WHERE expires_at <= ?', (time.time(),))
+            excess = conn.execute('SELECT COUNT(*) FROM cache').fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute(
+                    'DELETE FROM cache WHERE key IN (SELECT key FROM cache ORDER BY accessed_at LIMIT ?)',
+                    (excess,)
+                )
+                logger.debug(f"تم إخلاء {excess} عنصر من الذاكرة المشتركة")
+        except sqlite3.Error as e:
+            # الإخلاء يُعاد في الكتابة التالية ولا يُفشل الكتابة الحالية
+            logger.warning(f"⚠️ فشل إخلاء الذاكرة المشتركة: {str(e)}")
+
+    def clear(self):
+        self._conn().execute('DELETE FROM cache')
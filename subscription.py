@@ -1,14 +1,29 @@
 import os
+import time
 import logging
 from telegram import ParseMode
 from telegram.error import TelegramError, BadRequest
 from datetime import datetime, timedelta
+from concurrency import submit
+import deadline
+from deadline import DeadlineExceeded
+from metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+
+def _timed(func, *args):
+    """تنفيذ دالة وإرجاع (النتيجة، المدة)"""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, time.perf_counter() - start
+
+
 class SubscriptionManager:
-    def __init__(self, firebase):
+    def __init__(self, firebase, sender, cache=None):
         self.firebase = firebase
+        self.sender = sender
+        self.cache = cache
         self._validate_environment()
         logger.info("✅ تم تهيئة مدير الاشتراكات بنجاح")
 
@@ -17,6 +32,7 @@ class SubscriptionManager:
         self.FREE_CHAR_LIMIT = self._safe_get_env('FREE_CHAR_LIMIT', 500, int)
         self.MAX_VOICE_CLONES = self._safe_get_env('MAX_VOICE_CLONES', 1, int)
         self.REQUIRED_CHANNELS = self._parse_channels()
+        self.CHANNEL_CACHE_TTL = self._safe_get_env('CHANNEL_CACHE_TTL', 300, int)
         self.PAYMENT_CHANNEL = os.getenv('PAYMENT_CHANNEL', '@premium_support').strip()
         if not self.PAYMENT_CHANNEL.startswith('@'):
             self.PAYMENT_CHANNEL = '@' + self.PAYMENT_CHANNEL
@@ -41,21 +57,36 @@ class SubscriptionManager:
         return channels
 
     def check_all_limits(self, user_id, context, text_length=0):
-        """فحص جميع القيود"""
+        """فحص جميع القيود (استدعاءات القنوات و Firebase تُنفذ بالتوازي)"""
+        start = time.perf_counter()
+        channel_futures = self._submit_channel_checks(user_id, context)
+        hot_future = submit(_timed, self.firebase.get_user_hot, user_id)
+
+        missing_channels, channels_time = self._collect_missing_channels(channel_futures)
+        hot, firebase_time = hot_future.result()
+        elapsed = time.perf_counter() - start
+
+        # الزمن الفعلي يقارب أطول استدعاء بدلاً من مجموعها
+        metrics.observe('precheck.channels', channels_time)
+        metrics.observe('precheck.firebase', firebase_time)
+        metrics.observe('precheck.total', elapsed)
+        metrics.observe('precheck.saved', max(0.0, channels_time + firebase_time - elapsed))
+
         return all([
-            self.check_required_channels(user_id, context),
-            self.check_char_limit(user_id, context, text_length),
-            self.check_voice_clone_limit(user_id, context)
+            self._report_missing_channels(user_id, missing_channels, context),
+            self.check_char_limit(user_id, context, text_length, hot=hot or {}),
+            self.check_voice_clone_limit(user_id, context, hot=hot or {})
         ])
 
-    def check_voice_clone_limit(self, user_id, context=None, ignore_limit=False):
+    def check_voice_clone_limit(self, user_id, context=None, ignore_limit=False, hot=None):
         """فحص حد استنساخ الصوت"""
-        user_data = self.firebase.get_user_data(user_id) or {}
+        if hot is None:
+            hot = self.firebase.get_user_hot(user_id) or {}
         
-        if user_data.get('premium', {}).get('is_premium', False):
+        if hot.get('is_premium', False):
             return True
             
-        if user_data.get('voice_cloned', False) and not ignore_limit:
+        if hot.get('voice_cloned', False) and not ignore_limit:
             alert_msg = (
                 "<b>⚠️ لقد وصلت إلى حد استنساخ الصوت</b>\n\n"
                 "يمكنك استنساخ الصوت مرة واحدة فقط في النسخة المجانية\n"
@@ -63,9 +94,11 @@ class SubscriptionManager:
             )
             try:
                 if context:
-                    context.bot.send_message(
-                        chat_id=user_id,
-                        text=alert_msg,
+                    self.sender.send_message(
+                        context.bot,
+                        user_id,
+                        alert_msg,
+                        dedupe_key='voice_limit',
                         parse_mode=ParseMode.HTML,
                         disable_web_page_preview=True
                     )
@@ -79,16 +112,48 @@ class SubscriptionManager:
         if not self.REQUIRED_CHANNELS:
             return True
 
+        futures = self._submit_channel_checks(user_id, context)
+        missing_channels, _ = self._collect_missing_channels(futures)
+        return self._report_missing_channels(user_id, missing_channels, context)
+
+    def _submit_channel_checks(self, user_id, context):
+        """إرسال فحص كل قناة كمهمة مستقلة"""
+        if not context:
+            return []
+        return [
+            (channel, submit(_timed, self._is_missing_channel, channel, user_id, context))
+            for channel in self.REQUIRED_CHANNELS
+        ]
+
+    def _collect_missing_channels(self, futures):
+        """جمع نتائج فحص القنوات مع مجموع أزمنتها"""
         missing_channels = []
-        for channel in self.REQUIRED_CHANNELS:
+        total_time = 0.0
+        for channel, future in futures:
             try:
-                if context:
-                    member = context.bot.get_chat_member(channel, user_id)
-                    if member.status in ['left', 'kicked']:
-                        missing_channels.append(channel)
+                missing, duration = future.result()
+                total_time += duration
+                if missing:
+                    missing_channels.append(channel)
+            except DeadlineExceeded:
+                raise
             except Exception as e:
                 logger.error(f"خطأ في التحقق من القناة {channel}: {str(e)}")
+        return missing_channels, total_time
+
+    def _is_missing_channel(self, channel, user_id, context):
+        """هل المستخدم غير منضم للقناة؟"""
+        if self._is_cached_member(channel, user_id):
+            return False
+        member = context.bot.get_chat_member(channel, user_id, timeout=deadline.timeout(None, 'channels'))
+        if member.status in ['left', 'kicked']:
+            return True
+        if self.cache:
+            self.cache.set(f'member:{channel}:{user_id}', member.status, self.CHANNEL_CACHE_TTL)
+        return False
 
+    def _report_missing_channels(self, user_id, missing_channels, context=None):
+        """تنبيه المستخدم بالقنوات الناقصة"""
         if missing_channels:
             channels_list = "\n".join(f"• {c}" for c in missing_channels)
             alert_msg = (
@@ -98,9 +163,10 @@ class SubscriptionManager:
             )
             try:
                 if context:
-                    context.bot.send_message(
-                        chat_id=user_id,
-                        text=alert_msg,
+                    self.sender.send_message(
+                        context.bot,
+                        user_id,
+                        alert_msg,
                         parse_mode=ParseMode.HTML
                     )
             except Exception as e:
@@ -108,14 +174,19 @@ class SubscriptionManager:
             return False
         return True
 
-    def check_char_limit(self, user_id, context=None, text_length=0):
+    def _is_cached_member(self, channel, user_id):
+        """العضوية المؤكدة فقط تُحفظ، حتى يُعاد الفحص فور انضمام المستخدم"""
+        return bool(self.cache and self.cache.get(f'member:{channel}:{user_id}'))
+
+    def check_char_limit(self, user_id, context=None, text_length=0, hot=None):
         """فحص حد الأحرف"""
-        user_data = self.firebase.get_user_data(user_id) or {}
+        if hot is None:
+            hot = self.firebase.get_user_hot(user_id) or {}
         
-        if user_data.get('premium', {}).get('is_premium', False):
+        if hot.get('is_premium', False):
             return True
 
-        total_used = user_data.get('usage', {}).get('total_chars', 0)
+        total_used = hot.get('total_chars', 0)
         remaining = self.FREE_CHAR_LIMIT - total_used
 
         if remaining <= 0:
@@ -126,9 +197,11 @@ class SubscriptionManager:
             )
             try:
                 if context:
-                    context.bot.send_message(
-                        chat_id=user_id,
-                        text=alert_msg,
+                    self.sender.send_message(
+                        context.bot,
+                        user_id,
+                        alert_msg,
+                        dedupe_key='char_limit',
                         parse_mode=ParseMode.HTML
                     )
             except Exception as e:
@@ -144,9 +217,11 @@ class SubscriptionManager:
             )
             try:
                 if context:
-                    context.bot.send_message(
-                        chat_id=user_id,
-                        text=alert_msg,
+                    self.sender.send_message(
+                        context.bot,
+                        user_id,
+                        alert_msg,
+                        dedupe_key='low_chars',
                         parse_mode=ParseMode.HTML
                     )
             except Exception as e:
@@ -157,11 +232,11 @@ class SubscriptionManager:
     def get_usage_stats(self, user_id):
         """الحصول على إحصائيات الاستخدام"""
         try:
-            user_data = self.firebase.get_user_data(user_id) or {}
+            hot = self.firebase.get_user_hot(user_id) or {}
             
-            if user_data.get('premium', {}).get('is_premium', False):
-                remaining = user_data['premium'].get('remaining_chars', 0)
-                used = user_data['usage'].get('total_chars', 0)
+            if hot.get('is_premium', False):
+                remaining = hot.get('remaining_chars', 0)
+                used = hot.get('total_chars', 0)
                 total = remaining + used
                 return {
                     'is_premium': True,
@@ -171,7 +246,7 @@ class SubscriptionManager:
                     'percentage': (used / total) * 100 if total > 0 else 0
                 }
             else:
-                used = user_data.get('usage', {}).get('total_chars', 0)
+                used = hot.get('total_chars', 0)
                 remaining = max(0, self.FREE_CHAR_LIMIT - used)
                 return {
                     'is_premium': False,
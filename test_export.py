@@ -0,0 +1,42 @@
+import json
+import pytest
+from export import export_users
+
+USERS = {f'u{i:03d}': {'username': f'name{i}'} for i in range(10)}
+
+
+class FakeFirebase:
+    def __init__(self, fail_after=None):
+        self.fail_after = fail_after
+
+    def iter_users(self, page_size=500, start_after=None):
+        for count, user_id in enumerate(k for k in sorted(USERS) if start_after is None or k > start_after):
+            if self.fail_after is not None and count >= self.fail_after:
+                raise ConnectionError('انقطاع')
+            yield user_id, USERS[user_id]
+
+
+def read_ids(path):
+    with open(path, encoding='utf-8') as f:
+        return [json.loads(line)['id'] for line in f]
+
+
+def test_resume_continues_after_last_checkpoint(tmp_path):
+    output = str(tmp_path / 'users.ndjson')
+    checkpoint = str(tmp_path / 'users.checkpoint')
+
+    with pytest.raises(ConnectionError):
+        export_users(FakeFirebase(fail_after=7), output, checkpoint=checkpoint, page_size=3)
+    assert read_ids(output) == sorted(USERS)[:6]
+
+    result = export_users(FakeFirebase(), output, checkpoint=checkpoint, page_size=3)
+    assert result['records'] == 10
+    assert result['written'] == 4
+    assert read_ids(output) == sorted(USERS)
+
+
+def test_checkpoint_for_other_output_is_rejected(tmp_path):
+    checkpoint = tmp_path / 'users.checkpoint'
+    checkpoint.write_text(json.dumps({'output': 'other', 'last_key': 'u001', 'exported': 2, 'offset': 10}))
+    with pytest.raises(ValueError):
+        export_users(FakeFirebase(), str(tmp_path / 'users.ndjson'), checkpoint=str(checkpoint))
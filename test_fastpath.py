@@ -0,0 +1,43 @@
+from fastpath import FastPathRouter, _command
+
+ADMIN_ID = 1
+
+
+def make_router():
+    return FastPathRouter(['start', 'help', 'stats'], lambda user_id: user_id == ADMIN_ID)
+
+
+def message(text=None, sender=2, **fields):
+    body = {'from': {'id': sender}, **fields}
+    if text is not None:
+        body['text'] = text
+        if text.startswith('/'):
+            body['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+    return {'message': body}
+
+
+def test_command_strips_bot_name_and_case():
+    assert _command(message('/Start@my_bot now')['message']) == 'start'
+    assert _command({'text': 'hello'}) is None
+    assert _command({'text': 'x /start', 'entities': [{'type': 'bot_command', 'offset': 2, 'length': 6}]}) is None
+
+
+def test_route():
+    router = make_router()
+    assert router.route({'callback_query': {}}) == (True, 'callback')
+    assert router.route({'edited_message': {}}) == (False, 'unhandled_update')
+    assert router.route(message(voice={})) == (True, 'media')
+    assert router.route(message('/help')) == (True, 'command')
+    assert router.route(message('/unknown')) == (False, 'unknown_command')
+    assert router.route(message('hi')) == (False, 'short_text')
+    assert router.route(message('hi', sender=ADMIN_ID)) == (True, 'text')
+    assert router.route(message('hello there')) == (True, 'text')
+    assert router.route(message(document={})) == (False, 'unhandled_message')
+    assert router.route(message(document={}, sender=ADMIN_ID)) == (True, 'document')
+
+
+def test_sender_id():
+    router = make_router()
+    assert router.sender_id(message('hi', sender=5)) == 5
+    assert router.sender_id({'callback_query': {'from': {'id': 6}}}) == 6
+    assert router.sender_id({}) is None
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip('telegram')
+import messenger
+from messenger import TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [100.0]
+    monkeypatch.setattr(messenger.time, 'monotonic', lambda: now[0])
+    return now
+
+
+def test_token_bucket_burst_then_wait(clock):
+    bucket = TokenBucket(rate=2.0, capacity=2)
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == 0.0
+    assert bucket.reserve() == pytest.approx(0.5)
+
+
+def test_token_bucket_refills_up_to_capacity(clock):
+    bucket = TokenBucket(rate=2.0, capacity=2)
+    bucket.reserve()
+    bucket.reserve()
+    clock[0] += 10
+    assert bucket.reserve() == 0.0
+    assert bucket.tokens == pytest.approx(1.0)
+
+
+def test_token_bucket_refund(clock):
+    bucket = TokenBucket(rate=1.0, capacity=1)
+    bucket.reserve()
+    bucket.refund()
+    assert bucket.reserve() == 0.0
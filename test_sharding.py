@@ -0,0 +1,23 @@
+import pytest
+
+pytest.importorskip('requests')
+from sharding import HashRing
+
+KEYS = [str(user_id) for user_id in range(2000)]
+
+
+def test_empty_ring_has_no_owner():
+    assert HashRing().node_for('1') is None
+
+
+def test_same_key_same_node():
+    ring = HashRing(['a', 'b', 'c'])
+    assert [ring.node_for(key) for key in KEYS] == [HashRing(['c', 'b', 'a']).node_for(key) for key in KEYS]
+
+
+def test_adding_node_moves_only_its_share():
+    before = HashRing(['a', 'b', 'c'])
+    after = HashRing(['a', 'b', 'c', 'd'])
+    moved = [key for key in KEYS if before.node_for(key) != after.node_for(key)]
+    assert all(after.node_for(key) == 'd' for key in moved)
+    assert 0.1 < len(moved) / len(KEYS) < 0.4
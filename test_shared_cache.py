@@ -0,0 +1,55 @@
+import sqlite3
+import pytest
+from shared_cache import SharedCache
+from idempotency import UpdateDeduplicator
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return SharedCache(path=str(tmp_path / 'cache.sqlite3'), max_entries=100, default_ttl=60)
+
+
+@pytest.fixture
+def locked(cache):
+    """قفل كتابة من اتصال آخر، ومهلة قصيرة لاتصال الذاكرة بدل 5 ثوانٍ"""
+    cache._local.conn = sqlite3.connect(cache.path, timeout=0.05, isolation_level=None)
+    other = sqlite3.connect(cache.path, isolation_level=None)
+    other.execute('BEGIN IMMEDIATE')
+    yield cache
+    other.execute('ROLLBACK')
+    other.close()
+
+
+def test_compare_and_set_conflict_returns_false(cache):
+    assert cache.compare_and_set('k', None, 1) is True
+    assert cache.compare_and_set('k', None, 2) is False
+    assert cache.compare_and_set('k', 1, 2) is True
+    assert cache.get('k') == 2
+
+
+def test_compare_and_set_lock_raises(locked):
+    with pytest.raises(sqlite3.Error):
+        locked.compare_and_set('k', None, 1)
+
+
+def test_dedupe_rejects_duplicate_and_release_allows_retry(cache):
+    dedupe = UpdateDeduplicator(store=cache)
+    assert dedupe.claim(1) is True
+    assert dedupe.claim(1) is False
+    dedupe.release(1)
+    assert dedupe.claim(1) is True
+
+
+def test_dedupe_sees_claims_from_other_processes(cache):
+    assert UpdateDeduplicator(store=cache).claim(7) is True
+    assert UpdateDeduplicator(store=cache).claim(7) is False
+
+
+def test_dedupe_fails_open_when_store_locked(locked):
+    assert UpdateDeduplicator(store=locked).claim(9) is True
+
+
+def test_dedupe_without_id_always_claims():
+    dedupe = UpdateDeduplicator()
+    assert dedupe.claim(None) is True
+    assert dedupe.claim(None) is True
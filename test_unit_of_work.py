@@ -0,0 +1,89 @@
+import threading
+import unit_of_work
+from unit_of_work import UnitOfWork, increment
+
+
+class FakeRef:
+    def __init__(self):
+        self.calls = []
+
+    def update(self, updates):
+        self.calls.append(updates)
+
+
+def test_increments_on_same_path_combine():
+    uow = UnitOfWork()
+    uow.add({'users/1/usage/total_chars': increment(5)})
+    uow.add({'users/1/usage/total_chars': increment(-2)})
+    assert uow.updates == {'users/1/usage/total_chars': increment(3)}
+
+
+def test_increment_applies_to_pending_plain_value():
+    uow = UnitOfWork()
+    uow.add({'stats/users': 10})
+    uow.add({'stats/users': increment(1)})
+    assert uow.updates == {'stats/users': 11}
+
+
+def test_child_write_merges_into_pending_parent():
+    uow = UnitOfWork()
+    uow.add({'users/1': {'name': 'a'}})
+    uow.add({'users/1/premium/is_premium': True})
+    assert uow.updates == {'users/1': {'name': 'a', 'premium': {'is_premium': True}}}
+
+
+def test_parent_write_replaces_pending_children():
+    uow = UnitOfWork()
+    uow.add({'users/1/name': 'a'})
+    uow.add({'users/1': {'name': 'b'}})
+    assert uow.updates == {'users/1': {'name': 'b'}}
+
+
+def test_add_base_replays_pending_writes_on_top():
+    uow = UnitOfWork()
+    uow.add({'user_quota/1/remaining_chars': increment(-1)})
+    uow.add_base('user_quota/1', {'remaining_chars': 1, 'is_premium': True})
+    assert uow.updates == {'user_quota/1': {'remaining_chars': 0, 'is_premium': True}}
+
+
+def test_discard_keeps_durable_writes():
+    uow = UnitOfWork()
+    uow.add({'activity/2026-01-01/1': True}, user_ids=[1], durable=True)
+    uow.add({'users/1/usage/total_chars': increment(5)}, user_ids=[1])
+    assert uow.discard() == 1
+    assert uow.updates == {'activity/2026-01-01/1': True}
+    assert uow.user_ids == {1}
+
+
+def test_failed_runs_callbacks_once():
+    uow = UnitOfWork()
+    calls = []
+    uow.on_failure(lambda: calls.append(1))
+    uow.failed()
+    uow.failed()
+    assert calls == [1]
+
+
+def test_commit_sends_one_multi_path_update():
+    uow = UnitOfWork()
+    ref = FakeRef()
+    assert uow.commit(ref) is False
+    uow.add({'a/x': 1})
+    uow.add({'b/y': 2})
+    assert uow.commit(ref) is True
+    assert ref.calls == [{'a/x': 1, 'b/y': 2}]
+
+
+def test_bind_carries_unit_of_work_to_other_thread():
+    uow = unit_of_work.begin()
+    try:
+        seen = []
+        task = unit_of_work.bind(lambda: seen.append(unit_of_work.current()))
+        thread = threading.Thread(target=task)
+        thread.start()
+        thread.join()
+        assert seen == [uow]
+    finally:
+        unit_of_work.end()
+    assert unit_of_work.current() is None
+    assert uow.closed
@@ -0,0 +1,160 @@
+import os
+import re
+import gzip
+import json
+import time
+import hmac
+import atexit
+import hashlib
+import logging
+import threading
+from config import get_env
+
+logger = logging.getLogger(__name__)
+
+# كائنات تحمل هوية مستخدم أو محادثة داخل التحديث
+_IDENTITY_KEYS = ('from', 'chat', 'user', 'forward_from', 'sender_chat', 'forward_from_chat')
+_NAME_FIELDS = ('username', 'first_name', 'last_name', 'title')
+_TEXT_FIELDS = ('text', 'caption')
+_FILE_FIELDS = ('file_id', 'file_unique_id')
+# لا تُحفظ أبداً (entities تبقى لأن CommandHandler يعتمد عليها، والنص المموه بنفس الطول)
+_DROPPED_FIELDS = ('contact', 'location', 'venue', 'url')
+_WORD = re.compile(r'\w', re.UNICODE)
+_LONG_NUMBER = re.compile(r'\d{5,}')
+
+
+class Anonymizer:
+    """استبدال المعرفات والنصوص بقيم ثابتة بنفس الشكل (الطول والترقيم والأوامر)"""
+
+    def __init__(self, salt):
+        self.salt = salt.encode()
+
+    def _digest(self, value):
+        return hmac.new(self.salt, str(value).encode(), hashlib.sha256).digest()
+
+    def user_id(self, value):
+        anon = int.from_bytes(self._digest(value)[:6], 'big') % 10 ** 10 + 10 ** 9
+        return -anon if isinstance(value, int) and value < 0 else anon
+
+    def token(self, value, prefix):
+        return f'{prefix}{self._digest(value).hex()[:16]}'
+
+    @staticmethod
+    def text(value):
+        # الأوامر تبقى كما هي حتى يذهب التحديث لنفس المعالج
+        if value.startswith('/'):
+            command, _, rest = value.partition(' ')
+            return f'{command} {_WORD.sub(Anonymizer._mask, rest)}' if rest else command
+        return _WORD.sub(Anonymizer._mask, value)
+
+    @staticmethod
+    def _mask(match):
+        return 'x' if match.group().isascii() else 'س'
+
+    def update(self, node):
+        """نسخة مجهولة من التحديث"""
+        if isinstance(node, list):
+            return [self.update(item) for item in node]
+        if not isinstance(node, dict):
+            return node
+
+        result = {}
+        for key, value in node.items():
+            if key in _DROPPED_FIELDS:
+                continue
+            if key in _IDENTITY_KEYS and isinstance(value, dict):
+                value = self.update(value)
+                if 'id' in value:
+                    value['id'] = self.user_id(node[key]['id'])
+                result[key] = value
+            elif key in _NAME_FIELDS and isinstance(value, str):
+                result[key] = self.token(value, 'u')
+            elif key in _TEXT_FIELDS and isinstance(value, str):
+                result[key] = self.text(value)
+            elif key in _FILE_FIELDS and isinstance(value, str):
+                result[key] = self.token(value, 'f')
+            elif key == 'data' and isinstance(value, str):
+                # بيانات الأزرار قد تحمل معرف مستخدم (premium_monthly_<id>)
+                result[key] = _LONG_NUMBER.sub(lambda m: str(self.user_id(int(m.group()))), value)
+            else:
+                result[key] = self.update(value)
+        return result
+
+
+class TraceRecorder:
+    """تسجيل التحديثات الواردة (مجهولة) مع وقت وصولها في ملف NDJSON مضغوط"""
+
+    FLUSH_INTERVAL = 1.0
+
+    def __init__(self, path, salt=None):
+        # ملف لكل عملية حتى لا تتداخل كتابات عمال gunicorn
+        self.path = path.replace('{pid}', str(os.getpid()))
+        self.anonymizer = Anonymizer(salt or get_env('TRACE_SALT', os.urandom(16).hex()))
+        self._lock = threading.Lock()
+        self._file = gzip.open(self.path, 'at', encoding='utf-8')
+        self._last_flush = time.monotonic()
+        self.recorded = 0
+        atexit.register(self.close)
+        logger.info(f"⏺ تسجيل حركة الويب هوك في {self.path}")
+
+    def record(self, payload, arrived_at=None):
+        """تسجيل تحديث واحد (الأخطاء لا تؤثر على معالجة الطلب)"""
+        try:
+            line = json.dumps({
+                't': arrived_at or time.time(),
+                'update': self.anonymizer.update(payload)
+            }, ensure_ascii=False)
+            with self._lock:
+                if self._file is None:
+                    return
+                self._file.write(line + '\n')
+                self.recorded += 1
+                now = time.monotonic()
+                if now - self._last_flush >= self.FLUSH_INTERVAL:
+                    self._file.flush()
+                    self._last_flush = now
+        except Exception as e:
+            logger.warning(f"⚠️ فشل تسجيل التحديث: {str(e)}")
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+def read_traces(paths):
+    """قراءة ملف تسجيل أو أكثر مرتبة حسب وقت الوصول"""
+    records = []
+    for path in paths:
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            try:
+                for line in f:
+                    line = line.strip()
+                    if not line:
+                        continue
+                    try:
+                        records.append(json.loads(line))
+                    except json.JSONDecodeError:
+                        logger.warning(f"⚠️ تم تجاهل سطر تالف في {path}")
+            except EOFError:
+                # ملف عملية توقفت قبل إغلاقه: نكتفي بما كُتب حتى آخر تفريغ
+                logger.warning(f"⚠️ ملف غير مكتمل: {path}")
+    records.sort(key=lambda record: record['t'])
+    return records
+
+
+def update_kind(update):
+    """تصنيف التحديث لتقرير زمن الاستجابة"""
+    if 'callback_query' in update:
+        data = update['callback_query'].get('data') or ''
+        return f"callback:{data.split('_', 1)[0]}"
+    message = update.get('message') or {}
+    if 'voice' in message or 'audio' in message:
+        return 'voice'
+    text = message.get('text')
+    if text is None:
+        return 'other'
+    if text.startswith('/'):
+        return f"command:{text.split()[0]}"
+    return 'text:long' if len(text) > 500 else 'text'
@@ -0,0 +1,184 @@
+import copy
+import logging
+import threading
+from metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def increment(n):
+    """قيمة خادم تزيد الحقل ذرياً بمقدار n"""
+    return {'.sv': {'increment': n}}
+
+
+def _increment_of(value):
+    if isinstance(value, dict) and isinstance(value.get('.sv'), dict):
+        return value['.sv'].get('increment')
+    return None
+
+
+def _is_object(value):
+    return isinstance(value, dict) and '.sv' not in value
+
+
+def _combine(old, new):
+    """دمج كتابتين متتاليتين على نفس المسار"""
+    delta = _increment_of(new)
+    if delta is not None:
+        old_delta = _increment_of(old)
+        if old_delta is not None:
+            return increment(old_delta + delta)
+        if isinstance(old, (int, float)) and not isinstance(old, bool):
+            return old + delta
+    return new
+
+
+class UnitOfWork:
+    """تجميع كتابات Firebase لتحديث تيليجرام واحد وتنفيذها كتحديث متعدد المسارات"""
+
+    def __init__(self):
+        self.updates = {}
+        self.user_ids = set()
+        self.operations = 0
+        # مهام المنفذ المشترك تضيف إلى نفس الوحدة من خيوط أخرى (bind)
+        self._lock = threading.RLock()
+        self.closed = False
+        # كتابات لا تُلغى بخطأ معالج لاحق (تُعاد بعد التراجع) وما يُستدعى إذا لم تُكتب
+        self._durable = []
+        self._failure_callbacks = []
+
+    def add(self, updates, user_ids=(), durable=False):
+        """إضافة كتابة متعددة المسارات بنفس ترتيب تنفيذها
+
+        durable=True: تبقى بعد rollback (مثل علامة النشاط التي حُجزت خارج القاعدة)
+        """
+        with self._lock:
+            for path, value in updates.items():
+                self._merge(path.strip('/'), value)
+            self.user_ids.update(user_ids)
+            self.operations += 1
+            if durable:
+                self._durable.append((updates, tuple(user_ids)))
+
+    def on_failure(self, callback):
+        """استدعاء callback إذا لم تُنفذ كتابات الوحدة (فشل التنفيذ أو خطأ أنهى الكتلة)"""
+        with self._lock:
+            self._failure_callbacks.append(callback)
+
+    def failed(self):
+        with self._lock:
+            callbacks, self._failure_callbacks = self._failure_callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.warning(f"⚠️ فشل استدعاء ما بعد فشل وحدة العمل: {str(e)}")
+
+    def discard(self):
+        """إلغاء الكتابات غير الدائمة، ويعيد عدد المسارات الملغاة"""
+        with self._lock:
+            before = len(self.updates)
+            self.updates = {}
+            self.user_ids = set()
+            for updates, user_ids in self._durable:
+                for path, value in updates.items():
+                    self._merge(path.strip('/'), value)
+                self.user_ids.update(user_ids)
+            return before - len(self.updates)
+
+    def _merge(self, path, value):
+        if isinstance(value, dict):
+            value = copy.deepcopy(value)
+        # تحديث متعدد المسارات يرفض مساراً وأحد آبائه معاً، فنكتب داخل الأب
+        parts = path.split('/')
+        for i in range(len(parts) - 1, 0, -1):
+            ancestor = '/'.join(parts[:i])
+            if ancestor in self.updates:
+                if not _is_object(self.updates[ancestor]):
+                    self.updates[ancestor] = {}
+                node = self.updates[ancestor]
+                for part in parts[i:-1]:
+                    if not _is_object(node.get(part)):
+                        node[part] = {}
+                    node = node[part]
+                node[parts[-1]] = _combine(node.get(parts[-1]), value)
+                return
+
+        # الكتابة على أب تستبدل كل ما كُتب تحته سابقاً
+        prefix = path + '/'
+        for existing in [p for p in self.updates if p.startswith(prefix)]:
+            del self.updates[existing]
+        self.updates[path] = _combine(self.updates.get(path), value)
+
+    def add_base(self, path, value):
+        """كتابة قيمة أساس لعقدة قُرئت قبل كتابات هذا التحديث
+
+        الكتابات المعلقة تحت المسار تُعاد فوق القيمة بدلاً من أن تستبدلها.
+        """
+        path = path.strip('/')
+        prefix = path + '/'
+        with self._lock:
+            pending = [(p, v) for p, v in self.updates.items() if p.startswith(prefix)]
+            for existing, _ in pending:
+                del self.updates[existing]
+            self._merge(path, value)
+            for existing, pending_value in pending:
+                self._merge(existing, pending_value)
+
+    def commit(self, ref):
+        with self._lock:
+            if not self.updates:
+                return False
+            ref.update(self.updates)
+        metrics.incr('firebase.writes')
+        metrics.incr('uow.coalesced', self.operations - 1)
+        return True
+
+
+def current():
+    """وحدة العمل النشطة في الخيط الحالي (أو None)"""
+    uow = getattr(_local, 'uow', None)
+    # مهمة تأخرت عن نهاية تحديثها تكتب مباشرة بدلاً من وحدة نُفذت وانتهت
+    return None if uow is None or uow.closed else uow
+
+
+def begin():
+    """بدء وحدة عمل جديدة، أو None إذا كانت هناك وحدة نشطة"""
+    if current() is not None:
+        return None
+    _local.uow = UnitOfWork()
+    return _local.uow
+
+
+def end():
+    uow = getattr(_local, 'uow', None)
+    if uow is not None:
+        uow.closed = True
+    _local.uow = None
+
+
+def bind(func):
+    """نقل وحدة العمل إلى خيط آخر (مهام المنفذ المشترك)، مثل deadline.bind"""
+    uow = current()
+
+    def wrapper(*args, **kwargs):
+        previous = getattr(_local, 'uow', None)
+        _local.uow = uow
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.uow = previous
+    return wrapper
+
+
+def rollback():
+    """إلغاء الكتابات المعلقة في وحدة العمل الحالية"""
+    uow = current()
+    if uow is None:
+        return
+    discarded = uow.discard()
+    if discarded > 0:
+        logger.warning(f"↩️ تم إلغاء {discarded} كتابة معلقة بعد خطأ")
+        metrics.incr('uow.rolled_back')
@@ -0,0 +1,115 @@
+import json
+import time
+import logging
+import threading
+from urllib.parse import parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+logger = logging.getLogger(__name__)
+
+# مقطع ثابت يُعاد لكل طلب صوت (المحتوى لا يهم في إعادة التشغيل)
+_AUDIO_CHUNK = b'\x00' * 1024
+
+
+def _message(chat_id):
+    return {
+        'message_id': int(time.time() * 1000) % 2 ** 31,
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private'},
+        'text': ''
+    }
+
+
+def _int(value, default=1):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return default
+
+
+def _telegram_result(method, params):
+    """أقل رد صالح لكل دالة من Bot API يستخدمها البوت"""
+    chat_id = _int(params.get('chat_id'))
+    if method == 'getMe':
+        return {'id': 1, 'is_bot': True, 'first_name': 'stub', 'username': 'stub_bot'}
+    if method in ('sendMessage', 'sendVoice', 'editMessageText'):
+        return _message(chat_id)
+    if method == 'getChatMember':
+        return {
+            'user': {'id': _int(params.get('user_id')), 'is_bot': False, 'first_name': 'user'},
+            'status': 'member'
+        }
+    if method == 'getFile':
+        return {
+            'file_id': params.get('file_id', 'stub'),
+            'file_unique_id': 'stub',
+            'file_size': 64 * 1024,
+            'file_path': 'voice/stub.ogg'
+        }
+    return True
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _params(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        content_type = self.headers.get('Content-Type', '')
+        if 'json' in content_type and body:
+            return json.loads(body)
+        if 'x-www-form-urlencoded' in content_type:
+            return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        # multipart (sendVoice): لا نحتاج الحقول
+        return {}
+
+    def _send(self, status, body, content_type='application/json'):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _delay(self):
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+    def do_HEAD(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_GET(self):
+        self._delay()
+        if self.path.startswith('/file/bot'):
+            return self._send(200, _AUDIO_CHUNK * 64, 'audio/ogg')
+        self._send(404, b'{}')
+
+    def do_POST(self):
+        params = self._params()
+        self._delay()
+        if self.path.startswith('/bot'):
+            method = self.path.rsplit('/', 1)[-1]
+            body = {'ok': True, 'result': _telegram_result(method, params)}
+            return self._send(200, json.dumps(body).encode())
+        if self.path == '/v1/voices':
+            return self._send(200, json.dumps({'id': 'stub-voice'}).encode())
+        if self.path == '/v1/audio/stream':
+            # حجم تقريبي يتناسب مع طول النص
+            chunks = max(1, len(params.get('input', '')) // 20)
+            return self._send(200, _AUDIO_CHUNK * chunks, 'audio/ogg')
+        self._send(404, b'{}')
+
+
+def start_stub_server(port=0, latency=0.0):
+    """تشغيل خادم بديل لـ Telegram و Speechify في خيط خلفي وإرجاع عنوانه"""
+    server = ThreadingHTTPServer(('127.0.0.1', port), _Handler)
+    server.daemon_threads = True
+    server.latency = latency
+    threading.Thread(target=server.serve_forever, name='upstream-stub', daemon=True).start()
+    url = f'http://127.0.0.1:{server.server_address[1]}'
+    logger.info(f"🧪 خادم بديل للخدمات الخارجية على {url} (تأخير {latency * 1000:.0f} ms)")
+    return server, url
@@ -0,0 +1,101 @@
+import time
+import threading
+from contextlib import contextmanager
+from config import get_env
+
+# تيليجرام ينفذ استدعاءً واحداً من Bot API يُعاد في جسم رد الويب هوك
+_local = threading.local()
+
+
+def max_age():
+    """أقصى زمن معالجة يُعتمد بعده على جسم الرد (بعده قد تتخلى تيليجرام عن الطلب)"""
+    return get_env('WEBHOOK_REPLY_MAX_SECONDS', 10.0, float)
+
+
+class ReplySlot:
+    """مكان استدعاء واحد يُعاد في رد الويب هوك بدلاً من طلب HTTPS صادر"""
+
+    def __init__(self):
+        self.method = None
+        self.params = None
+        # المعاملات كما مُررت، لتنفيذ الاستدعاء كطلب صادر عند التأخر
+        self.kwargs = None
+        self.opened = time.monotonic()
+        # خيط الطلب قد يتوقف عن انتظار خيط الجزء؛ فيرسل الأخير الرد بنفسه
+        self._lock = threading.Lock()
+        self.detached = False
+        self.done = False
+
+    def payload(self):
+        if self.method is None:
+            return None
+        return {'method': self.method, **self.params}
+
+    def expired(self):
+        return self.detached or time.monotonic() - self.opened >= max_age()
+
+    def detach(self):
+        """خيط الطلب لن ينتظر النهاية (False إذا انتهت المعالجة في الأثناء)"""
+        with self._lock:
+            if self.done:
+                return False
+            self.detached = True
+            return True
+
+    def finish(self):
+        """نهاية المعالجة: True إذا تخلى عنها خيط الطلب فالرد المحجوز مسؤولية المعالج"""
+        with self._lock:
+            self.done = True
+            return self.detached
+
+
+def current():
+    return getattr(_local, 'slot', None)
+
+
+@contextmanager
+def slot():
+    """فتح مكان الرد للتحديث الجاري في هذا الخيط (مسار الويب هوك فقط)"""
+    previous = current()
+    _local.slot = ReplySlot()
+    try:
+        yield _local.slot
+    finally:
+        _local.slot = previous
+
+
+def available():
+    reply = current()
+    return reply is not None and reply.method is None and not reply.expired()
+
+
+def put(method, params):
+    """حجز المكان لاستدعاء (كائنات telegram تُحول إلى dict)"""
+    reply = current()
+    reply.method = method
+    reply.kwargs = {key: value for key, value in params.items() if value is not None}
+    reply.params = {
+        key: value.to_dict() if hasattr(value, 'to_dict') else value
+        for key, value in reply.kwargs.items()
+    }
+
+
+def discard():
+    """إلغاء الاستدعاء المحجوز (المعالج فشل بعد حجزه)"""
+    reply = current()
+    if reply is not None:
+        reply.method = reply.params = reply.kwargs = None
+
+
+def bind(func):
+    """نقل مكان الرد إلى خيط آخر (خيوط الأجزاء)"""
+    reply = current()
+
+    def wrapper(*args, **kwargs):
+        previous = current()
+        _local.slot = reply
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.slot = previous
+    return wrapper